@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+# 路由匹配性能对比: 原先的逐个正则匹配 / 路由树 / 合并正则
+# 运行: python benchmarks/bench_router.py
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mwebapp.router import TrieRouter, RegexRouter, _build_regex
+
+
+class LinearRouter(object):
+    # 原 WSGIApplication.match 的实现，按注册顺序逐个尝试正则
+    def __init__(self):
+        self._dynamic = {}
+
+    def add(self, method, path, func):
+        self._dynamic.setdefault(method, {})[re.compile(_build_regex(path))] = func
+
+    def match(self, method, path):
+        for re_path, fn in self._dynamic.get(method, {}).items():
+            args = re_path.match(path)
+            if args:
+                return fn, args.groups()
+        return None
+
+
+def _handler():
+    pass
+
+
+def build(router_class, count):
+    router = router_class()
+    for i in range(count):
+        router.add('GET', '/resource%d/:id/item/:name/' % i, _handler)
+    return router
+
+
+def bench(count, number=20000):
+    # 分别测试第一个路由、最后一个路由和未命中的地址
+    paths = {
+        'first': '/resource0/42/item/abc/',
+        'last': '/resource%d/42/item/abc/' % (count - 1),
+        'miss': '/missing/42/item/abc/',
+    }
+    results = []
+    for router_class in (LinearRouter, TrieRouter, RegexRouter):
+        router = build(router_class, count)
+        for name, path in sorted(paths.items()):
+            # 预热，RegexRouter 在首次匹配时编译
+            router.match('GET', path)
+            seconds = timeit.timeit(lambda: router.match('GET', path), number=number)
+            results.append((router_class.__name__, name, seconds / number * 1e6))
+    return results
+
+
+def main():
+    print('%-8s %-14s %-6s %12s' % ('routes', 'router', 'path', 'us/match'))
+    for count in (10, 100, 1000):
+        number = 20000 if count < 1000 else 2000
+        for router_name, path_name, usec in bench(count, number):
+            print('%-8d %-14s %-6s %12.3f' % (count, router_name, path_name, usec))
+
+
+if __name__ == '__main__':
+    main()
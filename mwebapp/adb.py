@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+# 数据库的 asyncio 接口，需要 python 3.5+
+# 同步的数据库函数在有界的线程池中执行，线程数默认与连接池大小相同。
+# 不在 aconnection/atransaction 内时每次调用各自取一个连接，可以用 asyncio.gather 并发执行多个查询:
+#     users, count = await asyncio.gather(db.aselect('select * from user'), db.aselect_int('select count(*) from user'))
+# aconnection/atransaction 内的调用共用一个连接，连接状态保存在 contextvars 中并依次执行
+import asyncio
+import functools
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from mwebapp import db
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# 当前 task 的连接状态，见 aconnection
+_async_state = contextvars.ContextVar('mwebapp_db_state', default=None)
+
+
+def set_executor(max_workers=None):
+    # 设置执行数据库操作的线程数，None 为连接池大小
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor = ThreadPoolExecutor(max_workers or _pool_size(), thread_name_prefix='mwebapp-db')
+
+
+def _pool_size():
+    if db.engine is None:
+        raise db.DBError('Engine is not initialized.')
+    return db.engine.pool.max_size
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(_pool_size(), thread_name_prefix='mwebapp-db')
+    return _executor
+
+
+class _AsyncState(object):
+    # 一个 aconnection 作用域的连接状态，执行时换入工作线程的 db._db_ctx
+    def __init__(self):
+        # 新建的 _DbCtx 在当前线程的属性即初始状态
+        self.values = dict(vars(db._DbCtx()))
+        self.lock = asyncio.Lock()
+
+
+def _call(state, func, args, kw):
+    # 在工作线程中执行，state 不为 None 时使用该作用域的连接
+    if state is None:
+        return func(*args, **kw)
+    local = vars(db._db_ctx)
+    saved = dict(local)
+    local.clear()
+    local.update(state.values)
+    try:
+        return func(*args, **kw)
+    finally:
+        state.values = dict(local)
+        local.clear()
+        local.update(saved)
+
+
+async def arun(func, *args, **kw):
+    # 在线程池中执行同步的数据库函数，func 中可以看到调用方的 contextvars
+    state = _async_state.get()
+    if state is None:
+        return await _submit(None, func, args, kw)
+    return await arun_in(state, func, *args, **kw)
+
+
+async def arun_in(state, func, *args, **kw):
+    # 使用指定的连接状态执行，同一连接上的调用依次执行
+    async with state.lock:
+        return await _submit(state, func, args, kw)
+
+
+def _submit(state, func, args, kw):
+    loop = asyncio.get_event_loop()
+    call = functools.partial(contextvars.copy_context().run, _call, state, func, args, kw)
+    return loop.run_in_executor(_get_executor(), call)
+
+
+async def aselect(sql, *args, **kw):
+    return await arun(db.select, sql, *args, **kw)
+
+
+async def aselect_one(sql, *args, **kw):
+    return await arun(db.select_one, sql, *args, **kw)
+
+
+async def aselect_int(sql, *args, **kw):
+    return await arun(db.select_int, sql, *args, **kw)
+
+
+async def aselect_rows(sql, *args, **kw):
+    return await arun(db.select_rows, sql, *args, **kw)
+
+
+async def aupdate(sql, *args):
+    return await arun(db.update, sql, *args)
+
+
+async def ainsert(table, **kw):
+    return await arun(db.insert, table, **kw)
+
+
+async def ainsert_many(table, rows, **kw):
+    return await arun(db.insert_many, table, rows, **kw)
+
+
+async def aupdate_many(table, pk, rows, **kw):
+    return await arun(db.update_many, table, pk, rows, **kw)
+
+
+def _init_state():
+    if db.engine is None:
+        raise db.DBError('Engine is not initialized.')
+    db._db_ctx.init(db.engine)
+
+
+class _AsyncConnectionCtx(object):
+    # async with aconnection(): 作用域内的调用共用一个连接
+    async def __aenter__(self):
+        self.token = None
+        if _async_state.get() is None:
+            state = _AsyncState()
+            await arun_in(state, _init_state)
+            self.token = _async_state.set(state)
+        return self
+
+    async def __aexit__(self, exctype, excvalue, traceback):
+        if self.token is not None:
+            state = _async_state.get()
+            _async_state.reset(self.token)
+            await arun_in(state, db._db_ctx.cleanup)
+
+
+def aconnection():
+    return _AsyncConnectionCtx()
+
+
+class _AsyncTransactionCtx(object):
+    # async with atransaction(): 最外层退出时提交，出现异常时回滚，嵌套时使用 savepoint
+    async def __aenter__(self):
+        self.conn_ctx = _AsyncConnectionCtx()
+        await self.conn_ctx.__aenter__()
+        self.transaction = db.transaction()
+        try:
+            await arun(self.transaction.__enter__)
+        except BaseException:
+            await self.conn_ctx.__aexit__(None, None, None)
+            raise
+        return self
+
+    async def __aexit__(self, exctype, excvalue, traceback):
+        try:
+            await arun(self.transaction.__exit__, exctype, excvalue, traceback)
+        finally:
+            await self.conn_ctx.__aexit__(exctype, excvalue, traceback)
+
+
+def atransaction():
+    return _AsyncTransactionCtx()
+
+
+# 先导入 mwebapp.adb 时，db 模块末尾的 from mwebapp.adb import ... 在本模块执行完之前进行，
+# 导入失败，在此补上 db.aselect 等接口
+for _name in ('arun', 'aselect', 'aselect_one', 'aselect_int', 'aselect_rows', 'aupdate', 'ainsert',
+              'ainsert_many', 'aupdate_many', 'aconnection', 'atransaction', 'set_executor'):
+    setattr(db, _name, globals()[_name])
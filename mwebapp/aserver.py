@@ -0,0 +1,513 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+# asyncio 的 HTTP/1.1 服务及 ASGI 适配，需要 python 3.7+
+# 连接的读写在事件循环中完成，大量慢速客户端只占用协程而不占用线程；
+# 同步的请求处理在线程池中执行，async def 的处理函数在事件循环中执行
+import io
+import os
+import sys
+import signal
+import asyncio
+import inspect
+import functools
+import contextvars
+from email.utils import formatdate
+from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
+
+from mwebapp.webapp import ctx
+from mwebapp.environ import _RESPONSE_STATUSES
+
+# 请求头的最大长度
+MAX_HEADER_SIZE = 64 * 1024
+
+
+class ASGIAdapter(object):
+    # 将 WSGIApplication 包装为 ASGI 应用
+    def __init__(self, app, threads=None):
+        self.app = app
+        self.executor = ThreadPoolExecutor(threads or 32, thread_name_prefix='mwebapp-worker')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported scope type: %s' % scope['type'])
+        body = await self._read_body(receive)
+        environ = self._environ(scope, body)
+        loop = asyncio.get_event_loop()
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        if self.app.is_async(environ):
+            # async def 的处理函数直接在事件循环中执行，等待期间不占用线程
+            result = await self._application(environ, start_response)
+            context = contextvars.copy_context()
+        else:
+            # 同一请求的处理及响应体的迭代都在该 context 中执行
+            context = contextvars.copy_context()
+
+            def call():
+                ctx.loop = loop
+                return self.app.application(environ, start_response)
+
+            result = await loop.run_in_executor(self.executor, context.run, call)
+        status, headers = started
+        await send({
+            'type': 'http.response.start',
+            'status': int(status[:3]),
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+        })
+        if isinstance(result, list):
+            await send({'type': 'http.response.body', 'body': b''.join(result)})
+            return
+        # 生成器逐块在线程池中取出，边生成边发送
+        iterator = iter(result)
+        take = functools.partial(next, iterator, None)
+        try:
+            while True:
+                chunk = await loop.run_in_executor(self.executor, context.run, take)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            close = getattr(result, 'close', None)
+            if close is not None:
+                await loop.run_in_executor(self.executor, context.run, close)
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def _application(self, environ, start_response):
+        # 与 WSGIApplication.application 相同，中间件在事件循环中执行，处理函数返回的 coroutine
+        # 经中间件原样返回或由 webapp.then 包装后在这里等待
+        app = self.app
+        app._begin(environ, async_dispatch=True)
+        responce_html = []
+        try:
+            r = app.fn()
+            if inspect.isawaitable(r):
+                r = await r
+            responce_html = app._body(r, environ)
+        except Exception as e:
+            responce_html = app._error_body(e)
+        return app._finish(environ, start_response, None, responce_html)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks)
+
+    def _environ(self, scope, body):
+        # 由 ASGI scope 生成 WSGI environ
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('0.0.0.0', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            # WSGI 的 PATH_INFO 为 latin-1 解码的原始字节
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', ()):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'CONTENT_LENGTH':
+                key = 'HTTP_' + name
+                environ[key] = environ[key] + ',' + value if key in environ else value
+        return environ
+
+
+class _Request(object):
+    # 解析后的一个 HTTP 请求
+    __slots__ = ('method', 'target', 'version', 'headers', 'body', 'keep_alive')
+
+
+class _BadRequest(Exception):
+    def __init__(self, status):
+        super(_BadRequest, self).__init__(status)
+        self.status = status
+
+
+class HTTPServer(object):
+    # HTTP/1.1 服务，支持 keep-alive 及 pipelining (同一连接上的请求依次处理，按顺序响应)
+    # app: ASGI 应用  keepalive_timeout: 空闲连接保持的秒数
+    # max_body: 请求体的最大字节数  backlog: listen 队列长度
+    def __init__(self, app, host='127.0.0.1', port=9000, keepalive_timeout=5, max_body=16 * 1024 * 1024,
+                 backlog=1024, sock=None):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.keepalive_timeout = keepalive_timeout
+        self.max_body = max_body
+        self.backlog = backlog
+        self.sock = sock
+        self.server = None
+        self._lifespan = None
+        self._lifespan_queue = None
+        # 进行中的连接任务，及其中等待下一个请求的空闲连接
+        self._connections = set()
+        self._idle = set()
+        # 为 True 时处理完当前请求后关闭连接，见 shutdown
+        self.closing = False
+
+    async def start(self):
+        if self.sock is not None:
+            self.server = await asyncio.start_server(self.handle, sock=self.sock, limit=MAX_HEADER_SIZE,
+                                                     backlog=self.backlog)
+        else:
+            self.server = await asyncio.start_server(self.handle, self.host, self.port, limit=MAX_HEADER_SIZE,
+                                                     backlog=self.backlog)
+        await self._startup()
+        return self.server
+
+    async def _startup(self):
+        # 发送 lifespan.startup，应用不支持 lifespan 时忽略
+        queue = self._lifespan_queue = asyncio.Queue()
+        await queue.put({'type': 'lifespan.startup'})
+        done = asyncio.Event()
+
+        async def send(message):
+            done.set()
+
+        scope = {'type': 'lifespan', 'asgi': {'version': '3.0'}}
+        # 保留引用，lifespan 任务在服务期间一直等待 shutdown
+        task = self._lifespan = asyncio.ensure_future(self.app(scope, queue.get, send))
+        waiter = asyncio.ensure_future(done.wait())
+        await asyncio.wait([task, waiter], return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+        if task.done() and not task.cancelled():
+            task.exception()
+
+    async def serve_forever(self):
+        server = await self.start()
+        async with server:
+            await server.serve_forever()
+
+    async def shutdown(self, timeout=None):
+        # 不再接受新连接，关闭空闲连接，等待进行中的请求完成，超时后取消
+        self.closing = True
+        self.server.close()
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        # 已 accept 的连接在之后的事件循环中才开始处理
+        await asyncio.sleep(0)
+        while self._connections:
+            for task in list(self._idle):
+                task.cancel()
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                for task in list(self._connections):
+                    task.cancel()
+                await asyncio.wait(list(self._connections))
+                break
+            await asyncio.wait(list(self._connections), timeout=remaining)
+        await self.server.wait_closed()
+        await self._shutdown_lifespan()
+
+    async def _shutdown_lifespan(self):
+        # 请求处理完后发送 lifespan.shutdown，等待应用清理，应用不响应时 5 秒后取消
+        task = self._lifespan
+        if task is None or task.done():
+            return
+        await self._lifespan_queue.put({'type': 'lifespan.shutdown'})
+        await asyncio.wait([task], timeout=5)
+        if not task.done():
+            task.cancel()
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        client = tuple(peer[:2]) if isinstance(peer, tuple) else None
+        task = asyncio.current_task()
+        self._connections.add(task)
+        served = False
+        try:
+            # 关闭服务时新连接的第一个请求仍然处理
+            while not (self.closing and served):
+                if served:
+                    # 新连接的第一个请求可能已在路上，关闭服务时只关闭处理过请求的空闲连接
+                    self._idle.add(task)
+                try:
+                    request = await self._read_request(reader, writer)
+                except _BadRequest as e:
+                    await self._write_error(writer, e.status)
+                    break
+                finally:
+                    self._idle.discard(task)
+                if request is None:
+                    break
+                keep_alive = await self._respond(request, reader, writer, client)
+                served = True
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            self._idle.discard(task)
+            writer.close()
+
+    async def _read_request(self, reader, writer):
+        # 返回 _Request，连接关闭或空闲超时时返回 None
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keepalive_timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            return None
+        except asyncio.LimitOverrunError:
+            raise _BadRequest('431 Request Header Fields Too Large')
+        # 已收到请求，关闭服务时等待其处理完成
+        self._idle.discard(asyncio.current_task())
+        lines = head[:-4].split(b'\r\n')
+        parts = lines[0].split(b' ')
+        if len(parts) != 3 or not parts[2].startswith(b'HTTP/1.'):
+            raise _BadRequest('400 Bad Request')
+        request = _Request()
+        request.method = parts[0].decode('latin-1')
+        request.target = parts[1]
+        request.version = parts[2].decode('latin-1')[5:]
+        headers = []
+        for line in lines[1:]:
+            name, sep, value = line.partition(b':')
+            if not sep:
+                raise _BadRequest('400 Bad Request')
+            headers.append((name.strip().lower(), value.strip()))
+        request.headers = headers
+        connection = self._header(headers, b'connection').lower()
+        if request.version == '1.1':
+            request.keep_alive = b'close' not in connection
+        else:
+            request.keep_alive = b'keep-alive' in connection
+        if self._header(headers, b'expect').lower() == b'100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        request.body = await self._read_body(reader, headers)
+        return request
+
+    def _header(self, headers, name):
+        for key, value in headers:
+            if key == name:
+                return value
+        return b''
+
+    async def _read_body(self, reader, headers):
+        try:
+            if b'chunked' in self._header(headers, b'transfer-encoding').lower():
+                chunks = []
+                size = 0
+                while True:
+                    line = await reader.readuntil(b'\r\n')
+                    length = int(line.split(b';')[0], 16)
+                    if length == 0:
+                        # 忽略 trailer
+                        while (await reader.readuntil(b'\r\n')) != b'\r\n':
+                            pass
+                        break
+                    size += length
+                    if size > self.max_body:
+                        raise _BadRequest('413 Request Entity Too Large')
+                    chunks.append(await reader.readexactly(length))
+                    await reader.readexactly(2)
+                return b''.join(chunks)
+            length = self._header(headers, b'content-length')
+            if not length:
+                return b''
+            length = int(length)
+        except ValueError:
+            raise _BadRequest('400 Bad Request')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            raise _BadRequest('400 Bad Request')
+        if length > self.max_body:
+            raise _BadRequest('413 Request Entity Too Large')
+        try:
+            return await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise _BadRequest('400 Bad Request')
+
+    async def _respond(self, request, reader, writer, client):
+        # 调用 ASGI 应用并写出响应，返回是否保持连接
+        path, _, query = request.target.partition(b'?')
+        sockname = writer.get_extra_info('sockname')
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': request.version,
+            'method': request.method,
+            'scheme': 'http',
+            'path': unquote(path.decode('latin-1')),
+            'raw_path': path,
+            'query_string': query,
+            'root_path': '',
+            'headers': request.headers,
+            'client': client,
+            'server': tuple(sockname[:2]) if isinstance(sockname, tuple) else None,
+        }
+        received = []
+        disconnected = asyncio.Event()
+
+        async def receive():
+            if not received:
+                received.append(True)
+                return {'type': 'http.request', 'body': request.body, 'more_body': False}
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        state = dict(start=None, head_sent=False, chunked=False, keep_alive=request.keep_alive, done=False)
+        head_only = request.method == 'HEAD'
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                state['start'] = message
+                return
+            if message['type'] != 'http.response.body' or state['done']:
+                return
+            body = message.get('body', b'')
+            more = message.get('more_body', False)
+            if not state['head_sent']:
+                writer.write(self._head(request, state, body, more, head_only))
+                state['head_sent'] = True
+            if head_only or not body and more:
+                pass
+            elif state['chunked']:
+                if body:
+                    writer.write(b'%x\r\n%s\r\n' % (len(body), body))
+            else:
+                writer.write(body)
+            if not more:
+                state['done'] = True
+                if state['chunked'] and not head_only:
+                    writer.write(b'0\r\n\r\n')
+            # 等待写缓冲区排空，慢速客户端不会占用过多内存
+            await writer.drain()
+
+        try:
+            await self.app(scope, receive, send)
+        except Exception:
+            if not state['head_sent']:
+                await self._write_error(writer, '500 Internal Server Error')
+            return False
+        finally:
+            disconnected.set()
+        if not state['done']:
+            # 应用未正常结束响应，无法确定响应体边界
+            return False
+        return state['keep_alive']
+
+    def _head(self, request, state, body, more, head_only):
+        # 状态行及响应头，决定响应体的分帧方式
+        start = state['start']
+        status = start['status']
+        headers = list(start.get('headers', ()))
+        names = set(name.lower() for name, value in headers)
+        if status in (204, 304) or status < 200:
+            pass
+        elif b'content-length' in names:
+            pass
+        elif not more and not head_only:
+            # 只有一块响应体，直接设置 Content-Length
+            headers.append((b'content-length', str(len(body)).encode('latin-1')))
+        elif head_only:
+            pass
+        elif request.version == '1.1':
+            headers.append((b'transfer-encoding', b'chunked'))
+            state['chunked'] = True
+        else:
+            # HTTP/1.0 以关闭连接标识响应结束
+            state['keep_alive'] = False
+        if b'date' not in names:
+            headers.append((b'date', formatdate(usegmt=True).encode('latin-1')))
+        if self.closing:
+            state['keep_alive'] = False
+        if not state['keep_alive']:
+            headers.append((b'connection', b'close'))
+        elif request.version != '1.1':
+            headers.append((b'connection', b'keep-alive'))
+        lines = [b'HTTP/1.1 %d %s' % (status, _reason(status))]
+        lines.extend(name + b': ' + value for name, value in headers)
+        return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+    async def _write_error(self, writer, status):
+        body = ('<html><body><h1>%s</h1></body></html>' % status).encode('latin-1')
+        writer.write(('HTTP/1.1 %s\r\nContent-Type: text/html\r\nContent-Length: %d\r\n'
+                      'Connection: close\r\n\r\n' % (status, len(body))).encode('latin-1') + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+def _reason(status):
+    return _RESPONSE_STATUSES.get(status, '').encode('latin-1')
+
+
+def serve(app, host='127.0.0.1', port=9000, **kw):
+    # 运行 HTTP 服务直到中断，app 为 ASGI 应用
+    server = HTTPServer(app, host, port, **kw)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+def serve_worker(app, sock, limit=0, master_pid=None, threads=None, graceful_timeout=30, **kw):
+    # prefork 的工作进程，见 mwebapp.server
+    # 使用已创建的监听 socket，处理 limit 个请求、收到 SIGTERM 或主进程退出后停止
+    # 停止时等待进行中的请求完成，最多 graceful_timeout 秒
+    adapter = ASGIAdapter(app, threads)
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        stop = asyncio.Event()
+        count = [0]
+
+        async def counted(scope, receive, send):
+            if scope['type'] == 'http':
+                count[0] += 1
+                if limit and count[0] >= limit:
+                    stop.set()
+            await adapter(scope, receive, send)
+
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+        server = HTTPServer(counted, sock=sock, **kw)
+        await server.start()
+        while not stop.is_set():
+            if master_pid is not None and os.getppid() != master_pid:
+                break
+            try:
+                await asyncio.wait_for(stop.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+        await server.shutdown(graceful_timeout)
+
+    asyncio.run(main())
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+import re
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    # 线程安全的 LRU 缓存
+    # maxsize: 最多保存的条目数  ttl: 过期秒数，None 为不过期
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > time.time():
+                    # 移到末尾
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry is not None and (entry[0] is None or entry[0] > time.time())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self._entries), maxsize=self.maxsize)
+
+
+class CacheBackend(object):
+    # 查询缓存后端接口，跨进程共享时各进程使用同一个后端存储
+    # 表版本号用于失效: 写入某表后版本号加一，旧版本的缓存不再被读到
+
+    def get(self, key):
+        # 返回缓存的值，不存在或已过期时返回 None
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def get_versions(self, tables):
+        # 返回各表当前的版本号列表
+        raise NotImplementedError
+
+    def incr_versions(self, tables):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    # 进程内的缓存后端
+    def __init__(self, maxsize=10000):
+        self._cache = LRUCache(maxsize)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, ttl):
+        self._cache.set(key, value, ttl)
+
+    def get_versions(self, tables):
+        versions = self._versions
+        return [versions.get(table, 0) for table in tables]
+
+    def incr_versions(self, tables):
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+    def clear(self):
+        self._cache.clear()
+
+
+class SqliteBackend(CacheBackend):
+    # 基于 sqlite 文件的缓存后端，同一台机器上的多个进程可共享
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._sets = 0
+        conn = self._connection()
+        conn.execute('create table if not exists query_cache '
+                     '(key text primary key, value blob, expires real)')
+        conn.execute('create table if not exists table_versions '
+                     '(name text primary key, version integer)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('pragma journal_mode=wal')
+            conn.execute('pragma synchronous=normal')
+            self._local.conn = conn
+        return conn
+
+    def after_fork(self):
+        # sqlite 连接不能在 fork 后继续使用
+        self._local = threading.local()
+
+    def get(self, key):
+        row = self._connection().execute(
+            'select value, expires from query_cache where key=?', (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return pickle.loads(bytes(row[0]))
+
+    def set(self, key, value, ttl):
+        conn = self._connection()
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        conn.execute('insert or replace into query_cache (key, value, expires) values (?, ?, ?)',
+                     (key, sqlite3.Binary(data), time.time() + ttl))
+        self._sets += 1
+        if self._sets % 1000 == 0:
+            # 定期清理过期的缓存
+            conn.execute('delete from query_cache where expires<?', (time.time(),))
+
+    def get_versions(self, tables):
+        if not tables:
+            return []
+        rows = self._connection().execute(
+            'select name, version from table_versions where name in (%s)' % ','.join('?' * len(tables)),
+            list(tables)).fetchall()
+        versions = dict(rows)
+        return [versions.get(table, 0) for table in tables]
+
+    def incr_versions(self, tables):
+        conn = self._connection()
+        for table in tables:
+            conn.execute('insert or ignore into table_versions (name, version) values (?, 0)', (table,))
+            conn.execute('update table_versions set version=version+1 where name=?', (table,))
+
+    def clear(self):
+        self._connection().execute('delete from query_cache')
+
+
+_re_tables = re.compile(r'\b(?:join|into|table)\s+(?:`?\w+`?\.)?`?(\w+)`?', re.I)
+
+# from/update 子句，其后以逗号分隔的表如 from a, b t, (select ...) c
+_re_table_list = re.compile(r'\b(?:from|update)\b', re.I)
+_re_string = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_re_token = re.compile(r"`[^`]*`|'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|\w+|\S")
+# 结束 from/update 子句的关键字
+_CLAUSE_END = frozenset(['where', 'group', 'order', 'limit', 'having', 'union', 'for', 'lock', 'window',
+                         'set', 'select', 'values', 'into', 'returning'])
+
+
+def _list_tables(sql, pos):
+    # 子句中每个逗号分隔项的第一个表名，join 的表由 _re_tables 匹配
+    # 括号内的子查询跳过，其中的表由子查询自身的 from 匹配
+    names = []
+    depth = 0
+    expect = True
+    # 上一个 token 是刚取出的表名，qualified: 表名后跟着 .
+    after_name = qualified = False
+    for m in _re_token.finditer(sql, pos):
+        token = m.group()
+        if token == '.' and after_name:
+            # db.table 取 table
+            qualified = True
+            after_name = False
+            continue
+        after_name = False
+        if token == '(':
+            depth += 1
+            expect = False
+            continue
+        if token == ')':
+            if not depth:
+                break
+            depth -= 1
+            continue
+        if depth:
+            continue
+        if token == ';':
+            break
+        if token == ',':
+            expect = True
+            continue
+        if token.lower() in _CLAUSE_END:
+            break
+        if expect or qualified:
+            name = token.strip('`')
+            if qualified:
+                names[-1] = name
+            else:
+                names.append(name)
+            expect = qualified = False
+            after_name = True
+    return names
+
+
+def sql_tables(sql):
+    # sql 中涉及的表名，字符串中的内容不参与匹配
+    sql = _re_string.sub("''", sql)
+    names = _re_tables.findall(sql)
+    for m in _re_table_list.finditer(sql):
+        names.extend(_list_tables(sql, m.end()))
+    return sorted(set(name.lower() for name in names))
+
+
+class QueryCache(object):
+    # 查询结果缓存，以规范化的 sql、参数及相关表的版本号为键
+    # 写入某表后该表的版本号加一，包含该表的查询缓存随之失效
+    def __init__(self, backend=None, default_ttl=60):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, sql, args):
+        normalized = ' '.join(sql.split())
+        tables = sql_tables(normalized)
+        versions = self.backend.get_versions(tables)
+        raw = repr((normalized, tuple(args), list(zip(tables, versions))))
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def get(self, sql, args):
+        key = self._key(sql, args)
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return key, value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None or ttl is True:
+            ttl = self.default_ttl
+        self.backend.set(key, value, ttl)
+
+    def invalidate(self, sql):
+        tables = sql_tables(sql)
+        if tables:
+            self.backend.incr_versions(tables)
+        return tables
+
+    def invalidate_tables(self, tables):
+        if tables:
+            self.backend.incr_versions(sorted(tables))
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses)
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 # __author__ = 'MingLei Ji'
+import sys
+import time
 import functools
+import itertools
 import threading
+from collections import namedtuple, OrderedDict
 
 from mwebapp.environ import Dict
+from mwebapp.drivers import get_driver
 
 
 class DBError(Exception):
@@ -14,17 +19,212 @@ class MultiColumnsError(DBError):
     pass
 
 
-class _LasyConnection(object):
-    def __init__(self, connect):
+class PoolTimeoutError(DBError):
+    pass
+
+
+# 每个连接最多缓存的预处理语句数
+MAX_STATEMENTS = 64
+
+
+class _PooledConnection(object):
+    # 连接池中的一个连接及其使用信息
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = time.time()
+        self.last_used = self.created
+        self.thread_id = None
+        # 服务端预处理语句 {sql: prepared cursor}
+        self.statements = OrderedDict()
+
+    def prepared_cursor(self, sql):
+        # 同一条语句复用同一个 prepared cursor，只在服务端 prepare 一次
+        cursor = self.statements.pop(sql, None)
+        if cursor is None:
+            # mysql.connector 没有同时 buffered 和 prepared 的游标，连接默认 buffered，需显式关闭
+            cursor = self.connection.cursor(prepared=True, buffered=False)
+            while len(self.statements) >= MAX_STATEMENTS:
+                self.statements.popitem(last=False)[1].close()
+        self.statements[sql] = cursor
+        return cursor
+
+    def drop_statement(self, sql):
+        cursor = self.statements.pop(sql, None)
+        if cursor is not None:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+
+class ConnectionPool(object):
+    # 线程安全的连接池
+    # min_size: 保持的最少连接数  max_size: 最多连接数
+    # timeout: 等待空闲连接的秒数  recycle: 空闲超过该秒数的连接关闭重建
+    # ping: 取出连接时检查连接是否可用  ping_func: 检查连接的函数，默认调用 connection.ping()
+    def __init__(self, connect, min_size=0, max_size=10, timeout=30, recycle=3600, ping=True, ping_func=None):
+        if max_size < 1 or min_size > max_size:
+            raise ValueError('Bad pool size: min_size=%s, max_size=%s' % (min_size, max_size))
         self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping = ping
+        self._ping_func = ping_func
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._stats = dict(checkouts=0, thread_hits=0, waits=0, timeouts=0,
+                           created=0, closed=0, ping_failures=0)
+        for i in range(min_size):
+            self._size += 1
+            self._idle.append(self._open())
+
+    def _count(self, name):
+        # 不持有锁时更新计数
+        with self._cond:
+            self._stats[name] += 1
+
+    def _open(self):
+        connection = _PooledConnection(self._connect())
+        self._count('created')
+        return connection
+
+    def _close(self, pooled):
+        self._count('closed')
+        try:
+            pooled.connection.close()
+        except Exception:
+            pass
+
+    def _take_idle(self, thread_id):
+        # 优先取当前线程上次使用的连接，否则取最近归还的连接
+        for i in range(len(self._idle) - 1, -1, -1):
+            if self._idle[i].thread_id == thread_id:
+                self._stats['thread_hits'] += 1
+                return self._idle.pop(i)
+        return self._idle.pop()
+
+    def acquire(self):
+        thread_id = threading.current_thread().ident
+        deadline = None
+        with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                if deadline is None:
+                    deadline = time.time() + self.timeout
+                    self._stats['waits'] += 1
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeoutError('Timed out waiting for a connection (max_size=%s).' % self.max_size)
+                self._cond.wait(remaining)
+            self._stats['checkouts'] += 1
+            if self._idle:
+                pooled = self._take_idle(thread_id)
+            else:
+                pooled = None
+                self._size += 1
+        try:
+            if pooled is not None:
+                pooled = self._check(pooled)
+            if pooled is None:
+                pooled = self._open()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        pooled.thread_id = thread_id
+        return pooled
+
+    def _check(self, pooled):
+        # 空闲过久或 ping 失败的连接关闭，返回 None 表示需要新建
+        if self.recycle is not None and time.time() - pooled.last_used > self.recycle:
+            self._close(pooled)
+            return None
+        if self.ping:
+            try:
+                if self._ping_func is not None:
+                    self._ping_func(pooled.connection)
+                else:
+                    pooled.connection.ping()
+            except Exception:
+                self._count('ping_failures')
+                self._close(pooled)
+                return None
+        return pooled
+
+    def release(self, pooled):
+        # 归还前回滚未提交的事务，避免下次使用时看到旧的快照
+        try:
+            pooled.connection.rollback()
+        except Exception:
+            self.discard(pooled)
+            return
+        pooled.last_used = time.time()
+        with self._cond:
+            self._idle.append(pooled)
+            self._cond.notify()
+
+    def discard(self, pooled):
+        # 关闭出错的连接，不再放回池中
+        self._close(pooled)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def after_fork(self):
+        # 子进程中丢弃从父进程继承的连接，不关闭，避免影响父进程中的同一连接
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = []
+        self._size = 0
+        for i in range(self.min_size):
+            self._size += 1
+            self._idle.append(self._open())
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for pooled in idle:
+            self._close(pooled)
+
+    @property
+    def in_use(self):
+        return self._size - len(self._idle)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(size=self._size, idle=len(self._idle), in_use=self._size - len(self._idle),
+                         min_size=self.min_size, max_size=self.max_size)
+        return stats
+
+
+class _LasyConnection(object):
+    def __init__(self, pool):
+        self._pool = pool
+        self._pooled = None
         self.connection = None
 
-    def cursor(self):
+    def _connect(self):
         if self.connection is None:
-            connection = self._connect()
-            self.connection = connection
+            self._pooled = self._pool.acquire()
+            self.connection = self._pooled.connection
+
+    def cursor(self):
+        self._connect()
         return self.connection.cursor()
 
+    def prepared_cursor(self, sql):
+        self._connect()
+        return self._pooled.prepared_cursor(sql)
+
+    def drop_statement(self, sql):
+        if self._pooled is not None:
+            self._pooled.drop_statement(sql)
+
     def commit(self):
         self.connection.commit()
 
@@ -33,46 +233,165 @@ class _LasyConnection(object):
 
     def cleanup(self):
         if self.connection:
-            connection = self.connection
+            pooled = self._pooled
             self.connection = None
-            connection.close()
+            self._pooled = None
+            self._pool.release(pooled)
 
 
 class _DbCtx(threading.local):
     def __init__(self):
         self.connection = None
+        # 当前事务的嵌套层数
+        self.transactions = 0
+        # 连接作用域内的 identity map {(table, pk): model}，见 orm.Model.get
+        self.identity_map = None
+        # 事务内写入过的表，提交后使其查询缓存失效
+        self.written_tables = set()
+        # 事务提交后调用的函数，见 after_commit
+        self.commit_callbacks = []
 
     def is_init(self):
         return not self.connection is None
 
-    def init(self, connect):
-        self.connection = _LasyConnection(connect)
+    def init(self, engine):
+        self.connection = _LasyConnection(engine.pool)
+        self.identity_map = {}
+        self.engine = engine
+        # 只读从库的连接，第一次读时选定从库
+        self.replica = None
+        # 为 True 时读操作也使用主库
+        self.pinned = False
 
     def cleanup(self):
         self.connection.cleanup()
         self.connection = None
+        self.identity_map = None
+        if self.replica is not None:
+            self.replica.cleanup()
+            self.replica = None
 
     def cursor(self):
         return self.connection.cursor()
 
+    def prepared_cursor(self, sql):
+        return self.connection.prepared_cursor(sql)
 
-_db_ctx = _DbCtx()
+    def read_connection(self):
+        # 读操作使用的连接: 事务内、已固定主库或没有从库时使用主库
+        if self.transactions or self.pinned or not self.engine.replica_pools:
+            return self.connection
+        if self.replica is None:
+            self.replica = _LasyConnection(self.engine.read_pool())
+        return self.replica
 
-connect = None
 
-def create_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
-    if _db_ctx.is_init():
+_db_ctx = _DbCtx()
+
+engine = None
+
+
+class _Engine(object):
+    # connect: 主库连接函数  replica_connects: 各从库的连接函数
+    # balance: 从库选择方式 'round_robin' 或 'least_connections'
+    # read_your_writes: 写入后本次连接作用域内的读操作也使用主库
+    # driver: mwebapp.drivers.Driver
+    def __init__(self, connect, prepared=False, replica_connects=(), balance='round_robin',
+                 read_your_writes=False, driver=None, **pool_kw):
+        if balance not in ('round_robin', 'least_connections'):
+            raise ValueError('Bad balance: %s' % balance)
+        self.connect = connect
+        self.driver = get_driver(driver or 'mysql.connector')
+        # 是否使用服务端预处理语句
+        self.prepared = prepared
+        pool_kw.setdefault('ping_func', self.driver.ping)
+        self.pool = ConnectionPool(connect, **pool_kw)
+        self.replica_pools = [ConnectionPool(c, **pool_kw) for c in replica_connects]
+        self.balance = balance
+        self.read_your_writes = read_your_writes
+        self._counter = itertools.count()
+
+    def read_pool(self):
+        pools = self.replica_pools
+        if self.balance == 'least_connections':
+            return min(pools, key=lambda pool: pool.in_use)
+        return pools[next(self._counter) % len(pools)]
+
+
+# create_engine 中连接池的参数
+_POOL_OPTIONS = dict(pool_min_size='min_size', pool_max_size='max_size', pool_timeout='timeout',
+                     pool_recycle='recycle', pool_ping='ping')
+
+
+def _replica_params(params, replica):
+    # 从库可写为 'host'、'host:port' 或参数 dict，未指定的参数与主库相同
+    replica_params = dict(params)
+    if isinstance(replica, dict):
+        replica_params.update(replica)
+    else:
+        host, _, port = replica.partition(':')
+        replica_params['host'] = host
+        if port:
+            replica_params['port'] = int(port)
+    return replica_params
+
+
+def create_engine(user=None, password=None, database=None, host='127.0.0.1', port=3306, **kw):
+    # driver='mysql.connector'、'pymysql'、'mysqlclient' 或 'sqlite3'，见 mwebapp.drivers
+    # sqlite3 只需要 database (文件路径)
+    # replicas=['10.0.0.2', {'host': '10.0.0.3', 'port': 3307}] 只读从库
+    # balance='round_robin' 或 'least_connections'
+    # read_your_writes=True 写入后当前请求的读操作固定使用主库
+    global engine
+    if engine is not None:
         raise DBError('Engine is already initialized.')
-    import mysql.connector
-    params = dict(user=user, password=password, database=database, host=host, port=port)
-    defaults = dict(use_unicode=True, charset='utf8', collation='utf8_general_ci', autocommit=False)
-    for k, v in defaults.items():
-        params[k] = kw.pop(k, v)
-    params.update(kw)
-    params['buffered'] = True
-    global connect
-    connect = lambda: mysql.connector.connect(**params)
-    _db_ctx.init(connect)
+    driver = get_driver(kw.pop('driver', 'mysql.connector'))
+    pool_kw = {}
+    for k, v in _POOL_OPTIONS.items():
+        if k in kw:
+            pool_kw[v] = kw.pop(k)
+    prepared = kw.pop('prepared', False)
+    if prepared and not driver.prepared:
+        raise DBError('Driver %s does not support prepared statements.' % driver.name)
+    replicas = kw.pop('replicas', ())
+    balance = kw.pop('balance', 'round_robin')
+    read_your_writes = kw.pop('read_your_writes', False)
+    params = driver.params(user, password, database, host, port, kw)
+    for k, v in driver.pool_defaults(params).items():
+        pool_kw.setdefault(k, v)
+    replica_connects = [
+        functools.partial(driver.connect, _replica_params(params, replica))
+        for replica in replicas
+    ]
+    engine = _Engine(functools.partial(driver.connect, params), prepared,
+                     replica_connects, balance, read_your_writes, driver, **pool_kw)
+
+
+def pin_primary():
+    # 当前连接作用域（请求）内的读操作改用主库
+    if _db_ctx.is_init():
+        _db_ctx.pinned = True
+
+
+def after_fork():
+    # fork 出的子进程中调用，子进程重新建立数据库连接
+    if engine is not None:
+        for pool in [engine.pool] + engine.replica_pools:
+            pool.after_fork()
+    if query_cache is not None:
+        after = getattr(query_cache.backend, 'after_fork', None)
+        if after is not None:
+            after()
+
+
+def pool_stats():
+    # 连接池使用情况，用于调整连接池大小
+    if engine is None:
+        raise DBError('Engine is not initialized.')
+    stats = engine.pool.stats()
+    if engine.replica_pools:
+        stats['replicas'] = [pool.stats() for pool in engine.replica_pools]
+    return stats
 
 
 class ConnectionCtx(object):
@@ -80,7 +399,9 @@ class ConnectionCtx(object):
         global _db_ctx
         self.should_cleanup = False
         if not _db_ctx.is_init():
-            _db_ctx.init(connect)
+            if engine is None:
+                raise DBError('Engine is not initialized.')
+            _db_ctx.init(engine)
             self.should_cleanup = True
         return self
 
@@ -90,6 +411,29 @@ class ConnectionCtx(object):
             _db_ctx.cleanup()
 
 
+class _DetachedCtx(object):
+    # 从当前线程取出的连接作用域，当前线程恢复为未建立连接的状态
+    # 由 run 在任意线程中换入继续使用，见 webapp 的流式响应体
+    def __init__(self):
+        local = vars(_db_ctx)
+        self.values = dict(local)
+        local.clear()
+        # 新建的 _DbCtx 在当前线程的属性即初始状态
+        local.update(vars(_DbCtx()))
+
+    def run(self, func, *args):
+        local = vars(_db_ctx)
+        saved = dict(local)
+        local.clear()
+        local.update(self.values)
+        try:
+            return func(*args)
+        finally:
+            self.values = dict(local)
+            local.clear()
+            local.update(saved)
+
+
 def with_connection(func):
     @functools.wraps(func)
     def _wrapper(*args, **kw):
@@ -99,55 +443,321 @@ def with_connection(func):
     return _wrapper
 
 
-def _select(sql, first, *args):
+class _TransactionCtx(object):
+    # 事务 最外层退出时提交，出现异常时回滚
+    # 嵌套的事务使用 savepoint，只回滚到该层开始的位置
+    def __enter__(self):
+        self.conn_ctx = ConnectionCtx()
+        self.conn_ctx.__enter__()
+        _db_ctx.transactions += 1
+        self.savepoint = None
+        try:
+            if _db_ctx.transactions > 1:
+                savepoint = 'sp_%d' % _db_ctx.transactions
+                _execute('SAVEPOINT %s' % savepoint)
+                self.savepoint = savepoint
+            elif _db_ctx.engine.driver.begin:
+                _execute(_db_ctx.engine.driver.begin)
+        except Exception:
+            self._leave(*sys.exc_info())
+            raise
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        self._leave(exctype, excvalue, traceback)
+
+    def _leave(self, exctype, excvalue, traceback):
+        try:
+            if self.savepoint:
+                if exctype is None:
+                    _execute('RELEASE SAVEPOINT %s' % self.savepoint)
+                else:
+                    _execute('ROLLBACK TO SAVEPOINT %s' % self.savepoint)
+            elif _db_ctx.transactions == 1:
+                self._end(exctype is None)
+        finally:
+            _db_ctx.transactions -= 1
+            self.conn_ctx.__exit__(exctype, excvalue, traceback)
+
+    def _end(self, commit):
+        connection = _db_ctx.connection
+        written_tables, _db_ctx.written_tables = _db_ctx.written_tables, set()
+        callbacks, _db_ctx.commit_callbacks = _db_ctx.commit_callbacks, []
+        if connection.connection is None:
+            # 事务内没有执行过语句
+            return
+        if not commit:
+            connection.rollback()
+            return
+        try:
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            # 事务期间其他连接可能缓存了提交前的数据
+            if query_cache is not None:
+                query_cache.invalidate_tables(written_tables)
+            for callback in callbacks:
+                callback()
+
+    def __call__(self, func):
+        # 作为装饰器使用 @transaction()
+        return with_transaction(func)
+
+
+def transaction():
+    # with transaction(): 或 @transaction()
+    return _TransactionCtx()
+
+
+def after_commit(func):
+    # 当前事务提交后调用 func，不在事务中时直接调用
+    if _db_ctx.transactions:
+        _db_ctx.commit_callbacks.append(func)
+    else:
+        func()
+
+
+def with_transaction(func):
+    @functools.wraps(func)
+    def _wrapper(*args, **kw):
+        with _TransactionCtx():
+            return func(*args, **kw)
+
+    return _wrapper
+
+
+def _execute(sql):
     cursor = None
-    sql = sql.replace('?', '%s')
     try:
         cursor = _db_ctx.cursor()
+        cursor.execute(sql)
+    finally:
+        if cursor:
+            cursor.close()
+
+
+def dict_factory(names):
+    # 默认的行对象 Dict
+    return lambda values: Dict(names, values)
+
+
+# {字段名元组: Row 类}
+_row_classes = {}
+_MAX_ROW_CLASSES = 256
+
+
+def row_class(names):
+    # 按字段名生成基于 tuple 的行类，同一组字段只生成一次
+    names = tuple(names)
+    cls = _row_classes.get(names)
+    if cls is None:
+        if len(_row_classes) >= _MAX_ROW_CLASSES:
+            _row_classes.clear()
+        # rename=True: count(id) 等不合法的字段名改为 _0, _1 ...
+        cls = _row_classes[names] = namedtuple('Row', names, rename=True)
+    return cls
+
+
+def row_factory(names):
+    # 轻量的行对象，字段按下标或属性访问
+    return row_class(names)._make
+
+
+def _translate(sql):
+    # 将 ? 占位符转换为驱动使用的 paramstyle
+    return engine.driver.translate(sql)
+
+
+def _cursor(sql, read=False):
+    # 返回 (cursor, 是否为复用的 prepared cursor, 使用的连接)
+    # read=True 时可能使用从库
+    connection = _db_ctx.read_connection() if read else _db_ctx.connection
+    if engine.prepared:
+        return connection.prepared_cursor(sql), True, connection
+    return connection.cursor(), False, connection
+
+
+# 查询结果缓存，见 set_query_cache
+query_cache = None
+
+
+def set_query_cache(cache):
+    # cache 为 mwebapp.cache.QueryCache，None 关闭查询缓存
+    global query_cache
+    query_cache = cache
+
+
+def _select(sql, first, *args, **kw):
+    # factory(names) 返回由一行数据构造行对象的函数
+    # cache=秒数 时使用查询缓存，事务内不使用
+    # primary=True 时不使用从库
+    factory = kw.get('factory') or dict_factory
+    ttl = kw.get('cache')
+    if ttl and query_cache is not None and _db_ctx.transactions == 0:
+        return _cached_select(sql, first, args, factory, ttl)
+    cursor = None
+    prepared = False
+    sql = _translate(sql)
+    try:
+        cursor, prepared, connection = _cursor(sql, read=not kw.get('primary'))
         cursor.execute(sql, args)
         if cursor.description:
             names = [x[0] for x in cursor.description]
+        make = factory(names)
         if first:
             values = cursor.fetchone()
+            if prepared:
+                # prepared cursor 不缓冲结果，需读完剩余的行
+                cursor.fetchall()
             if not values:
                 return None
-            return Dict(names, values)
-        return [Dict(names, x) for x in cursor.fetchall()]
+            return make(values)
+        return [make(x) for x in cursor.fetchall()]
+    except Exception:
+        if prepared:
+            connection.drop_statement(sql)
+            prepared = False
+            cursor = None
+        raise
     finally:
-        if cursor:
+        if cursor and not prepared:
             cursor.close()
 
 
+def _cached_select(sql, first, args, factory, ttl):
+    # 缓存 (字段名, 各行的 tuple)，每次命中时重新构造行对象
+    # 未命中时从主库读取: 写入后表的版本号已更新，从库可能尚未同步，
+    # 从从库读到的旧数据会以新版本号缓存到过期为止
+    key, value = query_cache.get(sql, args)
+    if value is None:
+        value = _select(sql, False, *args, factory=lambda names: lambda values: (names, tuple(values)),
+                        primary=True)
+        names = value[0][0] if value else []
+        value = (names, [row[1] for row in value])
+        query_cache.set(key, value, ttl)
+    names, rows = value
+    make = factory(names)
+    if first:
+        return make(rows[0]) if rows else None
+    return [make(row) for row in rows]
+
+
+def _invalidate(sql):
+    # 写入后使相关表的查询缓存失效，事务提交时再失效一次
+    if query_cache is None:
+        return
+    tables = query_cache.invalidate(sql)
+    if _db_ctx.transactions:
+        _db_ctx.written_tables.update(tables)
+
+
 def _update(sql, *args):
     cursor = None
-    sql = sql.replace('?', '%s')
+    prepared = False
+    sql = _translate(sql)
     try:
-        cursor = _db_ctx.cursor()
+        cursor, prepared, connection = _cursor(sql)
         cursor.execute(sql, args)
         r = cursor.rowcount
-        _db_ctx.connection.commit()
+        # 事务内由最外层事务统一提交
+        if _db_ctx.transactions == 0:
+            _db_ctx.connection.commit()
+        _invalidate(sql)
+        if engine.read_your_writes:
+            _db_ctx.pinned = True
         return r
+    except Exception:
+        if prepared:
+            connection.drop_statement(sql)
+            prepared = False
+            cursor = None
+        raise
     finally:
-        if cursor:
+        if cursor and not prepared:
             cursor.close()
 
 
 @with_connection
-def select_one(sql, *args):
-    return _select(sql, True, *args)
+def select_one(sql, *args, **kw):
+    return _select(sql, True, *args, **kw)
 
 
 @with_connection
-def select_int(sql, *args):
-    d = _select(sql, True, *args)
-    if len(d) != 1:
+def select_int(sql, *args, **kw):
+    row = _select(sql, True, *args, factory=lambda names: tuple, cache=kw.get('cache'))
+    if len(row) != 1:
         raise MultiColumnsError('Expect only one column.')
-    return d.values()[0]
+    return row[0]
 
 
 @with_connection
-def select(sql, *args):
-    return _select(sql, False, *args)
+def select(sql, *args, **kw):
+    return _select(sql, False, *args, **kw)
+
+
+@with_connection
+def select_rows(sql, *args, **kw):
+    # 返回基于 tuple 的轻量行对象列表
+    return _select(sql, False, *args, factory=row_factory, cache=kw.get('cache'))
+
+
+def iter_select(sql, *args, **kw):
+    # 逐行返回查询结果，用于导出大表等场景，内存占用与结果集大小无关
+    # 使用非缓冲游标和 fetchmany(chunk)，生成器结束或关闭前独占一个连接。
+    # 该连接与当前请求/事务的连接相互独立，看不到事务内未提交的修改
+    chunk = kw.pop('chunk', 1000)
+    factory = kw.pop('factory', None) or dict_factory
+    if kw:
+        raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kw))
+    if engine is None:
+        raise DBError('Engine is not initialized.')
+    # 与 select 相同，事务外可使用从库
+    if engine.replica_pools and not (_db_ctx.is_init() and (_db_ctx.transactions or _db_ctx.pinned)):
+        pool = engine.read_pool()
+    else:
+        pool = engine.pool
+    pooled = pool.acquire()
+    cursor = None
+    exhausted = False
+    try:
+        cursor = engine.driver.unbuffered_cursor(pooled.connection)
+        cursor.execute(_translate(sql), args)
+        make = factory([x[0] for x in cursor.description])
+        while True:
+            rows = cursor.fetchmany(chunk)
+            if not rows:
+                break
+            for row in rows:
+                yield make(row)
+        exhausted = True
+    finally:
+        try:
+            if cursor:
+                cursor.close()
+        except Exception:
+            exhausted = False
+        if exhausted:
+            pool.release(pooled)
+        else:
+            # 未读完的非缓冲结果集会使连接不可用，直接关闭
+            pool.discard(pooled)
+
+
+def _executemany(sql, rows):
+    # 同一语句执行多组参数，返回影响的行数
+    cursor = None
+    sql = _translate(sql)
+    try:
+        cursor = _db_ctx.cursor()
+        cursor.executemany(sql, rows)
+        r = cursor.rowcount
+        _invalidate(sql)
+        return r
+    finally:
+        if cursor:
+            cursor.close()
 
 
 @with_connection
@@ -163,6 +773,104 @@ def update(sql, *args):
     return _update(sql, *args)
 
 
+# 单条语句的大小上限，需小于 MySQL 的 max_allowed_packet
+MAX_PACKET = 1024 * 1024
+
+
+def _estimate_size(value):
+    # 估算参数在 SQL 中占用的字节数，转义后最多为原长度的两倍
+    # 字符串按 utf-8 编码后的字节数计算，中文等每个字符占 3 个字节
+    if isinstance(value, type(u'')):
+        value = value.encode('utf-8')
+    if isinstance(value, bytes):
+        return len(value) * 2 + 3
+    return 24
+
+
+def _chunk_rows(rows, batch_size, max_packet, base_size=0):
+    # 按行数和估算的语句大小分批
+    chunk = []
+    size = base_size
+    for row in rows:
+        row_size = sum(_estimate_size(v) for v in row) + len(row) * 2 + 3
+        if chunk and (len(chunk) >= batch_size or size + row_size > max_packet):
+            yield chunk
+            chunk = []
+            size = base_size
+        chunk.append(row)
+        size += row_size
+    if chunk:
+        yield chunk
+
+
+@with_connection
+def insert_many(table, rows, batch_size=1000, max_packet=MAX_PACKET):
+    # 批量插入 rows 为字段相同的 dict 列表
+    # 生成多行 insert into ... values (...),(...) 语句，在一个事务中提交
+    if not rows:
+        return 0
+    cols = list(rows[0].keys())
+    values = []
+    for row in rows:
+        if len(row) != len(cols):
+            raise DBError('All rows must have the same columns.')
+        values.append([row[col] for col in cols])
+    prefix = 'insert into `%s` (%s) values ' % (table, ','.join(['`%s`' % col for col in cols]))
+    placeholder = '(%s)' % ','.join(['?'] * len(cols))
+    count = 0
+    with transaction():
+        if not engine.driver.multirow:
+            # sqlite 等驱动使用 executemany
+            return _executemany(prefix + placeholder, values)
+        for chunk in _chunk_rows(values, batch_size, max_packet, len(prefix)):
+            sql = prefix + ','.join([placeholder] * len(chunk))
+            args = [v for row in chunk for v in row]
+            count += _update(sql, *args)
+    return count
+
+
+@with_connection
+def update_many(table, pk, rows, batch_size=500, max_packet=MAX_PACKET):
+    # 按主键 pk 批量更新 rows 为字段相同的 dict 列表，每行需包含主键
+    # 生成 update ... set `c`=case `pk` when ? then ? ... end where `pk` in (...)
+    if not rows:
+        return 0
+    cols = [col for col in rows[0].keys() if col != pk]
+    if not cols:
+        return 0
+    values = []
+    for row in rows:
+        if len(row) != len(cols) + 1:
+            raise DBError('All rows must have the same columns.')
+        values.append([row[pk]] + [row[col] for col in cols])
+    count = 0
+    with transaction():
+        if not engine.driver.multirow:
+            sql = 'update `%s` set %s where `%s`=?' % (table, ','.join(['`%s`=?' % col for col in cols]), pk)
+            return _executemany(sql, [row[1:] + row[:1] for row in values])
+        for chunk in _chunk_rows(values, batch_size, max_packet):
+            sets = []
+            args = []
+            for i, col in enumerate(cols, 1):
+                sets.append('`%s`=case `%s` %s end' % (col, pk, ' '.join(['when ? then ?'] * len(chunk))))
+                for row in chunk:
+                    args.append(row[0])
+                    args.append(row[i])
+            args.extend([row[0] for row in chunk])
+            sql = 'update `%s` set %s where `%s` in (%s)' % (
+                table, ','.join(sets), pk, ','.join(['?'] * len(chunk)))
+            count += _update(sql, *args)
+    return count
+
+
+try:
+    # asyncio 接口，python2 中不可用
+    from mwebapp.adb import (arun, aselect, aselect_one, aselect_int, aselect_rows, aupdate, ainsert,
+                             ainsert_many, aupdate_many, aconnection, atransaction, set_executor)
+except (ImportError, SyntaxError):
+    pass
+
+
 if __name__ == '__main__':
     create_engine('root', 'password', 'test')
     user_list = select('select * from user where id>?', 1000)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+# 数据库驱动，见 db.create_engine(driver=...)
+# sql 中统一使用 ? 占位符，由驱动转换为各自的 paramstyle
+
+
+class Driver(object):
+    # 驱动接口
+    # dialect: 生成表结构语句时使用的方言，见 orm._gen_sql
+    # prepared: 是否支持服务端预处理语句
+    # multirow: 批量写入使用多行 values 语句，否则使用 executemany
+    # begin: 开始事务的语句，None 为由驱动在第一条语句前自动开始
+    name = None
+    dialect = 'mysql'
+    prepared = False
+    multirow = True
+    begin = None
+    # 转换后的 sql 缓存 {sql: 转换后的 sql}
+    max_sql_cache = 1024
+
+    def __init__(self):
+        self._sql_cache = {}
+
+    def params(self, user, password, database, host, port, kw):
+        # 由 create_engine 的参数生成连接参数，kw 为其余的参数
+        raise NotImplementedError
+
+    def connect(self, params):
+        raise NotImplementedError
+
+    def pool_defaults(self, params):
+        # 该驱动默认的连接池参数
+        return {}
+
+    def _convert(self, sql):
+        # format 风格: ? 转换为 %s
+        return sql.replace('?', '%s')
+
+    def translate(self, sql):
+        translated = self._sql_cache.get(sql)
+        if translated is None:
+            if len(self._sql_cache) >= self.max_sql_cache:
+                self._sql_cache.clear()
+            translated = self._sql_cache[sql] = self._convert(sql)
+        return translated
+
+    def unbuffered_cursor(self, connection):
+        # 逐行读取结果的游标，见 db.iter_select
+        return connection.cursor()
+
+    def ping(self, connection):
+        # 连接不可用时抛出异常
+        connection.ping()
+
+
+class MySQLConnectorDriver(Driver):
+    # mysql-connector-python，纯 python 实现
+    name = 'mysql.connector'
+    prepared = True
+
+    def params(self, user, password, database, host, port, kw):
+        params = dict(user=user, password=password, database=database, host=host, port=int(port))
+        defaults = dict(use_unicode=True, charset='utf8', collation='utf8_general_ci', autocommit=False)
+        for k, v in defaults.items():
+            params[k] = kw.pop(k, v)
+        params.update(kw)
+        params['buffered'] = True
+        return params
+
+    def connect(self, params):
+        import mysql.connector
+        return mysql.connector.connect(**params)
+
+    def unbuffered_cursor(self, connection):
+        return connection.cursor(buffered=False)
+
+    def ping(self, connection):
+        connection.ping(reconnect=False)
+
+
+class PyMySQLDriver(Driver):
+    # PyMySQL
+    name = 'pymysql'
+
+    def params(self, user, password, database, host, port, kw):
+        params = dict(user=user, password=password, database=database, host=host, port=int(port))
+        defaults = dict(use_unicode=True, charset='utf8', autocommit=False)
+        for k, v in defaults.items():
+            params[k] = kw.pop(k, v)
+        params.update(kw)
+        return params
+
+    def connect(self, params):
+        import pymysql
+        return pymysql.connect(**params)
+
+    def _convert(self, sql):
+        # 有参数时驱动使用 sql % args，需转义 sql 中的 %
+        return sql.replace('%', '%%').replace('?', '%s')
+
+    def unbuffered_cursor(self, connection):
+        import pymysql.cursors
+        return connection.cursor(pymysql.cursors.SSCursor)
+
+    def ping(self, connection):
+        # 默认的 ping() 会自动重连，这里只检查连接
+        connection.ping(reconnect=False)
+
+
+class MySQLdbDriver(Driver):
+    # mysqlclient (MySQLdb)，基于 libmysqlclient 的 C 扩展
+    name = 'mysqlclient'
+
+    def params(self, user, password, database, host, port, kw):
+        params = dict(user=user, passwd=password, db=database, host=host, port=int(port))
+        defaults = dict(use_unicode=True, charset='utf8', autocommit=False)
+        for k, v in defaults.items():
+            params[k] = kw.pop(k, v)
+        params.update(kw)
+        return params
+
+    def connect(self, params):
+        import MySQLdb
+        return MySQLdb.connect(**params)
+
+    def _convert(self, sql):
+        return sql.replace('%', '%%').replace('?', '%s')
+
+    def unbuffered_cursor(self, connection):
+        import MySQLdb.cursors
+        return connection.cursor(MySQLdb.cursors.SSCursor)
+
+
+class SqliteDriver(Driver):
+    # 标准库 sqlite3，database 为数据库文件路径
+    # 文件数据库使用 WAL 模式，读写互不阻塞；连接池优先把线程上次使用的连接交给该线程，
+    # 每个线程基本固定使用自己的连接
+    name = 'sqlite3'
+    dialect = 'sqlite'
+    multirow = False
+    # sqlite3 模块只在 insert/update 等语句前自动开始事务，savepoint 会自行开始并在 release 时提交，
+    # 外层事务需显式 begin
+    begin = 'BEGIN'
+
+    def params(self, user, password, database, host, port, kw):
+        if not database:
+            raise ValueError('sqlite3 driver requires database (file path or :memory:).')
+        params = dict(database=database, timeout=kw.pop('timeout', 5))
+        # 连接由连接池在线程间复用，同一时间只有一个线程使用
+        params['check_same_thread'] = False
+        params.update(kw)
+        return params
+
+    def _is_memory(self, params):
+        database = params['database']
+        return database == ':memory:' or database.startswith('file::memory:')
+
+    def connect(self, params):
+        import sqlite3
+        connection = sqlite3.connect(**params)
+        if not self._is_memory(params):
+            connection.execute('pragma journal_mode=wal')
+            connection.execute('pragma synchronous=normal')
+        return connection
+
+    def pool_defaults(self, params):
+        # 内存数据库每个连接都是独立的库，只能使用一个连接
+        if self._is_memory(params):
+            return dict(min_size=0, max_size=1, recycle=None)
+        return {}
+
+    def _convert(self, sql):
+        # qmark 风格，无需转换
+        return sql
+
+    def ping(self, connection):
+        connection.execute('select 1')
+
+
+DRIVERS = {
+    'mysql.connector': MySQLConnectorDriver,
+    'pymysql': PyMySQLDriver,
+    'mysqlclient': MySQLdbDriver,
+    'MySQLdb': MySQLdbDriver,
+    'sqlite3': SqliteDriver,
+}
+
+
+def get_driver(driver):
+    # driver 为 DRIVERS 中的名字或 Driver 实例
+    if isinstance(driver, Driver):
+        return driver
+    try:
+        return DRIVERS[driver]()
+    except KeyError:
+        raise ValueError('Unknown driver: %s' % driver)
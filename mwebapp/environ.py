@@ -154,9 +154,7 @@ def _unquote(s, encoding='utf-8'):
 
 class Dict(dict):
     def __init__(self, names=(), values=(), **kw):
-        super(Dict, self).__init__(**kw)
-        for k, v in zip(names, values):
-            self[k] = v
+        super(Dict, self).__init__(zip(names, values), **kw)
 
     def __getattr__(self, key):
         try:
@@ -269,7 +267,7 @@ class Request(object):
             for k, v in self._environ.items():
                 if k.startswith('HTTP_'):
                     # convert 'HTTP_ACCEPT_ENCODING' to 'ACCEPT-ENCODING'
-                    hdrs[k[5:].replace('_', '-').upper()] = v.decode('utf-8')
+                    hdrs[k[5:].replace('_', '-').upper()] = _to_str(v)
             self._headers = hdrs
         return self._headers
 
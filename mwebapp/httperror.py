@@ -52,6 +52,12 @@ def notfound():
     raise HttpError(404)
 
 
+def methodnotallowed(allow):
+    e = HttpError(405)
+    e.header('Allow', allow)
+    raise e
+
+
 def conflict():
     raise HttpError(409)
 
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+# 内置中间件，在 settings 的 middleware 中配置:
+#     middleware = ('mwebapp.middleware.CompressionMiddleware',)
+# 处理响应体的中间件使用 then(self.app(), func)，async def 的处理函数结束后才调用 func
+import zlib
+
+from mwebapp.webapp import ctx, then, brotli, _compressible, _choose_encoding, _is_file_body, _iter_body
+from mwebapp.environ import _to_byte
+
+
+class _Compressor(object):
+    # 增量压缩，每次 compress 都输出已压缩的数据，流式响应的每块可以及时发送
+    def __init__(self, encoding, level, brotli_quality):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._brotli = brotli.Compressor(quality=brotli_quality)
+        else:
+            # gzip 格式 wbits 为 16+15，deflate 为 zlib 格式
+            wbits = 31 if encoding == 'gzip' else zlib.MAX_WBITS
+            self._zlib = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self._brotli.process(data) + self._brotli.flush()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._brotli.finish()
+        return self._zlib.flush()
+
+    def compress_all(self, data):
+        if self.encoding == 'br':
+            return self._brotli.process(data) + self._brotli.finish()
+        return self._zlib.compress(data) + self._zlib.flush()
+
+
+class CompressionMiddleware(object):
+    # 按 Accept-Encoding 压缩响应体，支持 gzip/deflate，安装了 brotli 时优先使用 br
+    # 不压缩: 小于 min_size 的响应、图片等已压缩的内容类型、已设置 Content-Encoding 的响应、
+    # 文件响应及支持 Range 的响应 (静态文件由 StaticMiddleware 输出预压缩文件)
+    # 生成器等流式响应逐块压缩，不设置 Content-Length
+    # 可继承后修改参数
+    min_size = 1024
+    level = 6
+    # 动态内容使用较低的 brotli 压缩等级，压缩速度与 gzip 6 相近
+    brotli_quality = 4
+    encodings = ('br', 'gzip', 'deflate') if brotli is not None else ('gzip', 'deflate')
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, *args, **kwargs):
+        return then(self.app(), self._compress)
+
+    def _compress(self, body):
+        response = ctx.response
+        if not self._compressible(body, response):
+            return body
+        if isinstance(body, (bytes, type(u''))):
+            body = _to_byte(body)
+            if len(body) < self.min_size:
+                return body
+        self._add_vary(response)
+        encoding = _choose_encoding(ctx.request.header('Accept-Encoding'), self.encodings)
+        if encoding is None:
+            return body
+        compressor = _Compressor(encoding, self.level, self.brotli_quality)
+        response.set_header('Content-Encoding', encoding)
+        etag = response.header('ETag')
+        if etag and not etag.startswith('W/'):
+            # 压缩后内容不同，强 ETag 改为弱 ETag
+            response.set_header('ETag', 'W/' + etag)
+        if isinstance(body, bytes):
+            body = compressor.compress_all(body)
+            response.content_length = len(body)
+            return body
+        response.unset_header('Content-Length')
+        return self._stream(body, compressor)
+
+    def _compressible(self, body, response):
+        if not body or response.status_code < 200 or response.status_code in (204, 206, 304):
+            return False
+        if response.header('Content-Encoding') or response.header('Accept-Ranges'):
+            return False
+        if 'no-transform' in (response.header('Cache-Control') or ''):
+            return False
+        if _is_file_body(body, ctx.request.environ):
+            return False
+        return _compressible(response.content_type)
+
+    def _add_vary(self, response):
+        vary = response.header('Vary')
+        if not vary:
+            response.set_header('Vary', 'Accept-Encoding')
+        elif vary.strip() != '*' and 'accept-encoding' not in [v.strip().lower() for v in vary.split(',')]:
+            response.set_header('Vary', vary + ', Accept-Encoding')
+
+    def _stream(self, body, compressor):
+        chunks = _iter_body(body)
+        try:
+            for chunk in chunks:
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+            yield compressor.finish()
+        finally:
+            chunks.close()
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 # __author__ = 'MingLei Ji'
 import time
+import functools
 
 from mwebapp import db
+from mwebapp.cache import LRUCache
 
 
 class Field(object):
@@ -95,15 +97,29 @@ class VersionField(Field):
 
 _triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
 
+# 每个 model 最多缓存的查询语句数
+_MAX_SQL_CACHE = 256
 
-def _gen_sql(table_name, mappings):
-    # 生成表结构语句
+
+# 各方言需要替换的字段类型
+_DIALECT_TYPES = {
+    'mysql': {},
+    # sqlite 中 integer 主键即 rowid，插入时自动生成
+    'sqlite': {'bigint': 'integer', 'bool': 'integer'},
+}
+
+
+def _gen_sql(table_name, mappings, dialect=None):
+    # 生成表结构语句，dialect 默认使用当前 engine 驱动的方言
+    if dialect is None:
+        dialect = db.engine.driver.dialect if db.engine is not None else 'mysql'
+    types = _DIALECT_TYPES[dialect]
     pk = None
     sql = ['-- generating SQL for %s:' % table_name, 'create table `%s` (' % table_name]
     for f in sorted(mappings.values(), key=lambda x: x._order):
         if not hasattr(f, 'ddl'):
             raise Exception('no ddl in field "%s".' % f)
-        ddl = f.ddl
+        ddl = types.get(f.ddl, f.ddl)
         nullable = f.nullable
         if f.primary_key:
             pk = f.name
@@ -151,7 +167,18 @@ class ModelMetaclass(type):
             attrs['__table__'] = name.lower()
         attrs['__mappings__'] = mappings
         attrs['__primary_key__'] = primary_key
-        attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings)
+        attrs['__sql__'] = lambda self, dialect=None: _gen_sql(attrs['__table__'], mappings, dialect)
+        # 拼接好的查询语句 {(columns, where): sql}
+        attrs['__sql_cache__'] = {}
+        # Model.get 的缓存，__identity_map__ = True 开启请求内的 identity map，
+        # __cache__ = {'maxsize': 1000, 'ttl': 60} 开启进程内的 LRU 缓存
+        # 未设置时继承基类的设置
+        if '__identity_map__' not in attrs and not any(hasattr(base, '__identity_map__') for base in bases):
+            attrs['__identity_map__'] = False
+        cache = attrs.get('__cache__')
+        if cache and not isinstance(cache, LRUCache):
+            attrs['__cache__'] = LRUCache(**cache) if isinstance(cache, dict) else LRUCache()
+        attrs['__cache_stats__'] = dict(identity_hits=0, cache_hits=0, misses=0)
         for trigger in _triggers:
             if not trigger in attrs:
                 attrs[trigger] = None
@@ -174,8 +201,10 @@ def with_metaclass(meta, *bases):
 
 class Model(with_metaclass(ModelMetaclass, dict)):
     # model 类 调用db模块 绑定sql方法
-    def __init__(self, **kw):
-        super(Model, self).__init__(**kw)
+    __identity_map__ = False
+    __cache__ = None
+    def __init__(self, *args, **kw):
+        super(Model, self).__init__(*args, **kw)
 
     def __getattr__(self, key):
         try:
@@ -187,39 +216,139 @@ class Model(with_metaclass(ModelMetaclass, dict)):
         self[key] = value
 
     @classmethod
-    def get(cls, pk):
-        d = db.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
-        return cls(**d) if d else None
+    def _factory(cls, names):
+        # 直接由一行数据构造 model，不经过中间的 Dict
+        return lambda values: cls(zip(names, values))
+
+    @classmethod
+    def _columns(cls, columns):
+        # 查询的字段，columns 为 None 时查询全部字段
+        if not columns:
+            return '*'
+        names = []
+        for column in columns:
+            field = cls.__mappings__.get(column)
+            if field is None:
+                raise ValueError('Unknown column %r for %s' % (column, cls.__name__))
+            names.append('`%s`' % field.name)
+        return ','.join(names)
+
+    @classmethod
+    def _select_sql(cls, columns, where=''):
+        # 同样的字段和条件只拼接一次 sql
+        key = (columns and tuple(columns), where)
+        sql = cls.__sql_cache__.get(key)
+        if sql is None:
+            if len(cls.__sql_cache__) >= _MAX_SQL_CACHE:
+                cls.__sql_cache__.clear()
+            sql = 'select %s from `%s` %s' % (cls._columns(columns), cls.__table__, where)
+            cls.__sql_cache__[key] = sql
+        return sql
+
+    @classmethod
+    def get(cls, pk, columns=None):
+        where = 'where `%s`=?' % cls.__primary_key__.name
+        if columns or not (cls.__identity_map__ or cls.__cache__ is not None):
+            return db.select_one(cls._select_sql(columns, where), pk, factory=cls._factory)
+        key = (cls.__table__, pk)
+        stats = cls.__cache_stats__
+        # 请求内的 identity map 返回同一个对象
+        identity_map = db._db_ctx.identity_map if cls.__identity_map__ else None
+        if identity_map is not None and key in identity_map:
+            stats['identity_hits'] += 1
+            return identity_map[key]
+        obj = None
+        # 事务内读到的可能是未提交的数据，不使用进程内的缓存
+        cache = cls.__cache__ if not db._db_ctx.transactions else None
+        if cache is not None:
+            d = cache.get(key)
+            if d is not None:
+                stats['cache_hits'] += 1
+                obj = cls(d)
+        if obj is None:
+            stats['misses'] += 1
+            obj = db.select_one(cls._select_sql(None, where), pk, factory=cls._factory)
+            if obj is None:
+                return None
+            if cache is not None:
+                # 缓存副本，避免修改返回的对象影响缓存
+                cache.set(key, dict(obj))
+        if identity_map is not None:
+            identity_map[key] = obj
+        return obj
+
+    @classmethod
+    def aget(cls, pk, columns=None):
+        # await Model.aget(pk)，在数据库线程池中执行 get，见 mwebapp.adb
+        return db.arun(cls.get, pk, columns)
+
+    @classmethod
+    def _invalidate(cls, pk):
+        # 写入后清除 get 的缓存
+        key = (cls.__table__, pk)
+        if cls.__identity_map__:
+            identity_map = db._db_ctx.identity_map
+            if identity_map is not None:
+                identity_map.pop(key, None)
+        if cls.__cache__ is not None:
+            cls.__cache__.delete(key)
+            # 事务提交前其他请求可能又读入了旧数据，提交后再清除一次
+            db.after_commit(functools.partial(cls.__cache__.delete, key))
+
+    @classmethod
+    def cache_stats(cls):
+        stats = dict(cls.__cache_stats__)
+        if cls.__cache__ is not None:
+            stats['cache_size'] = len(cls.__cache__)
+        return stats
+
+    @classmethod
+    def find_first(cls, where, *args, **kw):
+        return db.select_one(cls._select_sql(kw.get('columns'), where), *args, factory=cls._factory)
+
+    @classmethod
+    def find_all(cls, *args, **kw):
+        return db.select(cls._select_sql(kw.get('columns')), factory=cls._factory,
+                         cache=kw.get('cache'))
 
     @classmethod
-    def find_first(cls, where, *args):
-        d = db.select_one('select * from %s %s' % (cls.__table__, where), *args)
-        return cls(**d) if d else None
+    def find_by(cls, where, *args, **kw):
+        # columns=['id', 'name'] 只查询部分字段
+        # cache=60 使用查询缓存，见 db.set_query_cache
+        return db.select(cls._select_sql(kw.get('columns'), where), *args, factory=cls._factory,
+                         cache=kw.get('cache'))
 
     @classmethod
-    def find_all(cls, *args):
-        L = db.select('select * from `%s`' % cls.__table__)
-        return [cls(**d) for d in L]
+    def find_rows(cls, where='', *args, **kw):
+        # 返回基于 tuple 的轻量行对象，适合只读的大结果集
+        return db.select_rows(cls._select_sql(kw.get('columns'), where), *args)
 
     @classmethod
-    def find_by(cls, where, *args):
-        L = db.select('select * from `%s` %s' % (cls.__table__, where), *args)
-        return [cls(**d) for d in L]
+    def iter_by(cls, where, *args, **kw):
+        # 逐个返回 model，见 db.iter_select
+        sql = cls._select_sql(kw.pop('columns', None), where)
+        rows = db.iter_select(sql, *args, factory=cls._factory, **kw)
+        try:
+            for obj in rows:
+                yield obj
+        finally:
+            rows.close()
 
     @classmethod
-    def count_all(cls):
-        return db.select_int('select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__))
+    def count_all(cls, cache=None):
+        return db.select_int('select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__),
+                             cache=cache)
 
     @classmethod
-    def count_by(cls, where, *args):
+    def count_by(cls, where, *args, **kw):
         return db.select_int('select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where),
-                             *args)
+                             *args, cache=kw.get('cache'))
 
     def update(self):
         self.pre_update and self.pre_update()
         L = []
         args = []
-        for k, v in self.__mappings__.iteritems():
+        for k, v in self.__mappings__.items():
             if v.updatable:
                 if hasattr(self, k):
                     arg = getattr(self, k)
@@ -231,6 +360,7 @@ class Model(with_metaclass(ModelMetaclass, dict)):
         pk = self.__primary_key__.name
         args.append(getattr(self, pk))
         db.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+        self._invalidate(getattr(self, pk))
         return self
 
     def delete(self):
@@ -238,19 +368,105 @@ class Model(with_metaclass(ModelMetaclass, dict)):
         pk = self.__primary_key__.name
         args = (getattr(self, pk),)
         db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+        self._invalidate(args[0])
         return self
 
     def insert(self):
+        db.insert('%s' % self.__table__, **self._insert_params())
+        self._invalidate(getattr(self, self.__primary_key__.name, None))
+        return self
+
+    def _insert_params(self):
         self.pre_insert and self.pre_insert()
         params = {}
-        for k, v in self.__mappings__.iteritems():
+        for k, v in self.__mappings__.items():
             if v.insertable:
                 if not hasattr(self, k):
                     setattr(self, k, v.default)
                 params[v.name] = getattr(self, k)
-        db.insert('%s' % self.__table__, **params)
+        return params
+
+    def _update_params(self):
+        self.pre_update and self.pre_update()
+        params = {}
+        for k, v in self.__mappings__.items():
+            if v.updatable:
+                if not hasattr(self, k):
+                    setattr(self, k, v.default)
+                params[v.name] = getattr(self, k)
+        pk = self.__primary_key__.name
+        params[pk] = getattr(self, pk)
+        return params
+
+    @classmethod
+    def bulk_insert(cls, objs, batch_size=1000):
+        # 批量插入，按 batch_size 及语句大小分批，在一个事务中提交
+        rows = [obj._insert_params() for obj in objs]
+        db.insert_many(cls.__table__, rows, batch_size)
+        pk = cls.__primary_key__.name
+        for row in rows:
+            cls._invalidate(row.get(pk))
+        return objs
+
+    @classmethod
+    def bulk_update(cls, objs, batch_size=500):
+        # 按主键批量更新所有 updatable 字段
+        pk = cls.__primary_key__.name
+        rows = [obj._update_params() for obj in objs]
+        db.update_many(cls.__table__, pk, rows, batch_size)
+        for row in rows:
+            cls._invalidate(row[pk])
+        return objs
+
+
+class UnitOfWork(object):
+    # 收集 insert/update/delete，退出时在一个事务中按顺序写入
+    # with unit_of_work() as uow:
+    #     uow.insert(user)
+    def __init__(self):
+        self._operations = []
+
+    def insert(self, obj):
+        self._operations.append(('insert', obj))
+        return obj
+
+    def update(self, obj):
+        self._operations.append(('update', obj))
+        return obj
+
+    def delete(self, obj):
+        self._operations.append(('delete', obj))
+        return obj
+
+    def flush(self):
+        # 连续插入的同一个 Model 合并为 bulk_insert
+        operations, self._operations = self._operations, []
+        with db.transaction():
+            inserts = []
+            for operation, obj in operations:
+                if inserts and (operation != 'insert' or type(obj) is not type(inserts[0])):
+                    type(inserts[0]).bulk_insert(inserts)
+                    inserts = []
+                if operation == 'insert':
+                    inserts.append(obj)
+                else:
+                    getattr(obj, operation)()
+            if inserts:
+                type(inserts[0]).bulk_insert(inserts)
+
+    def __enter__(self):
         return self
 
+    def __exit__(self, exctype, excvalue, traceback):
+        if exctype is None:
+            self.flush()
+        else:
+            self._operations = []
+
+
+def unit_of_work():
+    return UnitOfWork()
+
 
 if __name__ == '__main__':
     db.create_engine('root', 'password', 'test')
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+import re
+from collections import OrderedDict
+
+_re_route = re.compile(r'(\:[a-zA-Z_]\w*)')
+_re_param_segment = re.compile(r'^\:[a-zA-Z_]\w*$')
+
+
+def _build_regex(path):
+    # 将路由转换为可以匹配地址的正则
+    re_list = ['^']
+    var_list = []
+    is_var = False
+    for v in _re_route.split(path):
+        if is_var:
+            var_name = v[1:]
+            var_list.append(var_name)
+            re_list.append(r'(?P<%s>[^\/]+)' % var_name)
+        else:
+            s = ''
+            for ch in v:
+                if re.match('\w', ch):
+                    s += ch
+                else:
+                    s += '\\' + ch
+            re_list.append(s)
+        is_var = not is_var
+    re_list.append('$')
+    return ''.join(re_list)
+
+
+class _Methods(object):
+    # 同一路径下各请求方式的处理函数，以及预先计算好的 Allow
+    __slots__ = ('handlers', 'resolved', 'allow')
+
+    def __init__(self):
+        # 注册的处理函数 {method: func}
+        self.handlers = {}
+        # 实际用于匹配的处理函数，未单独注册 HEAD 时由 GET 处理
+        self.resolved = {}
+        self.allow = ''
+
+    def add(self, method, func):
+        self.handlers[method] = func
+        resolved = dict(self.handlers)
+        if 'GET' in resolved and 'HEAD' not in resolved:
+            resolved['HEAD'] = resolved['GET']
+        self.resolved = resolved
+        self.allow = ', '.join(sorted(set(resolved) | set(['OPTIONS'])))
+
+
+def _merge_allow(methods_list):
+    # 同一地址匹配多个路由时合并各路由的 Allow
+    allowed = set(['OPTIONS'])
+    for methods in methods_list:
+        allowed.update(methods.resolved)
+    return ', '.join(sorted(allowed))
+
+
+class _Node(object):
+    # 路由树节点 按 '/' 分段
+    __slots__ = ('children', 'patterns', 'param', 'methods')
+
+    def __init__(self):
+        # 静态分段 {'admin': node}
+        self.children = {}
+        # 分段内混合参数 如 'user-:id'，[(segment, regex, node)]
+        self.patterns = []
+        # 整段参数 如 ':name'
+        self.param = None
+        # 路由终点的 _Methods
+        self.methods = None
+
+    def child(self, segment):
+        if _re_route.search(segment) is None:
+            node = self.children.get(segment)
+            if node is None:
+                node = self.children[segment] = _Node()
+            return node
+        if _re_param_segment.match(segment):
+            if self.param is None:
+                self.param = _Node()
+            return self.param
+        # 参数名不影响匹配，'user-:id' 与 'user-:name' 为同一节点
+        key = _re_route.sub(':', segment)
+        for pattern_key, regex, node in self.patterns:
+            if pattern_key == key:
+                return node
+        node = _Node()
+        self.patterns.append((key, re.compile(_build_regex(segment)), node))
+        return node
+
+    def find(self, segments, index, method, args, fallback):
+        # 返回支持该请求方式的 (node, args)
+        # 路径匹配但不支持该请求方式的节点依次记入 fallback，用于 405 及 OPTIONS
+        if index == len(segments):
+            methods = self.methods
+            if methods is None:
+                return None
+            if method in methods.resolved:
+                return self, args
+            fallback.append((self, args))
+            return None
+        segment = segments[index]
+        # 优先级: 静态分段 > 混合参数分段 > 整段参数
+        node = self.children.get(segment)
+        if node is not None:
+            result = node.find(segments, index + 1, method, args, fallback)
+            if result is not None:
+                return result
+        for pattern_key, regex, node in self.patterns:
+            match = regex.match(segment)
+            if match:
+                result = node.find(segments, index + 1, method,
+                                   args + list(match.groups()), fallback)
+                if result is not None:
+                    return result
+        if self.param is not None and segment:
+            return self.param.find(segments, index + 1, method, args + [segment], fallback)
+        return None
+
+
+class TrieRouter(object):
+    # 按路径分段的路由树，查找耗时与路径深度相关，与路由数量无关
+    # 静态路由直接保存在字典中
+
+    def __init__(self):
+        self._static = {}
+        self._root = _Node()
+
+    def add(self, method, path, func):
+        if _re_route.search(path) is None:
+            methods = self._static.get(path)
+            if methods is None:
+                methods = self._static[path] = _Methods()
+            methods.add(method, func)
+            return
+        node = self._root
+        for segment in path.split('/'):
+            node = node.child(segment)
+        if node.methods is None:
+            node.methods = _Methods()
+        node.methods.add(method, func)
+
+    def compile(self):
+        # 路由树在 add 时已建立
+        pass
+
+    def match(self, method, path):
+        # 返回 (func, args, allow)，路径存在但不支持该请求方式时 func 为 None
+        # 路径不存在时返回 None
+        static = self._static.get(path)
+        if static is not None and method in static.resolved:
+            return static.resolved[method], (), static.allow
+        fallback = []
+        result = self._root.find(path.split('/'), 0, method, [], fallback)
+        if result is not None:
+            node, args = result
+            return node.methods.resolved[method], tuple(args), node.methods.allow
+        if static is None and not fallback:
+            return None
+        methods_list = [node.methods for node, args in fallback]
+        if static is not None:
+            return None, (), _merge_allow([static] + methods_list)
+        return None, tuple(fallback[0][1]), _merge_allow(methods_list)
+
+
+_re_named_group = re.compile(r'\(\?P<[a-zA-Z_]\w*>')
+
+
+def _segments(path):
+    # 路由的各分段 [(kind, value, regex)]，kind: 0 静态分段 1 混合参数分段 2 整段参数
+    segments = []
+    for segment in path.split('/'):
+        if _re_route.search(segment) is None:
+            segments.append((0, segment, None))
+        elif _re_param_segment.match(segment):
+            segments.append((2, None, None))
+        else:
+            segments.append((1, _re_route.sub(':', segment), re.compile(_build_regex(segment))))
+    return segments
+
+
+def _overlap(a, b):
+    # 分段数相同的两个路由是否可能匹配同一地址，不能确定时视为可能
+    for (kind_a, value_a, regex_a), (kind_b, value_b, regex_b) in zip(a, b):
+        if kind_a == 0 and kind_b == 0:
+            if value_a != value_b:
+                return False
+        elif kind_a == 0 or kind_b == 0:
+            value, regex = (value_a, regex_b) if kind_a == 0 else (value_b, regex_a)
+            # 参数不匹配空的分段
+            if not value or (regex is not None and not regex.match(value)):
+                return False
+    return True
+
+
+def _overlaps(segments):
+    # 每个路由之后可能与其匹配同一地址的路由序号 (从 1 开始)
+    # 按分段位置建立 {静态分段: 路由} 索引，由静态分段缩小范围后再逐个比较
+    result = [()] * len(segments)
+    by_length = {}
+    for index, route in enumerate(segments):
+        by_length.setdefault(len(route), []).append(index)
+    for indexes in by_length.values():
+        statics = {}
+        wildcards = {}
+        for index in indexes:
+            for position, (kind, value, regex) in enumerate(segments[index]):
+                if kind == 0:
+                    statics.setdefault((position, value), set()).add(index)
+                else:
+                    wildcards.setdefault(position, set()).add(index)
+        for index in indexes:
+            candidates = None
+            for position, (kind, value, regex) in enumerate(segments[index]):
+                if kind != 0:
+                    continue
+                same = statics[(position, value)] | wildcards.get(position, set())
+                candidates = same if candidates is None else candidates & same
+                if len(candidates) == 1:
+                    break
+            if candidates is None:
+                candidates = indexes
+            result[index] = tuple(other + 1 for other in sorted(candidates)
+                                  if other > index and _overlap(segments[index], segments[other]))
+    return result
+
+
+def _precedence(segments):
+    # 按 TrieRouter 的查找顺序排列路由，返回排列后的下标
+    # 逐段比较: 静态分段 > 混合参数分段 (同一前缀下按注册顺序) > 整段参数
+    first_seen = {}
+    ranks = []
+    for index, route in enumerate(segments):
+        rank = []
+        prefix = ()
+        for kind, value, regex in route:
+            prefix += ((kind, value),)
+            if kind == 1:
+                rank.append((1, first_seen.setdefault(prefix, index)))
+            else:
+                # 同一位置的不同静态分段不会匹配同一地址，无需区分顺序
+                rank.append((kind, 0))
+        ranks.append(rank)
+    return sorted(range(len(segments)), key=ranks.__getitem__)
+
+
+class RegexRouter(object):
+    # 所有动态路由合并为一个正则，一次匹配后由 lastindex 找到路由
+    # 分支按 TrieRouter 的优先级排列，两种实现对重叠的路由匹配结果相同
+    # 路由变化后在下一次匹配时重新编译
+
+    def __init__(self):
+        self._static = {}
+        # {归一化的路径: (path, _Methods)} 保持注册顺序
+        self._dynamic = OrderedDict()
+        # (regex, {group_index: (_Methods, route_regex, overlaps)})
+        self._compiled = None
+
+    def add(self, method, path, func):
+        if _re_route.search(path) is None:
+            methods = self._static.get(path)
+            if methods is None:
+                methods = self._static[path] = _Methods()
+            methods.add(method, func)
+            return
+        # 参数名不影响匹配，'/:id/' 与 '/:name/' 为同一路由，合并为同一个分支
+        key = _re_route.sub(':', path)
+        if key not in self._dynamic:
+            self._dynamic[key] = (path, _Methods())
+        self._dynamic[key][1].add(method, func)
+        self._compiled = None
+
+    def _compile(self):
+        # 每个路由的参数改为非捕获分组，末尾加一个空分组作为标记:
+        # ^(?:\/a\/(?:[^\/]+)$()|\/b\/(?:[^\/]+)$())
+        # 只有整条路由匹配成功时标记分组才会被设置，lastindex 即路由序号。
+        # 失败的分支不留下分组记录，避免 sre 在分支回溯时保存大量分组状态
+        # overlaps: 排在该路由之后、可能匹配同一地址的路由序号，
+        # 大多数路由没有重叠，405/OPTIONS 直接使用该路由的 Allow，不再逐个匹配
+        parts = []
+        table = {}
+        routes = list(self._dynamic.values())
+        segments = [_segments(path) for path, methods in routes]
+        order = _precedence(segments)
+        routes = [routes[index] for index in order]
+        overlaps = _overlaps([segments[index] for index in order])
+        for index, (path, methods) in enumerate(routes):
+            route_regex = _build_regex(path)
+            parts.append(_re_named_group.sub('(?:', route_regex[1:]) + '()')
+            table[index + 1] = (methods, re.compile(route_regex), overlaps[index])
+        regex = re.compile('^(?:%s)' % '|'.join(parts)) if parts else None
+        self._compiled = compiled = (regex, table)
+        return compiled
+
+    def compile(self):
+        # 预先编译，如 prefork 时在主进程中编译，子进程共享
+        if self._compiled is None:
+            self._compile()
+
+    def match(self, method, path):
+        # 返回 (func, args, allow)，路径存在但不支持该请求方式时 func 为 None
+        # 路径不存在时返回 None
+        static = self._static.get(path)
+        if static is not None and method in static.resolved:
+            return static.resolved[method], (), static.allow
+        compiled = self._compiled
+        if compiled is None:
+            compiled = self._compile()
+        regex, table = compiled
+        match = regex.match(path) if regex is not None else None
+        if match is None:
+            if static is not None:
+                return None, (), static.allow
+            return None
+        methods, route_regex, overlaps = table[match.lastindex]
+        # 参数由该路由自身的正则取出
+        args = route_regex.match(path).groups()
+        func = methods.resolved.get(method)
+        if func is not None:
+            return func, args, methods.allow
+        if overlaps:
+            return self._fallback(method, path, static, table, methods, args, overlaps)
+        if static is not None:
+            return None, (), _merge_allow([static, methods])
+        return None, args, methods.allow
+
+    def _fallback(self, method, path, static, table, methods, args, overlaps):
+        # 第一个匹配的动态路由不支持该请求方式，按顺序查找与其重叠的路由，
+        # 都不支持时合并静态路由及各动态路由的 Allow
+        methods_list = [methods]
+        for index in overlaps:
+            other, route_regex, _ = table[index]
+            match = route_regex.match(path)
+            if match is None:
+                continue
+            func = other.resolved.get(method)
+            if func is not None:
+                return func, match.groups(), other.allow
+            methods_list.append(other)
+        if static is not None:
+            return None, (), _merge_allow([static] + methods_list)
+        return None, args, _merge_allow(methods_list)
+
+
+ROUTERS = {
+    'trie': TrieRouter,
+    'regex': RegexRouter,
+}
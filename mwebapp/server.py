@@ -0,0 +1,581 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+# WSGI 服务: 线程池服务 ThreadPoolWSGIServer 及多进程 prefork 服务 PreforkServer
+import io
+import os
+import sys
+import time
+import errno
+import random
+import signal
+import socket
+import threading
+import traceback
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+from mwebapp import db
+from mwebapp.webapp import FileBody
+
+try:
+    import queue
+    from http.server import BaseHTTPRequestHandler
+except ImportError:
+    import Queue as queue
+    from BaseHTTPServer import BaseHTTPRequestHandler
+
+# 请求行的最大长度
+MAX_REQUEST_LINE = 65536
+
+_BODY_503 = b'<html><body><h1>503 Service Unavailable</h1></body></html>'
+_RESPONSE_503 = (b'HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/html\r\nContent-Length: ' +
+                 str(len(_BODY_503)).encode('latin-1') +
+                 b'\r\nRetry-After: 1\r\nConnection: close\r\n\r\n' + _BODY_503)
+
+
+class _Input(object):
+    # 只能读取 Content-Length 长度的 wsgi.input，请求结束后读完剩余部分，
+    # 保证 keep-alive 连接上的下一个请求从正确的位置开始
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def drain(self):
+        while self.remaining > 0:
+            if not self.read(min(self.remaining, 65536)):
+                break
+
+
+def _read_chunked(rfile, limit):
+    # 读取 Transfer-Encoding: chunked 的请求体
+    chunks = []
+    size = 0
+    while True:
+        length = int(rfile.readline(MAX_REQUEST_LINE).split(b';')[0], 16)
+        if length == 0:
+            while rfile.readline(MAX_REQUEST_LINE) not in (b'\r\n', b'\n', b''):
+                pass
+            break
+        size += length
+        if size > limit:
+            raise ValueError('Request body too large')
+        chunks.append(rfile.read(length))
+        rfile.readline(MAX_REQUEST_LINE)
+    return b''.join(chunks)
+
+
+class _DeadlineReader(io.RawIOBase):
+    # 连接的读取端，设置 deadline 后每次 recv 的超时不超过剩余时间，
+    # 逐字节发送请求头的慢速客户端不能一直占用工作线程
+    def __init__(self, sock):
+        self.sock = sock
+        self.deadline = None
+        # 未到 deadline 时每次 recv 的超时
+        self.timeout = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout('Timed out reading the request head')
+            self.sock.settimeout(remaining if self.timeout is None else min(remaining, self.timeout))
+        return self.sock.recv_into(b)
+
+
+def _file_wrapper(fileobj, block_size=65536):
+    # wsgi.file_wrapper，返回的 FileBody 使用 sendfile 发送
+    return FileBody(fileobj, block_size=block_size)
+
+
+class _KeepAliveHandler(WSGIRequestHandler):
+    # 支持 HTTP/1.1 keep-alive 的请求处理
+    # 响应没有 Content-Length 时对 HTTP/1.1 客户端使用 chunked，否则响应后关闭连接
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.timeout = self.server.request_timeout
+        WSGIRequestHandler.setup(self)
+        self.rfile.close()
+        self.reader = _DeadlineReader(self.connection)
+        self.rfile = io.BufferedReader(self.reader, io.DEFAULT_BUFFER_SIZE)
+        self.requests = 0
+
+    def handle(self):
+        BaseHTTPRequestHandler.handle(self)
+
+    def handle_one_request(self):
+        # 等待同一连接上的下一个请求使用 keepalive_timeout，请求行和请求头需在 header_timeout 内读完
+        self.reader.timeout = self.server.keepalive_timeout if self.requests else self.server.request_timeout
+        self.reader.deadline = time.time() + self.server.header_timeout if self.server.header_timeout else None
+        try:
+            self.raw_requestline = self.rfile.readline(MAX_REQUEST_LINE + 1)
+            if len(self.raw_requestline) <= MAX_REQUEST_LINE and self.raw_requestline:
+                self.reader.timeout = self.server.request_timeout
+                if not self.parse_request():
+                    return
+        except (socket.timeout, socket.error):
+            self.close_connection = True
+            return
+        finally:
+            self.reader.deadline = None
+            self.connection.settimeout(self.server.request_timeout)
+        if len(self.raw_requestline) > MAX_REQUEST_LINE:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        self.requests += 1
+        try:
+            self.run_wsgi()
+        except (socket.timeout, socket.error):
+            self.close_connection = True
+
+    def run_wsgi(self):
+        environ = self.get_environ()
+        if 'chunked' in (self.headers.get('Transfer-Encoding') or '').lower():
+            try:
+                body = _read_chunked(self.rfile, self.server.max_body)
+            except ValueError:
+                self.send_error(413)
+                self.close_connection = True
+                return
+            environ['CONTENT_LENGTH'] = str(len(body))
+            stream = _Input(io.BytesIO(body), len(body))
+        else:
+            try:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                self.send_error(400)
+                self.close_connection = True
+                return
+            stream = _Input(self.rfile, length)
+        environ['wsgi.input'] = stream
+        environ['wsgi.errors'] = sys.stderr
+        environ['wsgi.version'] = (1, 0)
+        environ['wsgi.url_scheme'] = 'http'
+        environ['wsgi.multithread'] = True
+        environ['wsgi.multiprocess'] = False
+        environ['wsgi.run_once'] = False
+        environ['wsgi.file_wrapper'] = _file_wrapper
+        self.status = None
+        self.response_headers = None
+        self.headers_sent = False
+        self.chunked = False
+        try:
+            result = self.server.get_app()(environ, self.start_response)
+        except Exception:
+            self.server.handle_error(self.request, self.client_address)
+            if not self.headers_sent:
+                self.send_error(500)
+            self.close_connection = True
+            return
+        try:
+            if isinstance(result, list) and self.command != 'HEAD' and self.status[:3] not in ('204', '304') and \
+                    not self._header('Content-Length'):
+                self.response_headers.append(('Content-Length', str(sum(map(len, result)))))
+            if isinstance(result, FileBody) and self._can_sendfile():
+                # 文件由内核直接发送
+                self.send_head()
+                self.connection.sendfile(result.fileobj, result.offset, result.length)
+            else:
+                for data in result:
+                    if data:
+                        self.write(data)
+            if not self.headers_sent:
+                self.send_head()
+            if self.chunked:
+                self.wfile.write(b'0\r\n\r\n')
+        except (socket.timeout, socket.error):
+            raise
+        except Exception:
+            self.server.handle_error(self.request, self.client_address)
+            self.close_connection = True
+        finally:
+            close = getattr(result, 'close', None)
+            if close is not None:
+                close()
+        if not self.close_connection:
+            stream.drain()
+
+    def _can_sendfile(self):
+        return (hasattr(self.connection, 'sendfile') and self.command != 'HEAD' and
+                self._header('Content-Length') is not None)
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info:
+            try:
+                if self.headers_sent:
+                    raise exc_info[1]
+            finally:
+                exc_info = None
+        self.status = status
+        self.response_headers = list(headers)
+        return self.write
+
+    def _header(self, name):
+        name = name.lower()
+        for key, value in self.response_headers:
+            if key.lower() == name:
+                return value
+        return None
+
+    def send_head(self):
+        code = int(self.status[:3])
+        self.send_response(code, self.status[4:])
+        has_body = code >= 200 and code not in (204, 304) and self.command != 'HEAD'
+        if has_body and self._header('Content-Length') is None:
+            if self.request_version == 'HTTP/1.1':
+                self.response_headers.append(('Transfer-Encoding', 'chunked'))
+                self.chunked = True
+            else:
+                # HTTP/1.0 以关闭连接标识响应结束
+                self.close_connection = True
+        if not self.server.queue.empty():
+            # 有连接在排队时不保持空闲连接，让出工作线程
+            self.close_connection = True
+        if self.close_connection:
+            self.response_headers.append(('Connection', 'close'))
+        elif self.request_version != 'HTTP/1.1':
+            self.response_headers.append(('Connection', 'keep-alive'))
+        for name, value in self.response_headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.headers_sent = True
+
+    def write(self, data):
+        if not self.headers_sent:
+            self.send_head()
+        if self.command == 'HEAD':
+            return
+        if self.chunked:
+            self.wfile.write(('%x\r\n' % len(data)).encode('latin-1') + data + b'\r\n')
+        else:
+            self.wfile.write(data)
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    # 线程池 WSGI 服务，主线程 accept 后放入有界队列，由工作线程处理
+    # threads: 工作线程数  backlog: 排队的最大连接数，队列已满时直接返回 503
+    # request_timeout: 每次读写 socket 的超时秒数，即连接无数据往来的最长时间
+    # header_timeout: 读完请求行及请求头的总秒数，None 为不限制
+    # keepalive_timeout: 空闲连接保持的秒数
+    # queue_timeout: 连接排队超过该秒数时返回 503，None 为不限制
+    # max_body: chunked 请求体的最大字节数
+    def __init__(self, app, host='127.0.0.1', port=9000, threads=16, backlog=64, request_timeout=30,
+                 keepalive_timeout=5, queue_timeout=None, max_body=16 * 1024 * 1024, header_timeout=10):
+        self.request_queue_size = backlog
+        WSGIServer.__init__(self, (host, port), _KeepAliveHandler)
+        self.set_app(app)
+        self.queue = queue.Queue(backlog)
+        self.request_timeout = request_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.header_timeout = header_timeout
+        self.queue_timeout = queue_timeout
+        self.max_body = max_body
+        self.workers = []
+        for i in range(threads):
+            worker = threading.Thread(target=self._work, name='mwebapp-worker-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def process_request(self, request, client_address):
+        try:
+            self.queue.put_nowait((request, client_address, time.time()))
+        except queue.Full:
+            self._reject(request)
+
+    def _reject(self, request):
+        # 返回 503 并关闭连接
+        try:
+            request.setblocking(False)
+            try:
+                request.recv(MAX_REQUEST_LINE)
+            except socket.error:
+                pass
+            request.sendall(_RESPONSE_503)
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            request, client_address, queued = item
+            if self.queue_timeout is not None and time.time() - queued > self.queue_timeout:
+                self._reject(request)
+                continue
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        WSGIServer.server_close(self)
+        for worker in self.workers:
+            self.queue.put(None)
+
+
+class _WorkerWSGIServer(WSGIServer):
+    # 使用主进程创建的监听 socket 的 wsgiref 服务
+    def __init__(self, sock, app):
+        WSGIServer.__init__(self, sock.getsockname()[:2], WSGIRequestHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_address = sock.getsockname()
+        host, port = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.set_app(app)
+        # 已处理的请求数
+        self.handled = 0
+
+    def finish_request(self, request, client_address):
+        self.handled += 1
+        WSGIServer.finish_request(self, request, client_address)
+
+
+class PreforkServer(object):
+    # workers: 工作进程数，默认为 CPU 核数
+    # reuse_port: 每个工作进程使用各自的 SO_REUSEPORT socket，由内核分配连接；
+    #     False 时所有工作进程共用一个 socket，None 时系统支持则使用
+    # max_requests: 工作进程处理该数量的请求后退出并重启，0 为不限制
+    # max_requests_jitter: max_requests 随机增加 0~jitter，避免工作进程同时重启
+    # worker: 工作进程使用的服务 'wsgiref' 或 'asyncio'，worker_options 为 asyncio 服务的参数
+    # graceful_timeout: 退出时等待工作进程的秒数，超时后强制结束
+    def __init__(self, app, host='127.0.0.1', port=9000, workers=None, reuse_port=None, max_requests=0,
+                 max_requests_jitter=0, worker='wsgiref', graceful_timeout=30, backlog=1024, **worker_options):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('Prefork server requires os.fork.')
+        if worker not in ('wsgiref', 'asyncio'):
+            raise ValueError('Bad worker: %s' % worker)
+        if reuse_port is None:
+            reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers or _cpu_count()
+        self.reuse_port = reuse_port
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.worker = worker
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.worker_options = worker_options
+        # 每个工作进程位置对应的监听 socket，共用时都为同一个
+        self.sockets = []
+        # {pid: 位置}
+        self.children = {}
+        # 收到 SIGHUP 后等待退出的旧工作进程
+        self.retiring = set()
+        # {位置: 重启时间}，启动后很快退出的工作进程延迟重启
+        self.pending = {}
+        self.started = {}
+        self._reload = False
+        self._stopping = False
+        self._alive = True
+        self.master_pid = None
+
+    def _listen(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        return sock
+
+    def _bind(self):
+        # socket 由主进程创建，工作进程重启时继续使用，已排队的连接不会丢失
+        sock = self._listen()
+        # port 为 0 时使用系统分配的端口
+        self.port = sock.getsockname()[1]
+        if self.reuse_port:
+            self.sockets = [sock] + [self._listen() for i in range(self.workers - 1)]
+        else:
+            # 多个进程 accept 同一个 socket，未抢到连接的进程不阻塞
+            sock.setblocking(False)
+            self.sockets = [sock] * self.workers
+
+    def run(self):
+        self.app.preload()
+        self._bind()
+        self.master_pid = os.getpid()
+        signal.signal(signal.SIGHUP, self._on_hup)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        print('run prefork server on http://%s:%s (%d %s workers)' % (self.host, self.port, self.workers, self.worker))
+        for slot in range(self.workers):
+            self._spawn(slot)
+        try:
+            while not self._stopping:
+                self._reap()
+                if self._reload:
+                    self._reload = False
+                    self._restart()
+                now = time.time()
+                for slot, at in list(self.pending.items()):
+                    if at <= now:
+                        del self.pending[slot]
+                        self._spawn(slot)
+                time.sleep(0.2)
+        finally:
+            self._shutdown()
+
+    def _on_hup(self, signum, frame):
+        self._reload = True
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _spawn(self, slot):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = slot
+            self.started[pid] = time.time()
+            return pid
+        # 工作进程
+        code = 0
+        try:
+            self._worker(slot)
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def _reap(self):
+        # 回收退出的工作进程，非 SIGHUP 引起的退出在原位置重新启动
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            slot = self.children.pop(pid, None)
+            started = self.started.pop(pid, 0)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            if slot is None or self._stopping:
+                continue
+            if time.time() - started < 1:
+                # 启动后立即退出，避免反复重启
+                self.pending[slot] = time.time() + 1
+            else:
+                self._spawn(slot)
+
+    def _restart(self):
+        # 平滑重启: 先启动新的工作进程，再结束旧的
+        old = [pid for pid in self.children if pid not in self.retiring]
+        for pid in old:
+            self._spawn(self.children[pid])
+        for pid in old:
+            self.retiring.add(pid)
+            self._kill(pid, signal.SIGTERM)
+
+    def _kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            pass
+
+    def _shutdown(self):
+        for pid in list(self.children):
+            self._kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self.children and time.time() < deadline:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if pid:
+                self.children.pop(pid, None)
+            else:
+                time.sleep(0.1)
+        for pid in list(self.children):
+            self._kill(pid, signal.SIGKILL)
+        for sock in set(self.sockets):
+            sock.close()
+
+    def _worker(self, slot):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self._on_worker_stop)
+        signal.signal(signal.SIGINT, self._on_worker_stop)
+        sock = self.sockets[slot]
+        for other in set(self.sockets):
+            if other is not sock:
+                other.close()
+        # 子进程不能使用父进程的数据库连接
+        db.after_fork()
+        random.seed()
+        limit = self.max_requests
+        if limit and self.max_requests_jitter:
+            limit += random.randint(0, self.max_requests_jitter)
+        if self.worker == 'asyncio':
+            self._serve_asyncio(sock, limit)
+        else:
+            self._serve_wsgiref(sock, limit)
+
+    def _on_worker_stop(self, signum, frame):
+        self._alive = False
+
+    def _serve_wsgiref(self, sock, limit):
+        server = _WorkerWSGIServer(sock, self.app)
+        # handle_request 最多等待 1 秒，以便检查退出条件
+        server.timeout = 1
+        while self._alive and (not limit or server.handled < limit):
+            if os.getppid() != self.master_pid:
+                # 主进程已退出
+                break
+            server.handle_request()
+
+    def _serve_asyncio(self, sock, limit):
+        from mwebapp.aserver import serve_worker
+        serve_worker(self.app, sock, limit, self.master_pid, graceful_timeout=self.graceful_timeout,
+                     backlog=self.backlog, **self.worker_options)
+
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
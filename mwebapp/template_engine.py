@@ -3,6 +3,13 @@
 # 参见 https://mozillazg.github.io/2016/03/let-us-build-a-template-engine-part1.html
 import re
 import os
+import sys
+import marshal
+import hashlib
+import threading
+from collections import OrderedDict
+
+from mwebapp.environ import _to_byte
 
 
 class TemplateSyntaxError(ValueError):
@@ -42,52 +49,69 @@ class CodeBuilder(object):
 
 
 class Template(object):
+    # 变量
+    re_variable = re.compile(r'\{\{ .*? \}\}')
+    # 注释
+    re_comment = re.compile(r'\{# .*? #\}')
+    # 标签
+    re_tag = re.compile(r'\{% .*? %\}')
+    # 用于按变量，注释，标签分割模板字符串
+    re_tokens = re.compile(r'''(
+        (?:\{\{ .*? \}\})
+        |(?:\{\# .*? \#\})
+        |(?:\{% .*? %\})
+    )''', re.X)
+
+    # extends
+    re_extends = re.compile(r'\{% extends (?P<name>.*?) %\}')
+    # blocks
+    re_blocks = re.compile(
+        r'\{% block (?P<name>\w+) %\}'
+        r'(?P<code>.*?)'
+        r'\{% endblock %\}', re.DOTALL)
+    # block.super
+    re_block_super = re.compile(r'\{\{ block\.super \}\}')
+
     def __init__(self, raw_text, indent=0, default_context=None,
                  func_name='__func_name', result_var='__result',
-                 template_dir=''):
+                 template_dir='', filename='<template>', stream=False):
         self.raw_text = raw_text
         self.default_context = default_context or {}
         self.func_name = func_name
         self.result_var = result_var
         self.template_dir = template_dir
+        self.filename = filename
+        # stream=True 时生成按 __flush_size 分块 yield 的生成器函数
+        self.stream = stream
+        self.size_var = result_var + '_size'
         self.code_builder = code_builder = CodeBuilder(indent=indent)
         self.buffered = []
-
-        # 变量
-        self.re_variable = re.compile(r'\{\{ .*? \}\}')
-        # 注释
-        self.re_comment = re.compile(r'\{# .*? #\}')
-        # 标签
-        self.re_tag = re.compile(r'\{% .*? %\}')
-        # 用于按变量，注释，标签分割模板字符串
-        self.re_tokens = re.compile(r'''(
-            (?:\{\{ .*? \}\})
-            |(?:\{\# .*? \#\})
-            |(?:\{% .*? %\})
-        )''', re.X)
-
-        # extends
-        self.re_extends = re.compile(r'\{% extends (?P<name>.*?) %\}')
-        # blocks
-        self.re_blocks = re.compile(
-            r'\{% block (?P<name>\w+) %\}'
-            r'(?P<code>.*?)'
-            r'\{% endblock %\}', re.DOTALL)
-        # block.super
-        self.re_block_super = re.compile(r'\{\{ block\.super \}\}')
+        # extends/include 引用到的模版文件
+        self.dependencies = []
+        self._code = None
 
         # 生成 def __func_name():
         code_builder.add_line('def {}():'.format(self.func_name))
         code_builder.forward()
         # 生成 __result = []
         code_builder.add_line('{} = []'.format(self.result_var))
+        if stream:
+            # 生成 __result_size = 0
+            code_builder.add_line('{} = 0'.format(self.size_var))
         # if/for 匹配判断
         self.ops_stack = []
         self._parse_text()
 
         self.flush_buffer()
-        # 生成 return "".join(__result)
-        code_builder.add_line('return "".join({})'.format(self.result_var))
+        if stream:
+            # 生成 if __result: yield "".join(__result)
+            code_builder.add_line('if {}:'.format(self.result_var))
+            code_builder.forward()
+            code_builder.add_line('yield "".join({})'.format(self.result_var))
+            code_builder.backward()
+        else:
+            # 生成 return "".join(__result)
+            code_builder.add_line('return "".join({})'.format(self.result_var))
         code_builder.backward()
 
     def _parse_text(self):
@@ -118,9 +142,10 @@ class Template(object):
             return
 
         parent_template_name = match_extends.group('name').strip('"\' ')
-        parent_template_path = os.path.join(
-            self.template_dir, parent_template_name
+        parent_template_path = os.path.realpath(
+            os.path.join(self.template_dir, parent_template_name)
         )
+        self.dependencies.append(parent_template_path)
         # 获取当前模版里的所有 blocks
         child_blocks = self._get_all_blocks(self.raw_text)
         # 用这些 blocks 替换掉父模版里的同名 blocks
@@ -182,11 +207,28 @@ class Template(object):
         filename = tag.split()[1].strip('"\'')
         included_template = self._parse_another_template_file(filename)
         self.code_builder.add(included_template.code_builder)
-        self.code_builder.add_line(
-            '{0}.append({1}())'.format(
-                self.result_var, included_template.func_name
+        if self.stream:
+            # 合并 include 模版输出的块，满 __flush_size 后再 yield
+            self.code_builder.add_line(
+                'for {0}_chunk in {1}():'.format(
+                    self.result_var, included_template.func_name
+                )
+            )
+            self.code_builder.forward()
+            self.code_builder.add_line(
+                '{0}.append({0}_chunk)'.format(self.result_var)
+            )
+            self.code_builder.add_line(
+                '{0} += len({1}_chunk)'.format(self.size_var, self.result_var)
+            )
+            self.code_builder.backward()
+            self._add_flush_check()
+        else:
+            self.code_builder.add_line(
+                '{0}.append({1}())'.format(
+                    self.result_var, included_template.func_name
+                )
             )
-        )
 
     def _parse_another_template_file(self, filename):
         '''读取include 页面 ，创建新的 template 对象'''
@@ -201,8 +243,11 @@ class Template(object):
                 fp.read(), indent=self.code_builder.indent,
                 default_context=self.default_context,
                 func_name=func_name, result_var=result_var,
-                template_dir=self.template_dir
+                template_dir=self.template_dir, filename=template_path,
+                stream=self.stream
             )
+        self.dependencies.append(template_path)
+        self.dependencies.extend(template.dependencies)
         return template
 
     def _handle_statement(self, tag):
@@ -234,6 +279,9 @@ class Template(object):
 
     def flush_buffer(self):
         '''将buffer内的代码加入 code_builder '''
+        if self.stream:
+            self._flush_stream_buffer()
+            return
         # 生成类似代码: __result.extend(['<h1>', name, '</h1>'])
         line = '{0}.extend([{1}])'.format(
             self.result_var, ','.join(self.buffered)
@@ -241,21 +289,338 @@ class Template(object):
         self.code_builder.add_line(line)
         self.buffered = []
 
-    def render(self, context=None):
-        '''根据变量渲染页面'''
-        namespace = {}
-        namespace.update(self.default_context)
-        if context:
-            namespace.update(context)
-        exec (str(self.code_builder), namespace)
-        result = namespace[self.func_name]()
-        return result
-
-
-def render(html, content):
-    f = open(html)
-    html_str = f.read()
-    f.close()
-    template = Template(html_str, template_dir='template')
-    text = template.render(content)
+    def _flush_stream_buffer(self):
+        if not self.buffered:
+            return
+        # 生成类似代码:
+        # __result.append("".join(['<h1>', name, '</h1>']))
+        # __result_size += len(__result[-1])
+        self.code_builder.add_line('{0}.append("".join([{1}]))'.format(
+            self.result_var, ','.join(self.buffered)
+        ))
+        self.code_builder.add_line('{0} += len({1}[-1])'.format(
+            self.size_var, self.result_var
+        ))
+        self._add_flush_check()
+        self.buffered = []
+
+    def _add_flush_check(self):
+        # 生成类似代码:
+        # if __result_size >= __flush_size:
+        #     yield "".join(__result)
+        #     del __result[:]
+        #     __result_size = 0
+        code_builder = self.code_builder
+        code_builder.add_line('if {} >= __flush_size:'.format(self.size_var))
+        code_builder.forward()
+        code_builder.add_line('yield "".join({})'.format(self.result_var))
+        code_builder.add_line('del {}[:]'.format(self.result_var))
+        code_builder.add_line('{} = 0'.format(self.size_var))
+        code_builder.backward()
+
+    @property
+    def code(self):
+        '''编译后的 code object，只编译一次'''
+        if self._code is None:
+            self._code = compile(str(self.code_builder), self.filename, 'exec')
+        return self._code
+
+    def render(self, context=None, flush_size=None):
+        '''根据变量渲染页面，stream 模式返回字符串块的生成器'''
+        return _render_code(self.code, self.func_name, self.default_context,
+                            context, flush_size)
+
+
+class CompiledTemplate(object):
+    # 从预编译文件加载的模版，只保留 code object
+
+    def __init__(self, code, func_name='__func_name', default_context=None,
+                 filename='<template>', dependencies=(), stream=False):
+        self.code = code
+        self.func_name = func_name
+        self.default_context = default_context or {}
+        self.filename = filename
+        self.dependencies = list(dependencies)
+        self.stream = stream
+
+    def render(self, context=None, flush_size=None):
+        '''根据变量渲染页面，stream 模式返回字符串块的生成器'''
+        return _render_code(self.code, self.func_name, self.default_context,
+                            context, flush_size)
+
+
+# stream 模式下每次 yield 的最少字符数
+DEFAULT_FLUSH_SIZE = 8192
+
+
+def _render_code(code, func_name, default_context, context, flush_size=None):
+    namespace = {}
+    namespace.update(default_context)
+    if context:
+        namespace.update(context)
+    namespace['__flush_size'] = flush_size or DEFAULT_FLUSH_SIZE
+    exec (code, namespace)
+    result = namespace[func_name]()
+    return result
+
+
+def _stat_signature(path):
+    '''文件的 (mtime, inode, size)，文件不存在时返回 None'''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_ino, st.st_size
+
+
+class _CacheEntry(object):
+    def __init__(self, template, signatures):
+        self.template = template
+        # {依赖文件路径: stat 签名}
+        self.signatures = signatures
+
+    def is_fresh(self):
+        for path, signature in self.signatures.items():
+            if _stat_signature(path) != signature:
+                return False
+        return True
+
+
+# 预编译文件格式版本，与 python 版本一起校验
+_ARTIFACT_VERSION = 2
+_ARTIFACT_SUFFIX = '.tplc'
+
+
+def _artifact_name(relname, stream=False):
+    if stream:
+        relname += '?stream'
+    return hashlib.sha1(_to_byte(relname)).hexdigest() + _ARTIFACT_SUFFIX
+
+
+def _relname(path, template_dir):
+    '''模版相对 template_dir 的路径，不在 template_dir 内时返回 None'''
+    relname = os.path.relpath(os.path.realpath(path), os.path.realpath(template_dir))
+    if relname.startswith(os.pardir):
+        return None
+    return relname.replace(os.sep, '/')
+
+
+def _artifact_signature(path):
+    # 部署时文件会被复制，预编译文件不校验 inode
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+
+def write_artifact(template, relname, template_dir, artifact_dir):
+    '''将 Template 的 code object 写入 artifact_dir'''
+    dependencies = []
+    for path in [template.filename] + template.dependencies:
+        name = _relname(path, template_dir)
+        if name is None:
+            raise TemplateSyntaxError('%s is outside of %s' % (path, template_dir))
+        signature = _artifact_signature(path)
+        dependencies.append((name, signature[0], signature[1]))
+    data = marshal.dumps((
+        _ARTIFACT_VERSION, sys.version, relname, template.stream,
+        template.func_name, dependencies, template.code
+    ))
+    artifact_path = os.path.join(artifact_dir, _artifact_name(relname, template.stream))
+    # 先写临时文件再改名，避免其他进程读到写了一半的文件
+    tmp_path = '%s.%d.tmp' % (artifact_path, os.getpid())
+    with open(tmp_path, 'wb') as fp:
+        fp.write(data)
+    os.rename(tmp_path, artifact_path)
+    return artifact_path
+
+
+def load_artifact(path, template_dir, artifact_dir, stream=False):
+    '''加载预编译的模版，文件不存在、版本不符或依赖已修改时返回 None'''
+    relname = _relname(path, template_dir)
+    if relname is None:
+        return None
+    artifact_path = os.path.join(artifact_dir, _artifact_name(relname, stream))
+    try:
+        with open(artifact_path, 'rb') as fp:
+            data = marshal.loads(fp.read())
+    except (IOError, OSError, ValueError, EOFError, TypeError):
+        return None
+    if data[0] != _ARTIFACT_VERSION:
+        return None
+    version, py_version, name, is_stream, func_name, dependencies, code = data
+    if py_version != sys.version or name != relname or is_stream != stream:
+        return None
+    paths = []
+    for dep_name, mtime, size in dependencies:
+        dep_path = os.path.realpath(os.path.join(template_dir, dep_name))
+        if _artifact_signature(dep_path) != (mtime, size):
+            return None
+        paths.append(dep_path)
+    return CompiledTemplate(code, func_name, filename=paths[0],
+                            dependencies=paths[1:], stream=stream)
+
+
+class TemplateCache(object):
+    # 进程内的模版缓存 保存编译后的 Template，依赖链上任一文件变化即失效
+    # auto_reload=False 为生产模式，首次编译后不再检查文件
+    # artifact_dir 为预编译文件目录，优先从中加载，过期时回退到实时编译
+
+    def __init__(self, maxsize=128, auto_reload=True, template_dir='template',
+                 artifact_dir=None):
+        self.maxsize = maxsize
+        self.auto_reload = auto_reload
+        self.template_dir = template_dir
+        self.artifact_dir = artifact_dir
+        self._entries = OrderedDict()
+        # 调用时的 (path, template_dir, stream) 到缓存键的映射，命中时不再 realpath
+        self._keys = {}
+        self._lock = threading.RLock()
+
+    def configure(self, maxsize=None, auto_reload=None, template_dir=None,
+                  artifact_dir=None):
+        if maxsize is not None:
+            self.maxsize = maxsize
+        if auto_reload is not None:
+            self.auto_reload = auto_reload
+        if template_dir is not None:
+            self.template_dir = template_dir
+        if artifact_dir is not None:
+            self.artifact_dir = artifact_dir
+        with self._lock:
+            self._shrink()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _shrink(self):
+        while len(self._entries) > max(self.maxsize, 0):
+            self._entries.popitem(last=False)
+
+    def get_template(self, path, template_dir=None, stream=False):
+        '''获取模版，缓存未命中或已过期时重新编译'''
+        template_dir = template_dir or self.template_dir
+        key = self._keys.get((path, template_dir, stream))
+        if key is None:
+            key = self._key(path, template_dir, stream)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # 移到末尾 LRU
+                self._entries[key] = entry
+        if entry is not None and (not self.auto_reload or entry.is_fresh()):
+            return entry.template
+
+        entry = self._compile(key[0], template_dir, stream)
+        self._put(key, entry)
+        return entry.template
+
+    def _key(self, path, template_dir, stream):
+        # 同一模版可能以不同的相对路径或软链接访问，以 realpath 作为缓存键
+        key = (os.path.realpath(path), os.path.realpath(template_dir), stream)
+        if len(self._keys) >= max(self.maxsize, 0) * 4:
+            self._keys.clear()
+        self._keys[(path, template_dir, stream)] = key
+        return key
+
+    def _put(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            self._shrink()
+
+    def _compile(self, path, template_dir, stream=False):
+        # 先记录 stat 再读取文件，编译期间文件被修改时下次请求会重新编译
+        signatures = {path: _stat_signature(path)}
+        template = None
+        if self.artifact_dir:
+            template = load_artifact(path, template_dir, self.artifact_dir, stream)
+        if template is None:
+            with open(path) as fp:
+                raw_text = fp.read()
+            template = Template(raw_text, template_dir=template_dir,
+                                filename=path, stream=stream)
+            template.code
+        for dependency in template.dependencies:
+            signatures.setdefault(dependency, _stat_signature(dependency))
+        return _CacheEntry(template, signatures)
+
+    def preload(self, template_dir=None, stream=False):
+        '''worker 启动时预先加载 template_dir 下所有模版'''
+        template_dir = template_dir or self.template_dir
+        count = 0
+        for path in _walk_templates(template_dir):
+            key = (os.path.realpath(path), os.path.realpath(template_dir), stream)
+            try:
+                entry = self._compile(key[0], template_dir, stream)
+            except (IOError, OSError, SyntaxError, ValueError):
+                continue
+            self._put(key, entry)
+            count += 1
+        return count
+
+
+def _walk_templates(template_dir):
+    for root, dirs, files in os.walk(template_dir):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for filename in sorted(files):
+            if not filename.startswith('.'):
+                yield os.path.join(root, filename)
+
+
+def precompile(template_dir='template', artifact_dir='template_cache', stream=False):
+    '''编译 template_dir 下所有模版并写入 artifact_dir，返回写入的文件
+    stream=True 时同时生成 stream 模式的版本'''
+    if not os.path.isdir(artifact_dir):
+        os.makedirs(artifact_dir)
+    modes = (False, True) if stream else (False,)
+    written = []
+    for path in _walk_templates(template_dir):
+        path = os.path.realpath(path)
+        with open(path) as fp:
+            raw_text = fp.read()
+        for mode in modes:
+            template = Template(raw_text, template_dir=template_dir,
+                                filename=path, stream=mode)
+            written.append(write_artifact(
+                template, _relname(path, template_dir), template_dir, artifact_dir
+            ))
+    return written
+
+
+template_cache = TemplateCache()
+
+
+def render(html, content, stream=False, flush_size=None):
+    template = template_cache.get_template(html, stream=stream)
+    text = template.render(content, flush_size)
     return text
+
+
+def main(argv=None):
+    # 命令行入口: mweb-precompile [template_dir] [artifact_dir]
+    import argparse
+    parser = argparse.ArgumentParser(description='Precompile mwebapp templates.')
+    parser.add_argument('template_dir', nargs='?', default='template')
+    parser.add_argument('artifact_dir', nargs='?', default='template_cache')
+    parser.add_argument('--stream', action='store_true',
+                        help='also build the streaming variants')
+    args = parser.parse_args(argv)
+    try:
+        written = precompile(args.template_dir, args.artifact_dir, args.stream)
+    except (IOError, OSError, SyntaxError, ValueError) as e:
+        sys.stderr.write('precompile failed: %s\n' % e)
+        return 1
+    for path in written:
+        print(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
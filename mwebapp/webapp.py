@@ -1,55 +1,255 @@
 # -*- coding: utf-8 -*-
 # __author__ = 'MingLei Ji'
-import re
+import io
 import os
+import re
 import sys
 import time
+import gzip
 import json
+import stat
+import inspect
 import threading
 import traceback
 import mimetypes
 import subprocess
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
+from mwebapp import db
 from mwebapp.db import create_engine
-from mwebapp.template_engine import render
-from mwebapp.environ import _to_byte, Request, Response, _to_str
-from mwebapp.httperror import notfound, badrequest, RedirectError, HttpError
+from mwebapp.cache import LRUCache
+from mwebapp.router import ROUTERS, _re_route, _build_regex
+from mwebapp.template_engine import render, template_cache
+from mwebapp.environ import _to_byte, Request, Response, _to_str, _HEADER_X_POWERED_BY
+from mwebapp.httperror import notfound, methodnotallowed, RedirectError, HttpError
+
+if sys.version > '3':
+    unicode = str
+
+_MISSING = object()
+
+
+class _ContextLocal(object):
+    # 请求上下文，每个属性保存在一个 ContextVar 中
+    # 线程之间、asyncio task 之间相互隔离
+    def __init__(self):
+        object.__setattr__(self, '_vars', {})
+        object.__setattr__(self, '_lock', threading.Lock())
 
-ctx = threading.local()
+    def _var(self, name):
+        var = self._vars.get(name)
+        if var is None:
+            with self._lock:
+                var = self._vars.get(name)
+                if var is None:
+                    var = self._vars[name] = contextvars.ContextVar('mwebapp.ctx.%s' % name)
+        return var
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = self._var(name).get(_MISSING)
+        if value is _MISSING:
+            raise AttributeError(name)
+        return value
+
+    def __setattr__(self, name, value):
+        self._var(name).set(value)
+
+    def __delattr__(self, name):
+        self._var(name).set(_MISSING)
+
+
+# python2 中没有 contextvars，使用 threading.local
+ctx = _ContextLocal() if contextvars is not None else threading.local()
 ctx.request = Request({})
 ctx.response = Response()
 
-_re_route = re.compile(r'(\:[a-zA-Z_]\w*)')
+_iscoroutine = getattr(inspect, 'iscoroutine', lambda obj: False)
+_iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', lambda obj: False)
+_isawaitable = getattr(inspect, 'isawaitable', lambda obj: False)
 
 
-def _build_regex(path):
-    # 将路由转换为可以匹配地址的正则
-    re_list = ['^']
-    var_list = []
-    is_var = False
-    for v in _re_route.split(path):
-        if is_var:
-            var_name = v[1:]
-            var_list.append(var_name)
-            re_list.append(r'(?P<%s>[^\/]+)' % var_name)
-        else:
-            s = ''
-            for ch in v:
-                if re.match('\w', ch):
-                    s += ch
-                else:
-                    s += '\\' + ch
-            re_list.append(s)
-        is_var = not is_var
-    re_list.append('$')
-    return ''.join(re_list)
-
-
-def render_html(path, content):
+def _run_coroutine(coro):
+    # 在线程中同步执行 async def 的处理函数
+    # ASGI 下请求路径被中间件改写、未能预先判断为 async 时，在请求所属的事件循环中执行并等待结果；
+    # 其他服务使用临时的事件循环
+    import asyncio
+    loop = getattr(ctx, 'loop', None)
+    if loop is not None:
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def then(body, func):
+    # 中间件对响应体的后处理: return then(self.app(), self.process)
+    # ASGI 下 async def 的处理函数返回 awaitable，处理函数结束后再调用 func(body)
+    if not _isawaitable(body):
+        return func(body)
+    import asyncio
+    outer = asyncio.get_event_loop().create_future()
+    inner = asyncio.ensure_future(body)
+
+    def done(future):
+        if outer.cancelled():
+            return
+        if future.cancelled():
+            outer.cancel()
+            return
+        try:
+            outer.set_result(func(future.result()))
+        except Exception as e:
+            outer.set_exception(e)
+
+    def cancelled(future):
+        if future.cancelled():
+            inner.cancel()
+
+    inner.add_done_callback(done)
+    outer.add_done_callback(cancelled)
+    return outer
+
+
+def _close_body(body):
+    close = getattr(body, 'close', None)
+    if close is not None:
+        close()
+
+
+def _iter_body(body):
+    # 逐块输出可迭代的响应体，结束或中断时关闭原迭代器
+    try:
+        for chunk in body:
+            if chunk:
+                yield _to_byte(chunk)
+    finally:
+        _close_body(body)
+
+
+class _ScopedBody(object):
+    # 流式响应体，迭代结束并关闭后才清空 ctx、归还请求的数据库连接，
+    # stream 模式的模版在输出时仍可访问 ctx 及数据库
+    # ASGI 下各块可能在不同的工作线程中取出，每次迭代时换入该请求的连接作用域
+    def __init__(self, body, db_ctx):
+        self.body = body
+        self.iterator = iter(body)
+        self.db_ctx = db_ctx
+        self.scope = db._DetachedCtx() if db_ctx is not None and db_ctx.should_cleanup else None
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.scope is None:
+            return next(self.iterator)
+        return self.scope.run(next, self.iterator)
+
+    next = __next__
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.scope is None:
+                _close_body(self.body)
+            else:
+                self.scope.run(_close_body, self.body)
+        finally:
+            if self.scope is not None:
+                self.scope.run(self.db_ctx.__exit__, None, None, None)
+            _clear_ctx()
+
+
+def _clear_ctx():
+    del ctx.request
+    del ctx.response
+
+
+class FileBody(object):
+    # 文件响应体，输出 fileobj 从 offset 开始的 length 字节，结束后关闭文件
+    # 逐块读取，内存占用与文件大小无关；mwebapp.server 的线程池服务使用 sendfile 直接发送
+    def __init__(self, fileobj, offset=0, length=None, block_size=65536):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.length = length
+        self.block_size = block_size
+
+    def __iter__(self):
+        self.fileobj.seek(self.offset)
+        remaining = self.length
+        while remaining is None or remaining > 0:
+            size = self.block_size if remaining is None else min(self.block_size, remaining)
+            data = self.fileobj.read(size)
+            if not data:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+    def close(self):
+        self.fileobj.close()
+
+
+def _is_file_body(body, environ):
+    # 文件响应体直接交给服务输出，以便服务使用 sendfile
+    if isinstance(body, FileBody):
+        return True
+    wrapper = environ.get('wsgi.file_wrapper')
+    return isinstance(wrapper, type) and isinstance(body, wrapper)
+
+
+def _parse_range(value, size):
+    # 解析单个 Range: bytes=start-end，返回 (start, end)
+    # 无法解析或包含多个区间时返回 None，按完整文件响应；超出文件大小时抛出 ValueError
+    if not value or not value.startswith('bytes=') or ',' in value:
+        return None
+    start, sep, end = value[6:].strip().partition('-')
+    if not sep:
+        return None
+    start, end = start.strip(), end.strip()
+    if not start and not end:
+        return None
+    if start and not start.isdigit() or end and not end.isdigit():
+        return None
+    start = int(start) if start else None
+    end = int(end) if end else None
+    if start is not None and end is not None and start > end:
+        return None
+    if size == 0:
+        # 空文件没有可满足的区间
+        raise ValueError('Range not satisfiable')
+    if start is None:
+        # bytes=-500 最后 500 字节
+        if end == 0:
+            raise ValueError('Range not satisfiable')
+        return max(size - end, 0), size - 1
+    if start >= size:
+        raise ValueError('Range not satisfiable')
+    return start, size - 1 if end is None else min(end, size - 1)
+
+
+def render_html(path, content, stream=False, flush_size=None):
+    # stream=True 时返回分块生成器，由 application 直接作为 WSGI body 输出
     request = ctx.request
     content.update({'request': request})
     ctx.response.content_type = 'text/html; charset=utf-8'
-    return render(path, content)
+    return render(path, content, stream, flush_size)
 
 
 def render_json(content):
@@ -69,65 +269,426 @@ def url_for(re_path, groups):
     return re_path
 
 
+# 204/304 响应中去掉的头
+_ENTITY_HEADERS = ('Content-Type', 'Content-Length', 'Content-Encoding', 'Content-Language',
+                   'Content-Range', 'Content-Disposition')
+
+# 带内容指纹的文件名 如 app.3f2a9c1b5d7e9f01.js，指纹为 '.' 分隔的至少 16 位十六进制数，
+# 避免 report-20240101.css 等带日期、版本号的文件被当作指纹文件
+FINGERPRINT = r'\.[0-9a-fA-F]{16,}\.\w+$'
+
+# 指纹文件的缓存时间 一年
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def _etag_match(header, etag):
+    # If-None-Match 使用弱比较
+    if header.strip() == '*':
+        return True
+    etag = etag[2:] if etag.startswith('W/') else etag
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+# 预压缩文件的编码及扩展名，按优先顺序
+_PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
+# 可压缩的内容类型，图片、压缩包等已压缩的内容不再压缩
+_COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/x-javascript', 'application/json',
+                       'application/xml', 'application/xhtml+xml', 'application/wasm', 'image/svg+xml',
+                       'image/x-icon', 'image/vnd.microsoft.icon', 'image/bmp', 'font/ttf', 'font/otf')
+
+
+def _compressible(content_type):
+    return bool(content_type) and content_type.lower().startswith(_COMPRESSIBLE_TYPES)
+
+
+def _accept_encodings(value):
+    # 解析 Accept-Encoding，返回 {coding: q}
+    encodings = {}
+    for item in (value or '').split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, v = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        encodings[coding] = q
+    return encodings
+
+
+def _choose_encoding(value, available):
+    # 从 available 中选择客户端接受的编码，q 值相同时按 available 的顺序，都不接受时返回 None
+    if not value:
+        return None
+    accepted = _accept_encodings(value)
+    best, best_q = None, 0
+    for coding in available:
+        q = accepted.get(coding, accepted.get('*', 0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def _gzip(data, level=9):
+    # mtime 固定为 0，相同内容生成相同的文件
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class _StaticFile(object):
+    # 静态文件的元数据，不超过 cache_size 的文件同时缓存内容
+    # variants: 同名的预压缩文件 {'br': _StaticFile, 'gzip': _StaticFile}
+    __slots__ = ('path', 'mtime', 'size', 'etag', 'last_modified', 'content_type', 'data', 'variants')
+
+    def __init__(self, path, st, data=None, suffix=''):
+        self.path = path
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        self.etag = '"%x-%x%s"' % (int(st.st_mtime * 1000000), st.st_size, suffix)
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+        fext = os.path.splitext(path)[1]
+        self.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
+        self.data = data
+        self.variants = {}
+
+
+def _parse_http_date(value):
+    # 返回时间戳，无法解析时返回 None
+    try:
+        parsed = parsedate_tz(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
+
+
 class StaticMiddleware():
-    def __init__(self, app):
+    # /static 下的文件由 static 目录直接输出
+    # 文件逐块输出，支持 Range 请求 (206/416)
+    # 由文件的 mtime 和大小生成 ETag/Last-Modified，条件请求命中时返回 304
+    # max_age: 默认的缓存秒数，None 为不设置 Cache-Control
+    # cache_control: 按扩展名设置缓存秒数 {'.css': 86400, '.png': 604800}
+    # immutable: 带内容指纹的文件名使用一年的 immutable 缓存，默认关闭
+    # fingerprint: 匹配指纹文件名的正则，默认见 FINGERPRINT
+    # 文件的元数据保存在 LRU 缓存中，mtime 或大小变化时重新加载:
+    # cache_entries: 缓存的文件数  cache_size: 不超过该字节数的文件内容也缓存在内存中，0 为不缓存内容
+    # 存在同名的 .br/.gz 文件时按 Accept-Encoding 输出压缩后的文件
+    # precompress: 启动时为可压缩的文件生成 .gz (及安装了 brotli 时的 .br) 文件
+    block_size = 65536
+    # 小于该字节数的文件不预压缩
+    compress_min_size = 256
+
+    def __init__(self, app, prefix='/static', directory='static', max_age=None, cache_control=None,
+                 immutable=False, fingerprint=FINGERPRINT, cache_entries=256, cache_size=65536,
+                 precompress=False):
         self.app = app
+        self.prefix = prefix
+        self.directory = directory
+        self.max_age = max_age
+        self.cache_control = {}
+        self.immutable = immutable
+        self.fingerprint = re.compile(fingerprint)
+        self.cache_size = cache_size
+        self.precompress = precompress
+        self.files = LRUCache(cache_entries)
+        if cache_control:
+            self.configure(cache_control=cache_control)
+
+    def configure(self, prefix=None, directory=None, max_age=None, cache_control=None, immutable=None,
+                  fingerprint=None, cache_entries=None, cache_size=None, precompress=None):
+        # 见 settings 的 static 配置
+        if prefix is not None:
+            self.prefix = prefix.rstrip('/')
+        if directory is not None:
+            self.directory = directory
+            self.files.clear()
+        if max_age is not None:
+            self.max_age = max_age
+        if cache_control is not None:
+            self.cache_control = dict((ext.lower() if ext.startswith('.') else '.' + ext.lower(), age)
+                                      for ext, age in cache_control.items())
+        if immutable is not None:
+            self.immutable = immutable
+        if fingerprint is not None:
+            self.fingerprint = re.compile(fingerprint)
+        if cache_entries is not None:
+            self.files = LRUCache(cache_entries)
+        if cache_size is not None:
+            self.cache_size = cache_size
+            self.files.clear()
+        if precompress is not None:
+            self.precompress = precompress
+
+    def _cache_header(self, fpath):
+        name = os.path.basename(fpath)
+        if self.immutable and self.fingerprint.search(name):
+            return 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+        max_age = self.cache_control.get(os.path.splitext(name)[1].lower(), self.max_age)
+        if max_age is None:
+            return None
+        if max_age <= 0:
+            return 'no-cache'
+        return 'public, max-age=%d' % max_age
+
+    def _not_modified(self, request, etag, mtime):
+        # If-None-Match 优先于 If-Modified-Since
+        if_none_match = request.header('If-None-Match')
+        if if_none_match is not None:
+            return _etag_match(if_none_match, etag)
+        since = request.header('If-Modified-Since')
+        if since:
+            timestamp = _parse_http_date(since)
+            return timestamp is not None and int(mtime) <= timestamp
+        return False
+
+    def _range_allowed(self, request, etag, last_modified):
+        # If-Range 与当前文件不一致时返回完整文件
+        if_range = request.header('If-Range')
+        return not if_range or if_range.strip() in (etag, last_modified)
 
     def __call__(self, *args, **kwargs):
         request = ctx.request
         path = request.path_info
         if path == '/favicon.ico/':
-            path = '/static/favicon.ico'
-        if path.startswith('/static'):
-            fpath = _to_str('.' + path)
-            if not os.path.isfile(fpath):
-                raise notfound()
+            path = self.prefix + '/favicon.ico'
+        if path == self.prefix or path.startswith(self.prefix + '/'):
+            return self.serve(_to_str(path[len(self.prefix) + 1:]))
+        return self.app()
+
+    def _file_path(self, name):
+        # 返回 static 目录下的文件路径，不允许通过 .. 访问目录之外的文件
+        root = os.path.abspath(self.directory)
+        fpath = os.path.normpath(os.path.join(root, name))
+        if not fpath.startswith(root + os.sep):
+            raise notfound()
+        return fpath
+
+    def serve(self, name):
+        fpath = self._file_path(name)
+        try:
+            st = os.stat(fpath)
+        except (IOError, OSError):
+            raise notfound()
+        if not stat.S_ISREG(st.st_mode):
+            raise notfound()
+        entry = self.files.get(fpath)
+        if entry is None or entry.mtime != st.st_mtime or entry.size != st.st_size:
+            entry = self._load(fpath, st)
+        encoding = self._encoding(entry)
+        if encoding is not None and not self._current(entry.variants[encoding]):
+            # 预压缩文件被删除或重新生成，重新加载
+            entry = self._load(fpath, st)
+            encoding = self._encoding(entry)
+        return self._respond(entry, encoding)
+
+    def _load(self, fpath, st):
+        # 加载文件及其预压缩文件的元数据并放入缓存
+        try:
+            entry = self._entry(fpath, st)
+        except (IOError, OSError):
+            raise notfound()
+        for encoding, ext in _PRECOMPRESSED:
+            try:
+                vst = os.stat(fpath + ext)
+                # 早于原文件的压缩文件已过期
+                if stat.S_ISREG(vst.st_mode) and vst.st_mtime >= entry.mtime:
+                    entry.variants[encoding] = self._entry(fpath + ext, vst, '-' + encoding)
+            except (IOError, OSError):
+                pass
+        self.files.set(fpath, entry)
+        return entry
+
+    def _entry(self, fpath, st, suffix=''):
+        if not 0 < st.st_size <= self.cache_size:
+            return _StaticFile(fpath, st, None, suffix)
+        with open(fpath, 'rb') as f:
+            data = f.read()
+            # 以读取时的文件信息为准
+            st = os.fstat(f.fileno())
+        if len(data) != st.st_size:
+            return _StaticFile(fpath, st, None, suffix)
+        return _StaticFile(fpath, st, data, suffix)
+
+    def _encoding(self, entry):
+        # 按 Accept-Encoding 选择预压缩文件，返回编码，使用原文件时返回 None
+        if not entry.variants:
+            return None
+        return _choose_encoding(ctx.request.header('Accept-Encoding'),
+                                [coding for coding, ext in _PRECOMPRESSED if coding in entry.variants])
+
+    def _current(self, variant):
+        # 缓存的预压缩文件是否仍与磁盘上的文件一致
+        try:
+            st = os.stat(variant.path)
+        except (IOError, OSError):
+            return False
+        return st.st_mtime == variant.mtime and st.st_size == variant.size
+
+    def _respond(self, entry, encoding):
+        # 先判断 304/416 并打开文件，最后设置描述响应体的头，
+        # 出错时的 404/416 响应不会带有压缩文件的 Content-Encoding/Content-Length
+        request = ctx.request
+        response = ctx.response
+        representation = entry.variants[encoding] if encoding is not None else entry
+        etag = representation.etag
+        if self._not_modified(request, etag, entry.mtime):
+            self._set_headers(entry, representation, encoding)
+            response.status = 304
+            return ''
+        size = representation.size
+        try:
+            if self._range_allowed(request, etag, entry.last_modified):
+                byte_range = _parse_range(request.header('Range'), size)
             else:
-                fext = os.path.splitext(fpath)[1]
-                content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
+                byte_range = None
+        except ValueError:
+            e = HttpError(416)
+            e.header('Content-Range', 'bytes */%d' % size)
+            if entry.variants:
+                e.header('Vary', 'Accept-Encoding')
+            raise e
+        f = None
+        if representation.data is None:
+            try:
+                f = open(representation.path, 'rb')
+            except (IOError, OSError):
+                if encoding is None:
+                    raise notfound()
+                # 预压缩文件在读取前被删除，输出原文件
+                self.files.delete(entry.path)
+                return self._respond(entry, None)
+        self._set_headers(entry, representation, encoding)
+        response.set_header('Accept-Ranges', 'bytes')
+        if byte_range is not None:
+            start, end = byte_range
+            response.status = 206
+            response.set_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+            response.content_length = end - start + 1
+            if f is None:
+                return representation.data[start:end + 1]
+            return FileBody(f, start, end - start + 1, self.block_size)
+        response.status = 200
+        response.content_length = size
+        if f is None:
+            return representation.data
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            # 由服务输出文件，支持时使用 sendfile
+            return file_wrapper(f, self.block_size)
+        return FileBody(f, 0, size, self.block_size)
 
-                ctx.response.status = 200
-                ctx.response.set_header('CONTENT-TYPE', content_type)
-                return open(fpath, 'rb').read()
-        return self.app()
+    def _set_headers(self, entry, representation, encoding):
+        response = ctx.response
+        if entry.variants:
+            response.set_header('Vary', 'Accept-Encoding')
+        if encoding is not None:
+            response.set_header('Content-Encoding', encoding)
+        response.set_header('ETag', representation.etag)
+        response.set_header('Last-Modified', entry.last_modified)
+        cache_header = self._cache_header(entry.path)
+        if cache_header:
+            response.set_header('Cache-Control', cache_header)
+        response.content_type = entry.content_type
+
+    def _walk(self):
+        # static 目录下的文件，不包括预压缩文件
+        for root, dirs, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(tuple(ext for coding, ext in _PRECOMPRESSED)):
+                    yield os.path.join(root, name)
+
+    def preload(self):
+        # 预先加载文件到缓存，prefork 时工作进程共享这些内存
+        if not os.path.isdir(self.directory):
+            return
+        for count, path in enumerate(self._walk()):
+            if count >= self.files.maxsize:
+                break
+            fpath = os.path.abspath(path)
+            try:
+                self._load(fpath, os.stat(fpath))
+            except HttpError:
+                pass
+
+    def compress_files(self):
+        # 为可压缩的文件生成 .gz/.br 文件，已存在且不早于原文件时跳过
+        # 只保留比原文件小的压缩结果，返回生成的文件数
+        if not os.path.isdir(self.directory):
+            return 0
+        compressors = [('.gz', _gzip)]
+        if brotli is not None:
+            compressors.append(('.br', brotli.compress))
+        count = 0
+        for path in self._walk():
+            fext = os.path.splitext(path)[1]
+            if not _compressible(mimetypes.types_map.get(fext.lower())):
+                continue
+            st = os.stat(path)
+            if st.st_size < self.compress_min_size:
+                continue
+            data = None
+            for ext, compress in compressors:
+                target = path + ext
+                if os.path.isfile(target) and os.stat(target).st_mtime >= st.st_mtime:
+                    continue
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                compressed = compress(data)
+                if len(compressed) >= len(data):
+                    continue
+                # 写入临时文件后改名，不会读到写了一半的文件
+                tmp = '%s.%d.tmp' % (target, os.getpid())
+                with open(tmp, 'wb') as f:
+                    f.write(compressed)
+                os.rename(tmp, target)
+                count += 1
+        self.files.clear()
+        return count
 
 
 class Route(object):
     # 路由处理类
     def __init__(self, startpath=''):
         self.startpath = startpath
-        self._get_static = {}
-        self._post_static = {}
-        self._get_dynamic = {}
-        self._post_dynamic = {}
+        # [(method, path, func)]
+        self.routes = []
 
     def route(self, path, method=None):
         # 路由装饰器 根据路由及请求方式保存其对应关系
+        # 注册了 GET 的路由自动响应 HEAD，OPTIONS 及 405 由 application 自动处理
         if not method:
             method = ['GET', 'POST']
+        elif isinstance(method, (bytes, unicode)):
+            method = [method]
 
         def _decorator(func):
             allpath = self.startpath + path
             func.path = allpath
-            is_static = _re_route.search(allpath) is None
-            if is_static:
-                # 静态路由直接保存
-                if 'GET' in method:
-                    self._get_static[allpath] = func
-                if 'POST' in method:
-                    self._post_static[allpath] = func
-            else:
-                # 动态路由需正则转换
-                if 'GET' in method:
-                    re_path = re.compile(_build_regex(allpath))
-                    self._get_dynamic[re_path] = func
-                if 'POST' in method:
-                    re_path = re.compile(_build_regex(allpath))
-                    self._post_dynamic[re_path] = func
+            for m in method:
+                self.add_route(m.upper(), allpath, func)
             return func
 
         return _decorator
 
+    def add_route(self, method, path, func):
+        self.routes.append((method, path, func))
+
     def get(self, path):
         _decorator = self.route(path, ['GET'])
         return _decorator
@@ -136,21 +697,49 @@ class Route(object):
         _decorator = self.route(path, ['POST'])
         return _decorator
 
+    def put(self, path):
+        _decorator = self.route(path, ['PUT'])
+        return _decorator
+
+    def patch(self, path):
+        _decorator = self.route(path, ['PATCH'])
+        return _decorator
+
+    def delete(self, path):
+        _decorator = self.route(path, ['DELETE'])
+        return _decorator
+
 
 class WSGIApplication(Route):
-    def __init__(self, host='127.0.0.1', port=9000, debug=False, startpath=''):
+    def __init__(self, host='127.0.0.1', port=9000, debug=False, startpath='', router='trie', server='wsgiref'):
         super(WSGIApplication, self).__init__(startpath)
-        self.fn = StaticMiddleware(self.match)
+        self.router = ROUTERS[router]()
+        # 静态文件，可由 settings 的 static 配置
+        self.static = StaticMiddleware(self.match)
+        self.fn = self.static
         self.debug = debug
         self.host = host
         self.port = port
+        # runserver 使用的服务 'wsgiref' 或 'asyncio'，及其参数
+        self.server = server
+        self.server_options = {}
+        self._asgi = None
+
+    def add_route(self, method, path, func):
+        super(WSGIApplication, self).add_route(method, path, func)
+        self.router.add(method, path, func)
+
+    def set_router(self, name):
+        # 切换路由实现 'trie' 或 'regex'，已注册的路由重新加入
+        router = ROUTERS[name]()
+        for method, path, func in self.routes:
+            router.add(method, path, func)
+        self.router = router
 
     def register(self, route):
         # Route路由表注册
-        self._get_static.update(route._get_static)
-        self._post_static.update(route._post_static)
-        self._get_dynamic.update(route._get_dynamic)
-        self._post_dynamic.update(route._post_dynamic)
+        for method, path, func in route.routes:
+            self.add_route(method, path, func)
 
     def interceptor(self, func):
         # 加载中间件
@@ -162,11 +751,19 @@ class WSGIApplication(Route):
         app = getattr(settings, 'app', ())
         middleware = getattr(settings, 'middleware', ())
         debug = getattr(settings, 'debug', False)
+        template = getattr(settings, 'template', None)
+        router = getattr(settings, 'router', None)
+        server = getattr(settings, 'server', None)
+        static = getattr(settings, 'static', None)
         setting_dict = {
             'database': database,
             'app': app,
             'middleware': middleware,
-            'debug': debug
+            'debug': debug,
+            'template': template,
+            'router': router,
+            'server': server,
+            'static': static
         }
         self.load_dict(setting_dict)
 
@@ -176,8 +773,39 @@ class WSGIApplication(Route):
         app_list = settings.get('app', ())
         middleware_list = settings.get('middleware', ())
         debug = settings.get('debug', False)
+        template = settings.get('template', None)
+        router = settings.get('router', None)
+        server = settings.get('server', None)
+        static = settings.get('static', None)
         # 建立数据库连接
         if database: create_engine(**database)
+        # 模版缓存配置 {'maxsize': 128, 'auto_reload': True, 'artifact_dir': 'template_cache'}
+        if template:
+            template_cache.configure(**template)
+            if template_cache.artifact_dir:
+                # 启动时加载预编译的模版
+                template_cache.preload()
+        # 静态文件 {'prefix': '/static', 'directory': 'static', 'max_age': 3600,
+        #           'cache_control': {'.css': 86400, '.png': 604800}, 'immutable': True,
+        #           'fingerprint': r'\.[0-9a-fA-F]{16,}\.\w+$',
+        #           'cache_entries': 256, 'cache_size': 65536, 'precompress': True}
+        if static:
+            self.static.configure(**static)
+            if self.static.precompress:
+                # 启动时生成预压缩文件
+                self.static.compress_files()
+        # 路由实现
+        if router: self.set_router(router)
+        # 服务 'asyncio' 或 {'mode': 'asyncio', 'threads': 32, 'keepalive_timeout': 5}
+        # 线程池 {'mode': 'threaded', 'threads': 16, 'backlog': 64, 'request_timeout': 30, 'header_timeout': 10}
+        # 多进程 {'mode': 'prefork', 'workers': 4, 'max_requests': 10000, 'worker': 'asyncio'}
+        if server:
+            if isinstance(server, dict):
+                server = dict(server)
+                self.server = server.pop('mode', self.server)
+                self.server_options = server
+            else:
+                self.server = server
         # 注册路由表
         for app in app_list:
             module_list = app.split('.')
@@ -201,30 +829,35 @@ class WSGIApplication(Route):
         request = ctx.request
         methods = request.request_method
         url = request.path_info
-        if methods == 'GET':
-            # 优先匹配静态路由
-            fn = self._get_static.get(url, None)
-            if fn:
-                return fn()
-            for re_path, fn in self._get_dynamic.items():
-                args = re_path.match(url)
-                if args:
-                    # 传参调用处理函数
-                    return fn(*(args.groups()))
-            raise notfound()
-        if methods == 'POST':
-            fn = self._post_static.get(url, None)
-            if fn:
-                return fn()
-            for re_path, fn in self._post_dynamic.items():
-                args = re_path.match(url)
-                if args:
-                    return fn(*(args.groups()))
+        # 静态路由优先，其次由 self.router 匹配动态路由
+        matched = self.router.match(methods, url)
+        if matched is None:
             raise notfound()
-        raise badrequest()
+        fn, args, allow = matched
+        if fn is None:
+            # 路径存在但未注册该请求方式
+            if methods == 'OPTIONS':
+                ctx.response.status = 204
+                ctx.response.set_header('Allow', allow)
+                return ''
+            raise methodnotallowed(allow)
+        # 传参调用处理函数
+        r = fn(*args)
+        if _iscoroutine(r) and not getattr(ctx, 'async_dispatch', False):
+            # async def 的处理函数，在事件循环中执行时由 ASGIAdapter 等待
+            r = _run_coroutine(r)
+        return r
+
+    def preload(self):
+        # 预先编译路由和模版，prefork 时在 fork 前调用，工作进程共享这些内存
+        self.router.compile()
+        if os.path.isdir(template_cache.template_dir):
+            template_cache.preload()
+        self.static.preload()
 
     def run(self):
-        if self.debug:
+        # prefork 需要在主线程中处理信号，不使用自动重启
+        if self.debug and self.server != 'prefork':
             self.reloader_run()
         else:
             self.runserver()
@@ -270,6 +903,26 @@ class WSGIApplication(Route):
                 sys.exit(exit_status)
 
     def runserver(self):
+        if self.server == 'prefork':
+            # 多进程服务，见 mwebapp.server
+            from mwebapp.server import PreforkServer
+            PreforkServer(self, self.host, self.port, **self.server_options).run()
+            return
+        if self.server == 'threaded':
+            # 线程池服务，见 mwebapp.server
+            from mwebapp.server import ThreadPoolWSGIServer
+            server = ThreadPoolWSGIServer(self.application, self.host, self.port, **self.server_options)
+            print('run threaded server on http://%s:%s' % (self.host, self.port))
+            server.serve_forever()
+            return
+        if self.server == 'asyncio':
+            # asyncio 的 HTTP/1.1 服务，见 mwebapp.aserver
+            from mwebapp.aserver import serve
+            options = dict(self.server_options)
+            options.pop('threads', None)
+            print('run asyncio server on http://%s:%s' % (self.host, self.port))
+            serve(self.asgi, self.host, self.port, **options)
+            return
         # 使用python内置的wsgi服务
         from wsgiref.simple_server import make_server
         server = make_server(self.host, self.port, self.application)
@@ -277,50 +930,111 @@ class WSGIApplication(Route):
         server.serve_forever()
 
     def application(self, environ, start_response):
-        ctx.request = Request(environ)
-        ctx.response = Response()
         responce_html = []
+        # 请求内共用一个数据库连接，第一次查询时才从连接池取出
+        db_ctx = self._begin(environ)
         # 请求处理
         try:
-            r = self.fn()
-            if not r:
-                raise ValueError('View function did not return a response')
-            r = _to_byte(r)
-            responce_html = [r]
-        except RedirectError as e:
+            responce_html = self._body(self.fn(), environ)
+        except Exception as e:
+            responce_html = self._error_body(e)
+        finally:
+            return self._finish(environ, start_response, db_ctx, responce_html)
+
+    def _begin(self, environ, async_dispatch=False):
+        # 建立请求上下文，返回请求使用的数据库连接作用域
+        # async_dispatch: 在事件循环中执行 async def 的处理函数，见 aserver.ASGIAdapter，
+        # 此时处理函数使用 db.aselect 等异步接口，不建立连接作用域
+        ctx.request = Request(environ)
+        ctx.response = Response()
+        ctx.async_dispatch = async_dispatch
+        if db.engine is None or async_dispatch:
+            return None
+        db_ctx = db.ConnectionCtx()
+        db_ctx.__enter__()
+        return db_ctx
+
+    def _body(self, r, environ):
+        if not r and ctx.response.status_code not in (204, 304):
+            raise ValueError('View function did not return a response')
+        if isinstance(r, (bytes, unicode)):
+            return [_to_byte(r)]
+        if _is_file_body(r, environ):
+            return r
+        # 生成器等可迭代对象直接作为 body，不在内存中拼接整页
+        return _iter_body(r)
+
+    def _error_body(self, e):
+        # 去掉处理函数出错前设置的 Content-Length/Content-Encoding 等描述原响应体的头
+        for name in _ENTITY_HEADERS + ('ETag', 'Last-Modified', 'Accept-Ranges'):
+            ctx.response.unset_header(name)
+        ctx.response.content_type = 'text/html; charset=utf-8'
+        if isinstance(e, RedirectError):
             # 重定向
             ctx.response.status = e.status
             ctx.response.set_header('Location', e.location)
-            responce_html = []
-        except HttpError as e:
+            return []
+        if isinstance(e, HttpError):
             # http error
             error = '<html><body><h1>' + e.status + '</h1></body></html>'
             error = _to_byte(error)
             ctx.response.status = e.status
-            responce_html = [error]
-        except Exception as e:
-            # 系统错误
-            if self.debug:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                exception_list = traceback.format_exception(exc_type, exc_value, exc_traceback)
-                stacks = ''.join(exception_list)
-                error = '''<html><body><h1>500 Internal Server Error</h1>
-                            <div style="font-family:Monaco, Menlo, Consolas, 'Courier New', monospace;"><pre>''' \
-                        + stacks.replace('<', '&lt;').replace('>', '&gt;') + '''</pre></div></body></html>'''
-            else:
-                error = '<html><body><h1>500 Internal Server Error</h1></body></html>'
-            error = _to_byte(error)
-            ctx.response.status = 500
-            responce_html = [error]
-        finally:
-            # 返回处理结果
-            status = ctx.response.status
-            headers = ctx.response.headers
-            start_response(status, headers)
-            # 清空ctx
-            del ctx.request
-            del ctx.response
-            return responce_html
+            for name, value in e.headers:
+                if (name, value) != _HEADER_X_POWERED_BY:
+                    ctx.response.set_header(name, value)
+            return [error]
+        # 系统错误
+        if self.debug:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            exception_list = traceback.format_exception(exc_type, exc_value, exc_traceback)
+            stacks = ''.join(exception_list)
+            error = '''<html><body><h1>500 Internal Server Error</h1>
+                        <div style="font-family:Monaco, Menlo, Consolas, 'Courier New', monospace;"><pre>''' \
+                    + stacks.replace('<', '&lt;').replace('>', '&gt;') + '''</pre></div></body></html>'''
+        else:
+            error = '<html><body><h1>500 Internal Server Error</h1></body></html>'
+        error = _to_byte(error)
+        ctx.response.status = 500
+        return [error]
+
+    def _finish(self, environ, start_response, db_ctx, responce_html):
+        if ctx.response.status_code in (204, 304):
+            # 204/304 没有响应体，去掉默认的 Content-Type 等描述响应体的头
+            for name in _ENTITY_HEADERS:
+                ctx.response.unset_header(name)
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            # HEAD 请求丢弃响应体，保留与 GET 相同的 Content-Length
+            if isinstance(responce_html, list) and ctx.response.content_length is None and \
+                    ctx.response.status_code not in (204, 304):
+                ctx.response.content_length = sum(map(len, responce_html))
+            _close_body(responce_html)
+            responce_html = []
+        # 返回处理结果
+        status = ctx.response.status
+        headers = ctx.response.headers
+        start_response(status, headers)
+        if not isinstance(responce_html, list) and not _is_file_body(responce_html, environ):
+            # 流式响应体输出完并关闭后再归还连接、清空 ctx
+            return _ScopedBody(responce_html, db_ctx)
+        # 归还请求使用的数据库连接
+        if db_ctx is not None:
+            db_ctx.__exit__(None, None, None)
+        # 清空ctx
+        _clear_ctx()
+        return responce_html
+
+    def is_async(self, environ):
+        # 请求是否由 async def 的处理函数处理，ASGI 服务据此在事件循环中直接执行
+        # 按中间件处理前的路径匹配，由中间件改写路径的请求仍在线程池中执行
+        matched = self.router.match(environ.get('REQUEST_METHOD'), Request(environ).path_info)
+        return matched is not None and _iscoroutinefunction(matched[0])
+
+    def asgi(self, scope, receive, send):
+        # ASGI 入口，如 uvicorn main:app.asgi
+        if self._asgi is None:
+            from mwebapp.aserver import ASGIAdapter
+            self._asgi = ASGIAdapter(self, self.server_options.get('threads'))
+        return self._asgi(scope, receive, send)
 
     def __call__(self, *args, **kwargs):
         return self.application(*args, **kwargs)
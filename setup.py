@@ -11,6 +11,9 @@ setup(
     packages=find_packages(),
     description='Web framework written by self practice',
     install_requires=['mysql-connector'],
+    entry_points={
+        'console_scripts': ['mweb-precompile=mwebapp.template_engine:main'],
+    },
     classifiers=[
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python',
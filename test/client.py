@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+# 测试用的 WSGI 客户端，不启动服务直接调用 application
+# connect 及 read_response 用于测试启动的服务，可以发送任意字节，如 pipelining 的多个请求
+import io
+import socket
+from wsgiref.util import setup_testing_defaults
+
+
+class TestResponse(object):
+    def __init__(self, status, headers, chunks):
+        self.status = status
+        self.status_code = int(status[:3])
+        self.headers = dict((name.lower(), value) for name, value in headers)
+        # 响应体的各块，未合并
+        self.chunks = chunks
+        self.body = b''.join(chunks)
+
+    def header(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+
+def call(app, path, method='GET', headers=None, body=b''):
+    path, _, query = path.partition('?')
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+    }
+    for name, value in (headers or {}).items():
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        environ[key] = value
+    setup_testing_defaults(environ)
+    result = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        result['status'] = status
+        result['headers'] = response_headers
+
+    body = app(environ, start_response)
+    try:
+        chunks = list(body)
+    finally:
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+    return TestResponse(result['status'], result['headers'], chunks)
+
+
+def connect(port, timeout=5):
+    # 返回 (socket, 读取用的文件)
+    sock = socket.create_connection(('127.0.0.1', port), timeout)
+    return sock, sock.makefile('rb')
+
+
+def request(method, path, headers=None, body=b'', version='HTTP/1.1'):
+    # 生成请求的字节，headers 为 [(name, value)]
+    lines = ['%s %s %s' % (method, path, version), 'Host: localhost']
+    lines.extend('%s: %s' % (name, value) for name, value in (headers or []))
+    if body and not any(name.lower() in ('content-length', 'transfer-encoding') for name, value in headers or []):
+        lines.append('Content-Length: %d' % len(body))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+def read_response(rfile, head=False):
+    # 读取一个响应，连接已关闭时返回 None；1xx 响应单独返回
+    line = rfile.readline()
+    if not line:
+        return None
+    status = line.decode('latin-1').split(' ', 1)[1].rstrip('\r\n')
+    headers = []
+    while True:
+        line = rfile.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers.append((name.strip(), value.strip()))
+    response = TestResponse(status, headers, [])
+    code = response.status_code
+    chunks = []
+    if head or code < 200 or code in (204, 304):
+        pass
+    elif 'chunked' in response.header('Transfer-Encoding', '').lower():
+        while True:
+            size = int(rfile.readline().split(b';')[0], 16)
+            if not size:
+                # 没有 trailer
+                rfile.readline()
+                break
+            chunks.append(rfile.read(size))
+            rfile.readline()
+    elif response.header('Content-Length') is not None:
+        chunks.append(rfile.read(int(response.header('Content-Length'))))
+    else:
+        # 以关闭连接标识响应结束
+        chunks.append(rfile.read())
+    return TestResponse(status, headers, chunks)
+
+
+def chunked(*chunks):
+    # chunked 编码的请求体
+    return b''.join(b'%x\r\n%s\r\n' % (len(chunk), chunk) for chunk in chunks) + b'0\r\n\r\n'
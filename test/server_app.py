@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+# 服务测试使用的应用
+import os
+import time
+
+from mwebapp.webapp import WSGIApplication, ctx
+
+
+def make_app():
+    app = WSGIApplication()
+
+    @app.get('/hello/')
+    def hello():
+        return 'hello'
+
+    @app.post('/echo/')
+    def echo():
+        return 'echo:' + ctx.request.get_body().decode('utf-8')
+
+    @app.get('/stream/')
+    def stream():
+        for chunk in ('a', 'b', 'c'):
+            yield chunk
+
+    @app.get('/sleep/:seconds/')
+    def sleep(seconds):
+        time.sleep(float(seconds))
+        return 'slept'
+
+    @app.get('/pid/')
+    def pid():
+        return str(os.getpid())
+
+    return app
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+# mwebapp.adb 需要 python 3.5+
+import asyncio
+import contextvars
+import os
+import shutil
+import tempfile
+import unittest
+
+from mwebapp import adb, db
+
+from models import User
+
+
+def _reset_engine():
+    if db.engine is not None:
+        db.engine.pool.close()
+    db.engine = None
+
+
+class AsyncDbTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        _reset_engine()
+        db.create_engine(database=os.path.join(self.tmp, 'test.db'), driver='sqlite3')
+        db.update(User().__sql__())
+        db.update('create table t (id integer primary key, name text)')
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        if adb._executor is not None:
+            adb._executor.shutdown()
+            adb._executor = None
+        _reset_engine()
+        shutil.rmtree(self.tmp)
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def count(self):
+        return db.select_int('select count(*) from t')
+
+    def test_select_and_update(self):
+        async def main():
+            await db.ainsert('t', id=1, name='a')
+            await db.ainsert_many('t', [dict(id=2, name='b'), dict(id=3, name='c')])
+            self.assertEqual(await db.aupdate("update t set name='x' where id>?", 1), 2)
+            # 作用域外的调用各自取一个连接，可以并发执行
+            return await asyncio.gather(db.aselect('select * from t order by id'),
+                                        db.aselect_one('select name from t where id=?', 3),
+                                        db.aselect_int('select count(*) from t'))
+        rows, row, count = self.run_async(main())
+        self.assertEqual([r.name for r in rows], ['a', 'x', 'x'])
+        self.assertEqual(row.name, 'x')
+        self.assertEqual(count, 3)
+
+    def test_db_exports(self):
+        # 先导入 adb 时 db 中同样有 asyncio 接口
+        self.assertIs(db.aselect, adb.aselect)
+        self.assertIs(db.atransaction, adb.atransaction)
+
+    def test_contextvars(self):
+        var = contextvars.ContextVar('var')
+
+        async def main():
+            var.set('request')
+            return await db.arun(var.get)
+        self.assertEqual(self.run_async(main()), 'request')
+
+    def test_connection_is_shared(self):
+        checkouts = db.pool_stats()['checkouts']
+
+        async def main():
+            async with db.aconnection():
+                await asyncio.gather(*[db.ainsert('t', id=i, name='n') for i in range(5)])
+                return await db.aselect_int('select count(*) from t')
+        self.assertEqual(self.run_async(main()), 5)
+        self.assertEqual(db.pool_stats()['checkouts'], checkouts + 1)
+        self.assertEqual(db.pool_stats()['in_use'], 0)
+        # 工作线程恢复为未建立连接的状态
+        self.assertFalse(self.run_async(db.arun(db._db_ctx.is_init)))
+
+    def test_transaction_rollback(self):
+        async def main():
+            async with db.atransaction():
+                await db.ainsert('t', id=1, name='a')
+                self.assertEqual(await db.aselect_int('select count(*) from t'), 1)
+                raise ValueError()
+        self.assertRaises(ValueError, self.run_async, main())
+        self.assertEqual(self.count(), 0)
+        self.assertEqual(db.pool_stats()['in_use'], 0)
+
+    def test_nested_transaction(self):
+        async def inner():
+            async with db.atransaction():
+                await db.ainsert('t', id=2, name='inner')
+                raise ValueError()
+
+        async def main():
+            async with db.atransaction():
+                await db.ainsert('t', id=1, name='outer')
+                try:
+                    await inner()
+                except ValueError:
+                    pass
+        self.run_async(main())
+        # 内层回滚到 savepoint，外层提交
+        self.assertEqual(db.select('select name from t'), [dict(name='outer')])
+
+    def test_model_aget(self):
+        User(id=1, name='a', email='e').insert()
+        user = self.run_async(User.aget(1))
+        self.assertEqual((user.id, user.name), (1, 'a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+# mwebapp.aserver 需要 python 3.7+，服务在后台线程的事件循环中运行，监听系统分配的端口
+import asyncio
+import socket
+import threading
+import time
+import unittest
+
+from mwebapp.aserver import HTTPServer
+
+from client import connect, request, read_response, chunked
+from server_app import make_app
+
+
+class AsyncServerTestCase(unittest.TestCase):
+    server_options = {}
+
+    def setUp(self):
+        self.app = make_app()
+        self.loop = asyncio.new_event_loop()
+        self.server = HTTPServer(self.app.asgi, '127.0.0.1', 0, **self.server_options)
+        self.loop.run_until_complete(self.server.start())
+        self.port = self.server.server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        if not self.server.closing:
+            self.shutdown(5).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.app._asgi.executor.shutdown()
+
+    def shutdown(self, timeout):
+        return asyncio.run_coroutine_threadsafe(self.server.shutdown(timeout), self.loop)
+
+    def connect(self):
+        sock, rfile = connect(self.port)
+        self.sockets.append(sock)
+        return sock, rfile
+
+
+class HTTPServerTest(AsyncServerTestCase):
+    def test_keep_alive(self):
+        sock, rfile = self.connect()
+        for i in range(3):
+            sock.sendall(request('GET', '/hello/'))
+            r = read_response(rfile)
+            self.assertEqual((r.status_code, r.body), (200, b'hello'))
+            self.assertIsNone(r.header('Connection'))
+        sock.sendall(request('GET', '/hello/', [('Connection', 'close')]))
+        self.assertEqual(read_response(rfile).header('Connection'), 'close')
+        self.assertIsNone(read_response(rfile))
+
+    def test_http10(self):
+        sock, rfile = self.connect()
+        sock.sendall(request('GET', '/hello/', version='HTTP/1.0'))
+        self.assertEqual(read_response(rfile).header('Connection'), 'close')
+        self.assertIsNone(read_response(rfile))
+        sock, rfile = self.connect()
+        sock.sendall(request('GET', '/hello/', [('Connection', 'keep-alive')], version='HTTP/1.0'))
+        self.assertEqual(read_response(rfile).header('Connection'), 'keep-alive')
+
+    def test_pipelining(self):
+        sock, rfile = self.connect()
+        # 一次发送多个请求，按顺序响应
+        sock.sendall(request('GET', '/sleep/0.2/') + request('POST', '/echo/', body=b'x') +
+                     request('GET', '/stream/') + request('HEAD', '/hello/'))
+        bodies = [read_response(rfile).body for i in range(3)]
+        self.assertEqual(bodies, [b'slept', b'echo:x', b'abc'])
+        r = read_response(rfile, head=True)
+        self.assertEqual((r.status_code, r.header('Content-Length')), (200, '5'))
+        sock.sendall(request('GET', '/hello/'))
+        self.assertEqual(read_response(rfile).body, b'hello')
+
+    def test_chunked_request(self):
+        sock, rfile = self.connect()
+        sock.sendall(request('POST', '/echo/', [('Transfer-Encoding', 'chunked')], chunked(b'ab', b'cde')))
+        self.assertEqual(read_response(rfile).body, b'echo:abcde')
+        # 连接保持可用
+        sock.sendall(request('GET', '/hello/'))
+        self.assertEqual(read_response(rfile).body, b'hello')
+
+    def test_chunked_response(self):
+        sock, rfile = self.connect()
+        sock.sendall(request('GET', '/stream/'))
+        r = read_response(rfile)
+        self.assertEqual(r.header('Transfer-Encoding'), 'chunked')
+        self.assertIsNone(r.header('Content-Length'))
+        self.assertEqual(r.chunks, [b'a', b'b', b'c'])
+        # HTTP/1.0 不支持 chunked，以关闭连接标识响应结束
+        sock, rfile = self.connect()
+        sock.sendall(request('GET', '/stream/', version='HTTP/1.0'))
+        r = read_response(rfile)
+        self.assertIsNone(r.header('Transfer-Encoding'))
+        self.assertEqual(r.header('Connection'), 'close')
+        self.assertEqual(r.body, b'abc')
+
+    def test_expect_continue(self):
+        sock, rfile = self.connect()
+        sock.sendall(request('POST', '/echo/', [('Expect', '100-continue'), ('Content-Length', '4')]))
+        # 收到 100 Continue 后再发送请求体
+        self.assertEqual(read_response(rfile).status_code, 100)
+        sock.sendall(b'body')
+        self.assertEqual(read_response(rfile).body, b'echo:body')
+
+    def test_bad_request(self):
+        sock, rfile = self.connect()
+        sock.sendall(b'GARBAGE\r\n\r\n')
+        r = read_response(rfile)
+        self.assertEqual((r.status_code, r.header('Connection')), (400, 'close'))
+        self.assertIsNone(read_response(rfile))
+
+    def test_graceful_shutdown(self):
+        busy, busy_rfile = self.connect()
+        busy.sendall(request('GET', '/sleep/0.5/'))
+        idle, idle_rfile = self.connect()
+        idle.sendall(request('GET', '/hello/'))
+        read_response(idle_rfile)
+        time.sleep(0.1)
+        future = self.shutdown(5)
+        # 空闲连接被关闭，进行中的请求处理完后关闭连接
+        self.assertIsNone(read_response(idle_rfile))
+        r = read_response(busy_rfile)
+        self.assertEqual((r.body, r.header('Connection')), (b'slept', 'close'))
+        future.result(5)
+        self.assertRaises(socket.error, connect, self.port)
+
+    def test_lifespan_shutdown(self):
+        executor = self.app._asgi.executor
+        self.shutdown(5).result(10)
+        # 应用收到 lifespan.shutdown 后关闭线程池
+        self.assertTrue(self.server._lifespan.done())
+        self.assertRaises(RuntimeError, executor.submit, len, '')
+
+
+class BodyLimitTest(AsyncServerTestCase):
+    server_options = {'max_body': 10}
+
+    def test_content_length(self):
+        sock, rfile = self.connect()
+        sock.sendall(request('POST', '/echo/', body=b'x' * 10))
+        self.assertEqual(read_response(rfile).body, b'echo:' + b'x' * 10)
+        sock.sendall(request('POST', '/echo/', [('Content-Length', '11')]))
+        r = read_response(rfile)
+        self.assertEqual((r.status_code, r.header('Connection')), (413, 'close'))
+
+    def test_chunked(self):
+        sock, rfile = self.connect()
+        sock.sendall(request('POST', '/echo/', [('Transfer-Encoding', 'chunked')], chunked(b'x' * 6, b'x' * 6)))
+        self.assertEqual(read_response(rfile).status_code, 413)
+
+
+class KeepAliveTimeoutTest(AsyncServerTestCase):
+    server_options = {'keepalive_timeout': 0.3}
+
+    def test_idle_connection_closed(self):
+        sock, rfile = self.connect()
+        sock.sendall(request('GET', '/hello/'))
+        read_response(rfile)
+        start = time.time()
+        self.assertIsNone(read_response(rfile))
+        self.assertLess(time.time() - start, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
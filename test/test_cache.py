@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+import os
+import shutil
+import tempfile
+import unittest
+
+from mwebapp.cache import LRUCache, MemoryBackend, SqliteBackend, QueryCache, sql_tables
+
+
+class SqlTablesTest(unittest.TestCase):
+    def test_from_list(self):
+        self.assertEqual(sql_tables('select * from a, b as x, `c` where a.id=x.id'), ['a', 'b', 'c'])
+        self.assertEqual(sql_tables('select * from db.t1, db2.t2'), ['t1', 't2'])
+
+    def test_join(self):
+        self.assertEqual(sql_tables('select * from a join b on a.id=b.id left join c using (id)'), ['a', 'b', 'c'])
+
+    def test_subquery(self):
+        self.assertEqual(sql_tables('select * from (select id from inner_t) as s, o'), ['inner_t', 'o'])
+        self.assertEqual(sql_tables('select * from a where id in (select a_id from b)'), ['a', 'b'])
+
+    def test_string_literal(self):
+        # 字符串中的 from 不是表名
+        self.assertEqual(sql_tables("select * from t where name='from x' or name=\"join y\""), ['t'])
+
+    def test_write_statements(self):
+        self.assertEqual(sql_tables('update u set a=1 where id=2'), ['u'])
+        self.assertEqual(sql_tables('insert into log (a) values (1)'), ['log'])
+        self.assertEqual(sql_tables('delete from D where id=1'), ['d'])
+        self.assertEqual(sql_tables('select 1'), [])
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        # b 最久未使用
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=-1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 1)
+
+
+class QueryCacheTest(unittest.TestCase):
+    def backend(self):
+        return MemoryBackend()
+
+    def setUp(self):
+        self.cache = QueryCache(self.backend())
+
+    def test_hit(self):
+        key, value = self.cache.get('select * from t where id=?', [1])
+        self.assertIsNone(value)
+        self.cache.set(key, (['id'], [(1,)]))
+        # 空白不同的同一条语句共用缓存
+        self.assertEqual(self.cache.get('select *\n  from t where id=?', [1]), (key, (['id'], [(1,)])))
+        self.assertIsNone(self.cache.get('select * from t where id=?', [2])[1])
+        self.assertEqual(self.cache.stats(), dict(hits=1, misses=2))
+
+    def test_invalidate(self):
+        key = self.cache.get('select * from a join b on a.id=b.id', [])[0]
+        self.cache.set(key, 'value')
+        self.assertEqual(self.cache.invalidate('update c set x=1'), ['c'])
+        self.assertEqual(self.cache.get('select * from a join b on a.id=b.id', [])[1], 'value')
+        self.assertEqual(self.cache.invalidate('insert into b values (1)'), ['b'])
+        self.assertIsNone(self.cache.get('select * from a join b on a.id=b.id', [])[1])
+
+    def test_invalidate_tables(self):
+        key = self.cache.get('select * from a', [])[0]
+        self.cache.set(key, 'value')
+        self.cache.invalidate_tables(set(['a']))
+        self.assertIsNone(self.cache.get('select * from a', [])[1])
+
+
+class SqliteBackendQueryCacheTest(QueryCacheTest):
+    def backend(self):
+        self.tmp = tempfile.mkdtemp()
+        return SqliteBackend(os.path.join(self.tmp, 'cache.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,552 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+# python -m pytest test
+# mysql 的用例使用 settings.database 连接本地的测试库，无法连接时跳过
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from mwebapp import db
+from mwebapp.cache import QueryCache
+from mwebapp.drivers import MySQLConnectorDriver, SqliteDriver
+
+import settings
+
+
+def _reset_engine():
+    if db.engine is not None:
+        for pool in [db.engine.pool] + db.engine.replica_pools:
+            pool.close()
+    db.engine = None
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.closed = False
+        self.rollbacks = 0
+        self.alive = True
+
+    def ping(self):
+        if not self.alive:
+            raise IOError('gone away')
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def pool(self, **kw):
+        self.connections = []
+
+        def connect():
+            connection = FakeConnection()
+            self.connections.append(connection)
+            return connection
+
+        return db.ConnectionPool(connect, **kw)
+
+    def test_min_size(self):
+        pool = self.pool(min_size=2, max_size=3)
+        self.assertEqual(len(self.connections), 2)
+        self.assertEqual(pool.stats()['idle'], 2)
+        self.assertRaises(ValueError, self.pool, min_size=2, max_size=1)
+        self.assertRaises(ValueError, self.pool, max_size=0)
+
+    def test_reuse(self):
+        pool = self.pool()
+        pooled = pool.acquire()
+        pool.release(pooled)
+        self.assertIs(pool.acquire(), pooled)
+        self.assertEqual(len(self.connections), 1)
+        # 归还时回滚未提交的事务
+        self.assertEqual(pooled.connection.rollbacks, 1)
+
+    def test_timeout(self):
+        pool = self.pool(max_size=1, timeout=0.1)
+        pool.acquire()
+        start = time.time()
+        self.assertRaises(db.PoolTimeoutError, pool.acquire)
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        stats = pool.stats()
+        self.assertEqual((stats['waits'], stats['timeouts'], stats['in_use']), (1, 1, 1))
+
+    def test_wait_for_release(self):
+        pool = self.pool(max_size=1, timeout=5)
+        pooled = pool.acquire()
+        timer = threading.Timer(0.05, pool.release, (pooled,))
+        timer.start()
+        self.assertIs(pool.acquire(), pooled)
+        timer.join()
+        self.assertEqual(pool.stats()['waits'], 1)
+
+    def test_discard_frees_a_slot(self):
+        pool = self.pool(max_size=1, timeout=0.1)
+        pooled = pool.acquire()
+        pool.discard(pooled)
+        self.assertTrue(pooled.connection.closed)
+        self.assertIsNot(pool.acquire(), pooled)
+
+    def test_recycle(self):
+        pool = self.pool(recycle=0.05)
+        pooled = pool.acquire()
+        pool.release(pooled)
+        time.sleep(0.1)
+        self.assertIsNot(pool.acquire(), pooled)
+        self.assertTrue(pooled.connection.closed)
+        self.assertEqual(pool.stats()['closed'], 1)
+
+    def test_ping_failure(self):
+        pool = self.pool()
+        pooled = pool.acquire()
+        pool.release(pooled)
+        pooled.connection.alive = False
+        self.assertIsNot(pool.acquire(), pooled)
+        stats = pool.stats()
+        self.assertEqual((stats['ping_failures'], stats['created'], stats['size']), (1, 2, 1))
+
+    def test_thread_affinity(self):
+        pool = self.pool()
+        first = pool.acquire()
+        other = pool.acquire()
+        # 模拟另一个线程使用过的连接，且比当前线程的连接后归还
+        other.thread_id = -1
+        pool.release(first)
+        pool.release(other)
+        self.assertIs(pool.acquire(), first)
+        self.assertEqual(pool.stats()['thread_hits'], 1)
+        # 没有当前线程用过的连接时取最近归还的连接
+        self.assertIs(pool.acquire(), other)
+
+    def test_concurrent_counters(self):
+        pool = self.pool(max_size=4)
+
+        def worker():
+            for i in range(200):
+                pool.release(pool.acquire())
+
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = pool.stats()
+        self.assertEqual(stats['checkouts'], 1600)
+        self.assertEqual(stats['created'], len(self.connections))
+        self.assertEqual(stats['in_use'], 0)
+        self.assertLessEqual(stats['size'], 4)
+
+    def test_close(self):
+        pool = self.pool(min_size=2)
+        pool.close()
+        self.assertTrue(all(c.closed for c in self.connections))
+        self.assertEqual(pool.stats()['size'], 0)
+
+
+class _PreparedConnection(object):
+    # 记录 prepared cursor 的创建次数，sqlite3 的游标代替预处理语句
+    def __init__(self, connection):
+        self.connection = connection
+        self.prepared = 0
+
+    def cursor(self, prepared=False, buffered=True):
+        if prepared:
+            self.prepared += 1
+        return self.connection.cursor()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class PreparedSqliteDriver(SqliteDriver):
+    name = 'sqlite3-prepared'
+    prepared = True
+
+    def connect(self, params):
+        return _PreparedConnection(SqliteDriver.connect(self, params))
+
+
+class StatementCacheTest(unittest.TestCase):
+    def test_translate(self):
+        driver = MySQLConnectorDriver()
+        sql = 'select * from t where id=? and name=?'
+        translated = driver.translate(sql)
+        self.assertEqual(translated, 'select * from t where id=%s and name=%s')
+        self.assertIs(driver.translate(sql), translated)
+        driver.max_sql_cache = 2
+        for i in range(5):
+            driver.translate('select %d' % i)
+        self.assertLessEqual(len(driver._sql_cache), 2)
+
+    def test_prepared_cursor_lru(self):
+        pooled = db._PooledConnection(_PreparedConnection(sqlite3.connect(':memory:')))
+        cursor = pooled.prepared_cursor('select 0')
+        self.assertIs(pooled.prepared_cursor('select 0'), cursor)
+        oldest = pooled.prepared_cursor('select 1')
+        for i in range(2, db.MAX_STATEMENTS):
+            pooled.prepared_cursor('select %d' % i)
+        # 使用过的语句移到末尾，淘汰最久未使用的语句并关闭其游标
+        pooled.prepared_cursor('select 0')
+        pooled.prepared_cursor('select %d' % db.MAX_STATEMENTS)
+        self.assertEqual(len(pooled.statements), db.MAX_STATEMENTS)
+        self.assertNotIn('select 1', pooled.statements)
+        self.assertRaises(sqlite3.ProgrammingError, oldest.execute, 'select 1')
+        self.assertEqual(pooled.connection.prepared, db.MAX_STATEMENTS + 1)
+        pooled.drop_statement('select 0')
+        self.assertNotIn('select 0', pooled.statements)
+        self.assertRaises(sqlite3.ProgrammingError, cursor.execute, 'select 0')
+
+
+class PreparedSelectTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        _reset_engine()
+        db.create_engine(database=os.path.join(self.tmp, 'test.db'), driver=PreparedSqliteDriver(), prepared=True)
+        db.update('create table t (id integer primary key, name text)')
+        db.insert_many('t', [dict(id=i, name='n%d' % i) for i in range(3)])
+
+    def tearDown(self):
+        _reset_engine()
+        shutil.rmtree(self.tmp)
+
+    def test_reuse(self):
+        with db.ConnectionCtx():
+            connection = db._db_ctx.connection
+            connection.cursor()
+            prepared = connection.connection.prepared
+            for i in range(3):
+                self.assertEqual(db.select_one('select name from t where id=?', i).name, 'n%d' % i)
+                self.assertEqual(len(db.select('select * from t')), 3)
+            statements = connection._pooled.statements
+            self.assertEqual(connection.connection.prepared, prepared + 2)
+            self.assertIn('select name from t where id=?', statements)
+            self.assertIn('select * from t', statements)
+
+    def test_error_drops_statement(self):
+        with db.ConnectionCtx():
+            self.assertRaises(sqlite3.Error, db.update, 'insert into t values (?, ?)', 0, 'dup')
+            self.assertNotIn('insert into t values (?, ?)', db._db_ctx.connection._pooled.statements)
+
+    def test_unsupported_driver(self):
+        _reset_engine()
+        self.assertRaises(db.DBError, db.create_engine, database=os.path.join(self.tmp, 'test.db'),
+                          driver='sqlite3', prepared=True)
+
+
+class MySQLPreparedTest(unittest.TestCase):
+    def setUp(self):
+        try:
+            import mysql.connector
+            mysql.connector.connect(connection_timeout=2, **settings.database).close()
+        except Exception as e:
+            self.skipTest('mysql is not available: %s' % e)
+        _reset_engine()
+        db.create_engine(prepared=True, **settings.database)
+        db.update('drop table if exists prepared_test')
+        db.update('create table prepared_test (id int primary key, name varchar(20))')
+
+    def tearDown(self):
+        db.update('drop table if exists prepared_test')
+        _reset_engine()
+
+    def test_prepared_query(self):
+        db.insert('prepared_test', id=1, name='a')
+        db.insert('prepared_test', id=2, name='b')
+        # 同一条语句执行两次，第二次复用 prepared cursor
+        for i in range(2):
+            self.assertEqual(db.select_one('select name from prepared_test where id=?', 2).name, 'b')
+            self.assertEqual(db.select_int('select count(*) from prepared_test'), 2)
+
+
+class SqliteTestCase(unittest.TestCase):
+    # 使用临时 sqlite 文件的数据库，表 t (id, name)
+    engine_options = {}
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        _reset_engine()
+        db.create_engine(database=os.path.join(self.tmp, 'test.db'), driver='sqlite3', **self.engine_options)
+        db.update('create table t (id integer primary key, name text)')
+
+    def tearDown(self):
+        _reset_engine()
+        shutil.rmtree(self.tmp)
+
+
+class SqliteTransactionTest(SqliteTestCase):
+
+    def test_outer_rollback_discards_nested_transaction(self):
+        try:
+            with db.transaction():
+                with db.transaction():
+                    db.insert('t', id=1, name='inner')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(db.select_int('select count(*) from t'), 0)
+
+    def test_nested_rollback_keeps_outer_rows(self):
+        with db.transaction():
+            db.insert('t', id=1, name='outer')
+            try:
+                with db.transaction():
+                    db.insert('t', id=2, name='inner')
+                    raise ValueError()
+            except ValueError:
+                pass
+        self.assertEqual([r.id for r in db.select('select id from t')], [1])
+
+    def test_unit_of_work_is_atomic(self):
+        from mwebapp import orm
+        from models import User
+        db.update(User().__sql__())
+        try:
+            with orm.unit_of_work() as uow:
+                user = uow.insert(User(id=1, name='a', email='a'))
+                uow.insert(User(id=2, name='b', email='b'))
+                # 不同的操作分隔开，重复的主键在第二次 bulk_insert 中写入
+                uow.update(user)
+                uow.insert(User(id=1, name='c', email='c'))
+        except Exception:
+            pass
+        else:
+            self.fail('duplicate primary key was not rejected')
+        self.assertEqual(db.select_int('select count(*) from user'), 0)
+
+
+class IterSelectTest(SqliteTestCase):
+    def setUp(self):
+        super(IterSelectTest, self).setUp()
+        db.insert_many('t', [dict(id=i, name='n%d' % i) for i in range(10)])
+
+    def test_all_rows(self):
+        rows = list(db.iter_select('select * from t where id>=? order by id', 2, chunk=3))
+        self.assertEqual([row.id for row in rows], list(range(2, 10)))
+        self.assertEqual(rows[0].name, 'n2')
+        stats = db.pool_stats()
+        self.assertEqual(stats['in_use'], 0)
+        # 读完的连接放回连接池
+        self.assertEqual(stats['closed'], 0)
+
+    def test_factory(self):
+        rows = list(db.iter_select('select id, name from t order by id', factory=db.row_factory))
+        self.assertEqual(rows[3], (3, 'n3'))
+        self.assertEqual(rows[3].name, 'n3')
+
+    def test_early_close(self):
+        rows = db.iter_select('select * from t order by id', chunk=3)
+        self.assertEqual(next(rows).id, 0)
+        self.assertEqual(db.pool_stats()['in_use'], 1)
+        rows.close()
+        stats = db.pool_stats()
+        self.assertEqual(stats['in_use'], 0)
+        # 未读完的连接关闭，不放回连接池
+        self.assertEqual(stats['closed'], 1)
+        self.assertEqual(db.select_int('select count(*) from t'), 10)
+
+    def test_unknown_keyword(self):
+        self.assertRaises(TypeError, next, db.iter_select('select * from t', chunks=3))
+
+    def test_iter_by(self):
+        from models import User
+        db.update(User().__sql__())
+        User.bulk_insert([User(id=i, name='u%d' % i, email='e%d' % i) for i in range(5)])
+        users = User.iter_by('where id>? order by id', 1, columns=['id', 'name'], chunk=2)
+        self.assertEqual([(u.id, u.name) for u in users], [(2, 'u2'), (3, 'u3'), (4, 'u4')])
+        users = User.iter_by('order by id')
+        self.assertIsInstance(next(users), User)
+        users.close()
+        self.assertEqual(db.pool_stats()['in_use'], 0)
+
+
+class SqliteQueryCacheTest(unittest.TestCase):
+    # 从库为另一个 sqlite 文件，不同步主库的写入，相当于复制延迟无限大的从库
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        _reset_engine()
+        primary = os.path.join(self.tmp, 'primary.db')
+        replica = os.path.join(self.tmp, 'replica.db')
+        db.create_engine(database=primary, driver='sqlite3', replicas=[{'database': replica}])
+        for path in (primary, replica):
+            connection = sqlite3.connect(path)
+            connection.execute('create table t (id integer primary key, name text)')
+            connection.execute("insert into t values (1, 'a')")
+            connection.commit()
+            connection.close()
+        self.cache = QueryCache()
+        db.set_query_cache(self.cache)
+
+    def tearDown(self):
+        db.set_query_cache(None)
+        _reset_engine()
+        shutil.rmtree(self.tmp)
+
+    def test_hit_and_invalidate(self):
+        self.assertEqual(db.select_int('select count(*) from t', cache=60), 1)
+        self.assertEqual(db.select_int('select count(*) from t', cache=60), 1)
+        self.assertEqual(self.cache.stats(), dict(hits=1, misses=1))
+        db.update("insert into t values (2, 'b')")
+        self.assertEqual(db.select_int('select count(*) from t', cache=60), 2)
+
+    def test_fill_reads_from_primary(self):
+        with db.ConnectionCtx():
+            db.insert('t', id=2, name='b')
+            # 写入后缓存未命中，不能从落后的从库读到旧数据并以新版本号缓存
+            self.assertEqual(len(db.select('select * from t', cache=60)), 2)
+        self.assertEqual(len(db.select('select * from t', cache=60)), 2)
+        # 未使用缓存的读操作仍使用从库
+        self.assertEqual(len(db.select('select * from t')), 1)
+
+    def test_invalidated_after_commit(self):
+        self.assertEqual(db.select_int('select count(*) from t', cache=60), 1)
+        with db.transaction():
+            db.insert('t', id=2, name='b')
+            # 提交前其他连接以新版本号缓存了提交前的数据
+            self.cache.set(self.cache.get('select count(*) from t', [])[0], (['count'], [(1,)]))
+        self.assertEqual(db.select_int('select count(*) from t', cache=60), 2)
+
+    def test_transaction_skips_cache(self):
+        def write():
+            with db.transaction():
+                db.insert('t', id=2, name='b')
+                # 事务内读到未提交的数据，不写入缓存
+                self.assertEqual(db.select_int('select count(*) from t', cache=60), 2)
+                raise ValueError()
+        self.assertRaises(ValueError, write)
+        self.assertEqual(self.cache.stats(), dict(hits=0, misses=0))
+        self.assertEqual(db.select_int('select count(*) from t', cache=60), 1)
+
+
+class ReplicaTestCase(unittest.TestCase):
+    # 主库和两个从库为各自独立的 sqlite 文件，t 表中的 name 标明读到的是哪个库
+    engine_options = {}
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        _reset_engine()
+        names = ['primary', 'replica0', 'replica1']
+        paths = [os.path.join(self.tmp, name + '.db') for name in names]
+        for name, path in zip(names, paths):
+            connection = sqlite3.connect(path)
+            connection.execute('create table t (id integer primary key, name text)')
+            connection.execute('insert into t values (1, ?)', (name,))
+            connection.commit()
+            connection.close()
+        db.create_engine(database=paths[0], driver='sqlite3',
+                         replicas=[{'database': path} for path in paths[1:]], **self.engine_options)
+
+    def tearDown(self):
+        _reset_engine()
+        shutil.rmtree(self.tmp)
+
+    def read(self):
+        return db.select_one('select name from t where id=1').name
+
+
+class ReplicaTest(ReplicaTestCase):
+    def test_round_robin(self):
+        self.assertEqual([self.read() for i in range(4)], ['replica0', 'replica1', 'replica0', 'replica1'])
+        # 同一连接作用域内使用同一个从库
+        with db.ConnectionCtx():
+            self.assertEqual(set(self.read() for i in range(3)), set([self.read()]))
+        self.assertEqual(len(db.pool_stats()['replicas']), 2)
+
+    def test_writes_use_primary(self):
+        db.update("update t set name='written' where id=1")
+        self.assertEqual(db.select_one('select name from t where id=1', primary=True).name, 'written')
+        self.assertTrue(self.read().startswith('replica'))
+
+    def test_transaction_uses_primary(self):
+        with db.transaction():
+            self.assertEqual(self.read(), 'primary')
+            self.assertEqual([row.name for row in db.iter_select('select name from t')], ['primary'])
+
+    def test_pin_primary(self):
+        with db.ConnectionCtx():
+            self.assertTrue(self.read().startswith('replica'))
+            db.pin_primary()
+            self.assertEqual(self.read(), 'primary')
+        self.assertTrue(self.read().startswith('replica'))
+
+    def test_writes_do_not_pin(self):
+        with db.ConnectionCtx():
+            db.update("update t set name='written' where id=1")
+            self.assertTrue(self.read().startswith('replica'))
+
+    def test_iter_select(self):
+        self.assertTrue(next(db.iter_select('select name from t')).name.startswith('replica'))
+        with db.ConnectionCtx():
+            db.pin_primary()
+            self.assertEqual([row.name for row in db.iter_select('select name from t')], ['primary'])
+
+    def test_bad_balance(self):
+        _reset_engine()
+        self.assertRaises(ValueError, db.create_engine, database=os.path.join(self.tmp, 'primary.db'),
+                          driver='sqlite3', replicas=[{'database': 'x.db'}], balance='random')
+
+
+class ReadYourWritesTest(ReplicaTestCase):
+    engine_options = {'read_your_writes': True}
+
+    def test_read_your_writes(self):
+        with db.ConnectionCtx():
+            self.assertTrue(self.read().startswith('replica'))
+            db.update("update t set name='written' where id=1")
+            self.assertEqual(self.read(), 'written')
+            self.assertEqual([row.name for row in db.iter_select('select name from t')], ['written'])
+        # 新的连接作用域 (请求) 重新使用从库
+        with db.ConnectionCtx():
+            self.assertTrue(self.read().startswith('replica'))
+
+
+class LeastConnectionsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        _reset_engine()
+        db.create_engine(database=os.path.join(self.tmp, 'primary.db'), driver='sqlite3',
+                         replicas=[{'database': os.path.join(self.tmp, 'replica%d.db' % i)} for i in range(2)],
+                         balance='least_connections')
+
+    def tearDown(self):
+        _reset_engine()
+        shutil.rmtree(self.tmp)
+
+    def test_least_connections(self):
+        busy = db.engine.read_pool()
+        pooled = busy.acquire()
+        try:
+            # 有连接在使用的从库不再被选中
+            for i in range(3):
+                self.assertIsNot(db.engine.read_pool(), busy)
+        finally:
+            busy.release(pooled)
+
+
+class BatchTest(unittest.TestCase):
+    def test_estimate_size(self):
+        self.assertEqual(db._estimate_size(b'abc'), 9)
+        self.assertEqual(db._estimate_size(u'abc'), 9)
+        # 中文每个字符 utf-8 编码后为 3 个字节
+        self.assertEqual(db._estimate_size(u'\u4e2d\u6587'), 15)
+
+    def test_chunk_rows_by_packet_size(self):
+        rows = [[i, u'\u4e2d' * 100] for i in range(100)]
+        chunks = list(db._chunk_rows(rows, 1000, 10000))
+        self.assertEqual(sum(len(chunk) for chunk in chunks), 100)
+        for chunk in chunks:
+            size = sum(len(row[1].encode('utf-8')) * 2 for row in chunk)
+            self.assertLessEqual(size, 10000)
+
+    def test_chunk_rows_by_count(self):
+        chunks = list(db._chunk_rows([[i] for i in range(10)], 4, db.MAX_PACKET))
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 4, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+import gzip
+import unittest
+import zlib
+
+from mwebapp.middleware import CompressionMiddleware
+from mwebapp.webapp import WSGIApplication, ctx
+
+from client import call
+
+TEXT = u'<p>hello world</p>\n' * 200
+
+
+class CompressionMiddlewareTest(unittest.TestCase):
+    def setUp(self):
+        self.app = app = WSGIApplication()
+        app.interceptor(CompressionMiddleware)
+        self.chunks = [(u'<p>chunk %d</p>\n' % i) * 50 for i in range(5)]
+
+        @app.get('/text/')
+        def text():
+            return TEXT
+
+        @app.get('/small/')
+        def small():
+            return u'<p>small</p>'
+
+        @app.get('/image/')
+        def image():
+            ctx.response.content_type = 'image/png'
+            return b'\x89PNG' + b'\x00' * 2000
+
+        @app.get('/encoded/')
+        def encoded():
+            ctx.response.set_header('Content-Encoding', 'gzip')
+            return gzip.compress(TEXT.encode('utf-8'))
+
+        @app.get('/no-transform/')
+        def no_transform():
+            ctx.response.set_header('Cache-Control', 'no-transform')
+            return TEXT
+
+        @app.get('/stream/')
+        def stream():
+            for chunk in self.chunks:
+                yield chunk
+
+        @app.get('/etag/:kind/')
+        def etag(kind):
+            ctx.response.set_header('ETag', 'W/"v1"' if kind == 'weak' else '"v1"')
+            return TEXT
+
+        @app.get('/vary/:vary/')
+        def vary(vary):
+            ctx.response.set_header('Vary', vary)
+            return TEXT
+
+    def get(self, path, accept='gzip'):
+        return call(self.app, path, headers={'Accept-Encoding': accept} if accept else None)
+
+    def assertIdentity(self, r):
+        self.assertEqual(r.status_code, 200)
+        self.assertIsNone(r.header('Content-Encoding'))
+
+    def test_gzip(self):
+        r = self.get('/text/')
+        self.assertEqual(r.header('Content-Encoding'), 'gzip')
+        self.assertEqual(r.header('Vary'), 'Accept-Encoding')
+        self.assertEqual(int(r.header('Content-Length')), len(r.body))
+        self.assertEqual(gzip.decompress(r.body).decode('utf-8'), TEXT)
+
+    def test_deflate(self):
+        r = self.get('/text/', 'deflate')
+        self.assertEqual(r.header('Content-Encoding'), 'deflate')
+        self.assertEqual(zlib.decompress(r.body).decode('utf-8'), TEXT)
+
+    def test_negotiation(self):
+        self.assertEqual(self.get('/text/', 'deflate;q=0.5, gzip;q=0.8').header('Content-Encoding'), 'gzip')
+        self.assertEqual(self.get('/text/', 'gzip;q=0, deflate').header('Content-Encoding'), 'deflate')
+        self.assertEqual(self.get('/text/', '*').header('Content-Encoding'), 'gzip')
+        for accept in (None, 'identity', 'gzip;q=0', '*;q=0', 'compress'):
+            r = self.get('/text/', accept)
+            self.assertIdentity(r)
+            self.assertEqual(r.body.decode('utf-8'), TEXT)
+            # 压缩与否取决于 Accept-Encoding，不压缩时同样需要 Vary
+            self.assertEqual(r.header('Vary'), 'Accept-Encoding')
+
+    def test_min_size(self):
+        r = self.get('/small/')
+        self.assertIdentity(r)
+        self.assertEqual(r.body, b'<p>small</p>')
+
+    def test_content_type_skip(self):
+        r = self.get('/image/')
+        self.assertIdentity(r)
+        self.assertIsNone(r.header('Vary'))
+        self.assertEqual(len(r.body), 2004)
+
+    def test_existing_encoding_skip(self):
+        r = self.get('/encoded/')
+        self.assertEqual(r.header('Content-Encoding'), 'gzip')
+        self.assertEqual(gzip.decompress(r.body).decode('utf-8'), TEXT)
+
+    def test_no_transform_skip(self):
+        self.assertIdentity(self.get('/no-transform/'))
+
+    def test_head(self):
+        r = call(self.app, '/text/', 'HEAD', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(r.header('Content-Encoding'), 'gzip')
+        self.assertEqual(r.body, b'')
+
+    def test_stream(self):
+        r = self.get('/stream/')
+        self.assertEqual(r.header('Content-Encoding'), 'gzip')
+        self.assertIsNone(r.header('Content-Length'))
+        self.assertGreater(len(r.chunks), 1)
+        # 每块输出后都可以解压出已输出的内容，不需要等待响应结束
+        decompressor = zlib.decompressobj(31)
+        text = u''
+        for i, chunk in enumerate(r.chunks[:len(self.chunks)]):
+            text += decompressor.decompress(chunk).decode('utf-8')
+            self.assertEqual(text, u''.join(self.chunks[:i + 1]))
+        text += decompressor.decompress(b''.join(r.chunks[len(self.chunks):])).decode('utf-8')
+        self.assertEqual(text, u''.join(self.chunks))
+        self.assertTrue(decompressor.eof)
+
+    def test_stream_identity(self):
+        r = self.get('/stream/', None)
+        self.assertIdentity(r)
+        self.assertEqual(r.body.decode('utf-8'), u''.join(self.chunks))
+
+    def test_etag(self):
+        r = self.get('/etag/strong/')
+        self.assertEqual(r.header('ETag'), 'W/"v1"')
+        self.assertEqual(self.get('/etag/weak/').header('ETag'), 'W/"v1"')
+        # 未压缩时保留强 ETag
+        self.assertEqual(self.get('/etag/strong/', None).header('ETag'), '"v1"')
+
+    def test_vary(self):
+        self.assertEqual(self.get('/vary/Cookie/').header('Vary'), 'Cookie, Accept-Encoding')
+        self.assertEqual(self.get('/vary/Cookie, accept-encoding/').header('Vary'), 'Cookie, accept-encoding')
+        self.assertEqual(self.get('/vary/*/').header('Vary'), '*')
+
+
+if __name__ == '__main__':
+    unittest.main()
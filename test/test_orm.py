@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+import os
+import shutil
+import tempfile
+import unittest
+
+from mwebapp import db
+from mwebapp.orm import Model, IntegerField, StringField
+
+from models import User
+
+
+def _reset_engine():
+    if db.engine is not None:
+        db.engine.pool.close()
+    db.engine = None
+
+
+class IdentityUser(Model):
+    __table__ = 'user'
+    __identity_map__ = True
+    id = IntegerField(primary_key=True)
+    name = StringField()
+    email = StringField(updatable=False)
+
+
+class SubIdentityUser(IdentityUser):
+    # 未设置 __identity_map__，继承基类的设置
+    __table__ = 'user'
+    id = IntegerField(primary_key=True)
+    name = StringField()
+
+
+class CachedUser(Model):
+    __table__ = 'user'
+    __cache__ = {'maxsize': 2, 'ttl': 60}
+    id = IntegerField(primary_key=True)
+    name = StringField()
+    email = StringField(updatable=False)
+
+
+class OrmTestCase(unittest.TestCase):
+    # 临时 sqlite 文件中的 user 表，id 0-4
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        _reset_engine()
+        db.create_engine(database=os.path.join(self.tmp, 'test.db'), driver='sqlite3')
+        db.update(User().__sql__())
+        User.bulk_insert([User(id=i, name='u%d' % i, email='e%d' % i) for i in range(5)])
+
+    def tearDown(self):
+        _reset_engine()
+        shutil.rmtree(self.tmp)
+
+
+class ProjectionTest(OrmTestCase):
+    def test_columns(self):
+        users = User.find_by('where id<? order by id', 2, columns=['id', 'name'])
+        self.assertEqual(users, [dict(id=0, name='u0'), dict(id=1, name='u1')])
+        self.assertIsInstance(users[0], User)
+        self.assertEqual(User.find_first('where id=?', 3, columns=['email']), dict(email='e3'))
+        self.assertEqual(User.get(4, columns=['name']), dict(name='u4'))
+
+    def test_unknown_column(self):
+        self.assertRaises(ValueError, User.find_by, 'where id=?', 1, columns=['id', 'password'])
+
+    def test_sql_cache(self):
+        sql = User._select_sql(['id'], 'where id=?')
+        self.assertIs(User._select_sql(['id'], 'where id=?'), sql)
+        self.assertEqual(sql, 'select `id` from `user` where id=?')
+
+    def test_find_rows(self):
+        rows = User.find_rows('where id>? order by id', 2, columns=['id', 'name'])
+        self.assertEqual(rows, [(3, 'u3'), (4, 'u4')])
+        self.assertEqual(rows[0].name, 'u3')
+        self.assertEqual(rows[0]._fields, ('id', 'name'))
+
+    def test_select_rows(self):
+        row = db.select_rows('select count(id), max(id) as top from user')[0]
+        self.assertEqual(row, (5, 4))
+        # 不合法的字段名改为 _0, _1 ...
+        self.assertEqual(row._0, 5)
+        self.assertEqual(row.top, 4)
+        # 同一组字段共用一个行类
+        self.assertIs(db.row_class(['id', 'name']), db.row_class(('id', 'name')))
+
+
+class IdentityMapTest(OrmTestCase):
+    def test_same_object(self):
+        with db.ConnectionCtx():
+            user = IdentityUser.get(1)
+            self.assertIs(IdentityUser.get(1), user)
+            self.assertIsNot(IdentityUser.get(2), user)
+        # 每个连接作用域有各自的 identity map
+        with db.ConnectionCtx():
+            self.assertIsNot(IdentityUser.get(1), user)
+        self.assertIsNot(IdentityUser.get(1), IdentityUser.get(1))
+
+    def test_update_invalidates(self):
+        with db.ConnectionCtx():
+            user = IdentityUser.get(1)
+            user.name = 'changed'
+            user.update()
+            fresh = IdentityUser.get(1)
+            self.assertIsNot(fresh, user)
+            self.assertEqual(fresh.name, 'changed')
+
+    def test_delete_invalidates(self):
+        with db.ConnectionCtx():
+            IdentityUser.get(2).delete()
+            self.assertIsNone(IdentityUser.get(2))
+
+    def test_columns_skip_identity_map(self):
+        with db.ConnectionCtx():
+            user = IdentityUser.get(1)
+            self.assertEqual(IdentityUser.get(1, columns=['name']), dict(name='u1'))
+            self.assertIs(IdentityUser.get(1), user)
+
+    def test_inherited(self):
+        self.assertTrue(SubIdentityUser.__identity_map__)
+        self.assertIsNone(SubIdentityUser.__cache__)
+        with db.ConnectionCtx():
+            self.assertIs(SubIdentityUser.get(3), SubIdentityUser.get(3))
+        self.assertFalse(User.__identity_map__)
+
+
+class ModelCacheTest(OrmTestCase):
+    def setUp(self):
+        super(ModelCacheTest, self).setUp()
+        CachedUser.__cache__.clear()
+        CachedUser.__cache_stats__.update(identity_hits=0, cache_hits=0, misses=0)
+
+    def test_hits(self):
+        user = CachedUser.get(1)
+        user.name = 'local'
+        other = CachedUser.get(1)
+        self.assertIsNot(other, user)
+        # 缓存的是副本，修改返回的对象不影响缓存
+        self.assertEqual(other.name, 'u1')
+        self.assertEqual(CachedUser.cache_stats(),
+                         dict(identity_hits=0, cache_hits=1, misses=1, cache_size=1))
+
+    def test_maxsize(self):
+        for pk in range(4):
+            CachedUser.get(pk)
+        self.assertEqual(CachedUser.cache_stats()['cache_size'], 2)
+        CachedUser.get(0)
+        self.assertEqual(CachedUser.cache_stats()['misses'], 5)
+
+    def test_missing_row_not_cached(self):
+        self.assertIsNone(CachedUser.get(100))
+        self.assertEqual(CachedUser.cache_stats()['cache_size'], 0)
+
+    def test_update_and_delete_invalidate(self):
+        user = CachedUser.get(1)
+        user.name = 'changed'
+        user.update()
+        self.assertEqual(CachedUser.get(1).name, 'changed')
+        CachedUser.get(1).delete()
+        self.assertIsNone(CachedUser.get(1))
+
+    def test_transaction_skips_cache(self):
+        CachedUser.get(1)
+        with db.transaction():
+            CachedUser.get(1)
+            CachedUser.get(2)
+        stats = CachedUser.cache_stats()
+        self.assertEqual((stats['cache_hits'], stats['misses'], stats['cache_size']), (0, 3, 1))
+
+    def test_invalidated_after_commit(self):
+        key = ('user', 1)
+        with db.transaction():
+            user = CachedUser.get(1)
+            user.name = 'changed'
+            user.update()
+            # 提交前其他请求读入了旧数据
+            CachedUser.__cache__.set(key, dict(id=1, name='u1', email='e1'))
+        self.assertIsNone(CachedUser.__cache__.get(key))
+        self.assertEqual(CachedUser.get(1).name, 'changed')
+
+
+if __name__ == '__main__':
+    unittest.main()
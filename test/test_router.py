@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+# 路由的用例对 TrieRouter 和 RegexRouter 各运行一次
+import random
+import unittest
+
+from mwebapp.router import TrieRouter, RegexRouter
+from mwebapp.webapp import WSGIApplication
+
+from client import call
+
+
+def _handler(name):
+    def handler(*args):
+        return name
+    handler.__name__ = name
+    return handler
+
+
+class RouterTests(object):
+    router_class = None
+
+    def setUp(self):
+        self.router = self.router_class()
+
+    def add(self, method, path, name=None):
+        func = _handler(name or '%s %s' % (method, path))
+        self.router.add(method, path, func)
+        return func
+
+    def match(self, method, path):
+        matched = self.router.match(method, path)
+        if matched is None:
+            return None
+        func, args, allow = matched
+        return (func and func.__name__), args, allow
+
+    def test_static(self):
+        self.add('GET', '/about/')
+        self.assertEqual(self.match('GET', '/about/'), ('GET /about/', (), 'GET, HEAD, OPTIONS'))
+        self.assertIsNone(self.match('GET', '/missing/'))
+
+    def test_params(self):
+        self.add('GET', '/user/:id/')
+        self.add('GET', '/user/:id/post/:post/')
+        self.add('GET', '/file/img-:name.png')
+        self.assertEqual(self.match('GET', '/user/42/')[:2], ('GET /user/:id/', ('42',)))
+        self.assertEqual(self.match('GET', '/user/42/post/7/')[:2], ('GET /user/:id/post/:post/', ('42', '7')))
+        self.assertEqual(self.match('GET', '/file/img-logo.png')[:2], ('GET /file/img-:name.png', ('logo',)))
+        # 参数不匹配空的分段及 '/'
+        self.assertIsNone(self.match('GET', '/user//'))
+        self.assertIsNone(self.match('GET', '/user/a/b/'))
+        self.assertIsNone(self.match('GET', '/file/img-.png'))
+
+    def test_head(self):
+        self.add('GET', '/page/:id/')
+        self.add('GET', '/static-page/')
+        self.assertEqual(self.match('HEAD', '/page/1/')[0], 'GET /page/:id/')
+        self.assertEqual(self.match('HEAD', '/static-page/')[0], 'GET /static-page/')
+        # 单独注册的 HEAD 优先
+        self.add('HEAD', '/page/:id/')
+        self.assertEqual(self.match('HEAD', '/page/1/')[0], 'HEAD /page/:id/')
+
+    def test_options_and_method_not_allowed(self):
+        self.add('GET', '/item/:id/')
+        self.add('DELETE', '/item/:id/')
+        for method in ('OPTIONS', 'POST'):
+            self.assertEqual(self.match(method, '/item/1/'), (None, ('1',), 'DELETE, GET, HEAD, OPTIONS'))
+
+    def test_same_pattern_different_names(self):
+        self.add('GET', '/item/:id/')
+        self.add('POST', '/item/:name/')
+        self.assertEqual(self.match('POST', '/item/1/')[:2], ('POST /item/:name/', ('1',)))
+        self.assertEqual(self.match('PUT', '/item/1/')[2], 'GET, HEAD, OPTIONS, POST')
+
+    def test_static_before_params(self):
+        self.add('GET', '/user/:id/')
+        self.add('GET', '/user/me/')
+        self.assertEqual(self.match('GET', '/user/me/')[0], 'GET /user/me/')
+        self.assertEqual(self.match('GET', '/user/you/')[0], 'GET /user/:id/')
+
+    def test_static_segment_before_param_segment(self):
+        # 注册顺序与优先级相反
+        self.add('GET', '/a/:x/b')
+        self.add('GET', '/a/c/:y')
+        self.assertEqual(self.match('GET', '/a/c/b'), ('GET /a/c/:y', ('b',), 'GET, HEAD, OPTIONS'))
+        self.assertEqual(self.match('GET', '/a/d/b'), ('GET /a/:x/b', ('d',), 'GET, HEAD, OPTIONS'))
+
+    def test_mixed_segment_before_param_segment(self):
+        self.add('GET', '/f/:name/')
+        self.add('GET', '/f/img-:id/')
+        self.assertEqual(self.match('GET', '/f/img-1/'), ('GET /f/img-:id/', ('1',), 'GET, HEAD, OPTIONS'))
+        self.assertEqual(self.match('GET', '/f/doc/'), ('GET /f/:name/', ('doc',), 'GET, HEAD, OPTIONS'))
+
+    def test_overlapping_routes_by_method(self):
+        self.add('GET', '/a/:x/b')
+        self.add('POST', '/a/c/:y')
+        self.assertEqual(self.match('GET', '/a/c/b')[:2], ('GET /a/:x/b', ('c',)))
+        self.assertEqual(self.match('POST', '/a/c/b')[:2], ('POST /a/c/:y', ('b',)))
+        # 都不支持时合并 Allow，参数取自优先的路由
+        self.assertEqual(self.match('DELETE', '/a/c/b'), (None, ('b',), 'GET, HEAD, OPTIONS, POST'))
+        self.assertEqual(self.match('DELETE', '/a/d/b'), (None, ('d',), 'GET, HEAD, OPTIONS'))
+
+    def test_static_and_dynamic_allow(self):
+        self.add('PUT', '/a/c')
+        self.add('GET', '/a/:x')
+        self.assertEqual(self.match('GET', '/a/c')[:2], ('GET /a/:x', ('c',)))
+        self.assertEqual(self.match('DELETE', '/a/c'), (None, (), 'GET, HEAD, OPTIONS, PUT'))
+
+
+class TrieRouterTest(RouterTests, unittest.TestCase):
+    router_class = TrieRouter
+
+
+class RegexRouterTest(RouterTests, unittest.TestCase):
+    router_class = RegexRouter
+
+
+class RouterEquivalenceTest(unittest.TestCase):
+    # 随机生成重叠的路由，两种实现的匹配结果相同
+    # 同一路由中的参数名不能重复，按位置编号
+    segments = ['a', 'b', ':x%d', ':y%d', 'img-:id%d', 'img-:name%d.png', 'v-:n%d']
+    values = ['a', 'b', 'img-1', 'img-a.png', 'v-1', 'c', '']
+    methods = ['GET', 'POST', 'PUT']
+
+    def test_random_routes(self):
+        rand = random.Random(2024)
+        for round in range(50):
+            routers = [TrieRouter(), RegexRouter()]
+            for i in range(rand.randint(1, 30)):
+                length = rand.randint(1, 3)
+                path = '/' + '/'.join(rand.choice(self.segments).replace('%d', str(j)) for j in range(length))
+                method = rand.choice(self.methods)
+                func = _handler('%s %s' % (method, path))
+                for router in routers:
+                    router.add(method, path, func)
+            for i in range(100):
+                length = rand.randint(1, 3)
+                path = '/' + '/'.join(rand.choice(self.values) for j in range(length))
+                for method in self.methods + ['HEAD', 'OPTIONS', 'DELETE']:
+                    trie, regex = [router.match(method, path) for router in routers]
+                    self.assertEqual(trie, regex, (method, path))
+
+
+class ApplicationMethodTest(unittest.TestCase):
+    router = 'trie'
+
+    def setUp(self):
+        self.app = WSGIApplication(router=self.router)
+
+        @self.app.get('/item/:id/')
+        def item(id):
+            return 'item %s' % id
+
+    def test_head(self):
+        r = call(self.app, '/item/1/', 'HEAD')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.body, b'')
+        self.assertEqual(r.header('Content-Length'), '6')
+
+    def test_options(self):
+        r = call(self.app, '/item/1/', 'OPTIONS')
+        self.assertEqual(r.status_code, 204)
+        self.assertEqual(r.header('Allow'), 'GET, HEAD, OPTIONS')
+        self.assertEqual(r.body, b'')
+        self.assertIsNone(r.header('Content-Type'))
+        self.assertIsNone(r.header('Content-Length'))
+
+    def test_method_not_allowed(self):
+        r = call(self.app, '/item/1/', 'DELETE')
+        self.assertEqual(r.status_code, 405)
+        self.assertEqual(r.header('Allow'), 'GET, HEAD, OPTIONS')
+
+    def test_not_found(self):
+        self.assertEqual(call(self.app, '/missing/').status_code, 404)
+
+
+class RegexApplicationMethodTest(ApplicationMethodTest):
+    router = 'regex'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+# mwebapp.server 的测试，服务监听系统分配的端口
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+from mwebapp.server import ThreadPoolWSGIServer
+
+from client import connect, request, read_response, chunked
+from server_app import make_app
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 在子进程中运行 PreforkServer，参数为 max_requests 及 worker
+PREFORK_SCRIPT = '''
+import sys
+from mwebapp.server import PreforkServer
+from server_app import make_app
+PreforkServer(make_app(), '127.0.0.1', 0, workers=1, max_requests=int(sys.argv[1]), worker=sys.argv[2],
+              graceful_timeout=5).run()
+'''
+
+
+class ThreadPoolTestCase(unittest.TestCase):
+    server_options = {}
+
+    def setUp(self):
+        self.server = ThreadPoolWSGIServer(make_app(), '127.0.0.1', 0, **self.server_options)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def connect(self):
+        sock, rfile = connect(self.port)
+        self.sockets.append(sock)
+        return sock, rfile
+
+
+class ThreadPoolWSGIServerTest(ThreadPoolTestCase):
+    server_options = {'threads': 4}
+
+    def test_keep_alive(self):
+        sock, rfile = self.connect()
+        for i in range(3):
+            sock.sendall(request('GET', '/hello/'))
+            r = read_response(rfile)
+            self.assertEqual((r.status_code, r.body, r.header('Content-Length')), (200, b'hello', '5'))
+            self.assertIsNone(r.header('Connection'))
+        sock.sendall(request('GET', '/hello/', [('Connection', 'close')]))
+        self.assertEqual(read_response(rfile).body, b'hello')
+        self.assertIsNone(read_response(rfile))
+
+    def test_pipelining(self):
+        sock, rfile = self.connect()
+        sock.sendall(request('POST', '/echo/', body=b'x') + request('GET', '/stream/') + request('GET', '/hello/'))
+        self.assertEqual([read_response(rfile).body for i in range(3)], [b'echo:x', b'abc', b'hello'])
+
+    def test_chunked(self):
+        sock, rfile = self.connect()
+        sock.sendall(request('POST', '/echo/', [('Transfer-Encoding', 'chunked')], chunked(b'ab', b'cde')))
+        self.assertEqual(read_response(rfile).body, b'echo:abcde')
+        sock.sendall(request('GET', '/stream/'))
+        r = read_response(rfile)
+        self.assertEqual(r.header('Transfer-Encoding'), 'chunked')
+        self.assertEqual(r.chunks, [b'a', b'b', b'c'])
+        # HTTP/1.0 以关闭连接标识响应结束
+        sock, rfile = self.connect()
+        sock.sendall(request('GET', '/stream/', version='HTTP/1.0'))
+        r = read_response(rfile)
+        self.assertEqual((r.body, r.header('Connection')), (b'abc', 'close'))
+
+    def test_expect_continue(self):
+        sock, rfile = self.connect()
+        sock.sendall(request('POST', '/echo/', [('Expect', '100-continue'), ('Content-Length', '4')]))
+        self.assertEqual(read_response(rfile).status_code, 100)
+        sock.sendall(b'body')
+        self.assertEqual(read_response(rfile).body, b'echo:body')
+
+    def test_unread_body_is_drained(self):
+        # 处理函数没有读取请求体，读取下一个请求前跳过
+        sock, rfile = self.connect()
+        sock.sendall(request('GET', '/hello/', [('Content-Length', '5')], b'xxxxx') + request('GET', '/hello/'))
+        self.assertEqual([read_response(rfile).body for i in range(2)], [b'hello', b'hello'])
+
+
+class BackpressureTest(ThreadPoolTestCase):
+    # 一个工作线程，最多一个连接排队
+    server_options = {'threads': 1, 'backlog': 1}
+
+    def test_queue_full(self):
+        busy, busy_rfile = self.connect()
+        busy.sendall(request('GET', '/sleep/0.5/'))
+        time.sleep(0.2)
+        queued, queued_rfile = self.connect()
+        queued.sendall(request('GET', '/hello/'))
+        time.sleep(0.2)
+        # 队列已满，直接返回 503
+        rejected, rejected_rfile = self.connect()
+        rejected.sendall(request('GET', '/hello/'))
+        r = read_response(rejected_rfile)
+        self.assertEqual((r.status_code, r.header('Retry-After'), r.header('Connection')), (503, '1', 'close'))
+        # 有连接排队时响应后关闭连接，让出工作线程
+        r = read_response(busy_rfile)
+        self.assertEqual((r.body, r.header('Connection')), (b'slept', 'close'))
+        self.assertEqual(read_response(queued_rfile).body, b'hello')
+
+
+class QueueTimeoutTest(ThreadPoolTestCase):
+    server_options = {'threads': 1, 'queue_timeout': 0.2}
+
+    def test_queue_timeout(self):
+        busy, busy_rfile = self.connect()
+        busy.sendall(request('GET', '/sleep/0.5/'))
+        time.sleep(0.1)
+        queued, queued_rfile = self.connect()
+        queued.sendall(request('GET', '/hello/'))
+        self.assertEqual(read_response(busy_rfile).body, b'slept')
+        # 排队超过 queue_timeout 的连接返回 503
+        self.assertEqual(read_response(queued_rfile).status_code, 503)
+
+
+class HeaderTimeoutTest(ThreadPoolTestCase):
+    server_options = {'threads': 1, 'header_timeout': 0.5, 'request_timeout': 30}
+
+    def test_slow_headers(self):
+        sock, rfile = self.connect()
+        sock.settimeout(0.1)
+        start = time.time()
+        closed = False
+        sock.sendall(b'GET /hello/ HTTP/1.1\r\n')
+        # 每 0.1 秒发送请求头的一个字节，每次 recv 都不超过 request_timeout
+        while time.time() - start < 5:
+            try:
+                sock.sendall(b'X')
+                if sock.recv(1) == b'':
+                    closed = True
+                    break
+            except socket.timeout:
+                pass
+            except socket.error:
+                closed = True
+                break
+        self.assertTrue(closed)
+        self.assertLess(time.time() - start, 2)
+        # 工作线程已释放
+        sock, rfile = self.connect()
+        sock.sendall(request('GET', '/hello/'))
+        self.assertEqual(read_response(rfile).body, b'hello')
+
+
+class BodyLimitTest(ThreadPoolTestCase):
+    server_options = {'max_body': 10}
+
+    def test_chunked(self):
+        sock, rfile = self.connect()
+        sock.sendall(request('POST', '/echo/', [('Transfer-Encoding', 'chunked')], chunked(b'x' * 6, b'x' * 6)))
+        r = read_response(rfile)
+        self.assertEqual((r.status_code, r.header('Connection')), (413, 'close'))
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'Prefork server requires os.fork.')
+class PreforkTestCase(unittest.TestCase):
+    max_requests = 0
+    worker = 'wsgiref'
+
+    def setUp(self):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(TEST_DIR), TEST_DIR, env.get('PYTHONPATH', '')])
+        self.process = subprocess.Popen([sys.executable, '-u', '-c', PREFORK_SCRIPT, str(self.max_requests),
+                                         self.worker], cwd=TEST_DIR, env=env, stdout=subprocess.PIPE)
+        # 启动时输出 run prefork server on http://127.0.0.1:<port> ...
+        line = self.process.stdout.readline().decode('utf-8')
+        self.port = int(line.split('http://')[1].split()[0].rsplit(':', 1)[1])
+
+    def tearDown(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            self.process.wait(10)
+        self.process.stdout.close()
+
+    def pid(self):
+        # 每个请求使用新的连接，返回处理请求的工作进程
+        sock, rfile = connect(self.port, timeout=10)
+        try:
+            sock.sendall(request('GET', '/pid/', [('Connection', 'close')]))
+            return int(read_response(rfile).body)
+        finally:
+            rfile.close()
+            sock.close()
+
+    def wait_for_new_worker(self, old):
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                pid = self.pid()
+            except (OSError, ValueError):
+                pid = None
+            if pid is not None and pid != old:
+                return pid
+            time.sleep(0.1)
+        self.fail('Worker %d was not replaced' % old)
+
+
+class PreforkServerTest(PreforkTestCase):
+    def test_respawn(self):
+        pid = self.pid()
+        self.assertEqual(self.pid(), pid)
+        os.kill(pid, signal.SIGKILL)
+        self.assertNotEqual(self.wait_for_new_worker(pid), pid)
+
+    def test_stop(self):
+        pid = self.pid()
+        self.process.send_signal(signal.SIGTERM)
+        self.assertEqual(self.process.wait(10), 0)
+        # 工作进程随主进程退出
+        self.assertRaises(OSError, os.kill, pid, 0)
+
+
+class AsyncPreforkServerTest(PreforkServerTest):
+    worker = 'asyncio'
+
+
+class PreforkMaxRequestsTest(PreforkTestCase):
+    max_requests = 2
+
+    def test_max_requests(self):
+        pid = self.pid()
+        self.assertEqual(self.pid(), pid)
+        # 处理 2 个请求后退出，由新的工作进程继续处理排队的连接
+        new = self.pid()
+        self.assertNotEqual(new, pid)
+        self.assertEqual(self.pid(), new)
+
+
+class AsyncPreforkMaxRequestsTest(PreforkMaxRequestsTest):
+    worker = 'asyncio'
+
+
+if __name__ == '__main__':
+    unittest.main()
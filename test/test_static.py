@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from mwebapp.webapp import WSGIApplication, _parse_range
+
+from client import call
+
+
+class StaticVariantTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.data = b'var a = 1;\n' * 200
+        self.path = os.path.join(self.tmp, 'big.js')
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        self._write_gz(self.data)
+        self.app = WSGIApplication()
+        # 不缓存文件内容，每次从文件读取
+        self.app.static.configure(directory=self.tmp, cache_size=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write_gz(self, data):
+        with gzip.open(self.path + '.gz', 'wb') as f:
+            f.write(data)
+
+    def _get(self, headers=None):
+        return call(self.app, '/static/big.js', headers=headers)
+
+    def assertFramed(self, r):
+        if r.header('Content-Length') is not None:
+            self.assertEqual(int(r.header('Content-Length')), len(r.body))
+
+    def test_precompressed_variant(self):
+        r = self._get({'Accept-Encoding': 'gzip'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.header('Content-Encoding'), 'gzip')
+        self.assertEqual(r.header('Vary'), 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(r.body), self.data)
+        self.assertFramed(r)
+
+    def test_deleted_variant_falls_back_to_identity(self):
+        self._get({'Accept-Encoding': 'gzip'})
+        os.remove(self.path + '.gz')
+        r = self._get({'Accept-Encoding': 'gzip'})
+        self.assertEqual(r.status_code, 200)
+        self.assertIsNone(r.header('Content-Encoding'))
+        self.assertEqual(r.body, self.data)
+        self.assertFramed(r)
+
+    def test_variant_removed_before_open(self):
+        self._get({'Accept-Encoding': 'gzip'})
+        # 通过了一致性检查，打开前被删除
+        self.app.static._current = lambda variant: True
+        os.remove(self.path + '.gz')
+        r = self._get({'Accept-Encoding': 'gzip'})
+        self.assertEqual(r.status_code, 200)
+        self.assertIsNone(r.header('Content-Encoding'))
+        self.assertEqual(r.body, self.data)
+        self.assertFramed(r)
+
+    def test_regenerated_variant_is_reloaded(self):
+        self._get({'Accept-Encoding': 'gzip'})
+        data = b'var b = 2;\n' * 300
+        self._write_gz(data)
+        r = self._get({'Accept-Encoding': 'gzip'})
+        self.assertEqual(gzip.decompress(r.body), data)
+        self.assertFramed(r)
+
+    def test_missing_file(self):
+        r = call(self.app, '/static/missing.js', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(r.status_code, 404)
+        self.assertIsNone(r.header('Content-Encoding'))
+        self.assertTrue(r.header('Content-Type').startswith('text/html'))
+        self.assertFramed(r)
+
+    def test_unsatisfiable_range_on_variant(self):
+        r = self._get({'Accept-Encoding': 'gzip', 'Range': 'bytes=100000-'})
+        self.assertEqual(r.status_code, 416)
+        self.assertIsNone(r.header('Content-Encoding'))
+        self.assertIsNone(r.header('ETag'))
+        size = os.path.getsize(self.path + '.gz')
+        self.assertEqual(r.header('Content-Range'), 'bytes */%d' % size)
+        self.assertTrue(r.header('Content-Type').startswith('text/html'))
+        self.assertFramed(r)
+
+    def test_range_on_variant(self):
+        r = self._get({'Accept-Encoding': 'gzip', 'Range': 'bytes=0-9'})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.header('Content-Encoding'), 'gzip')
+        self.assertEqual(len(r.body), 10)
+        self.assertFramed(r)
+
+    def test_not_modified(self):
+        etag = self._get({'Accept-Encoding': 'gzip'}).header('ETag')
+        r = self._get({'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.body, b'')
+        self.assertIsNone(r.header('Content-Encoding'))
+        self.assertEqual(r.header('ETag'), etag)
+
+
+class ParseRangeTest(unittest.TestCase):
+    def test_range(self):
+        self.assertEqual(_parse_range('bytes=0-9', 100), (0, 9))
+        # 结束位置超出文件大小时截断
+        self.assertEqual(_parse_range('bytes=90-200', 100), (90, 99))
+
+    def test_open_ended(self):
+        self.assertEqual(_parse_range('bytes=10-', 100), (10, 99))
+
+    def test_suffix(self):
+        self.assertEqual(_parse_range('bytes=-5', 100), (95, 99))
+        self.assertEqual(_parse_range('bytes=-500', 100), (0, 99))
+        self.assertRaises(ValueError, _parse_range, 'bytes=-0', 100)
+
+    def test_out_of_range(self):
+        self.assertRaises(ValueError, _parse_range, 'bytes=100-', 100)
+        self.assertRaises(ValueError, _parse_range, 'bytes=100-200', 100)
+
+    def test_empty_file(self):
+        for value in ('bytes=-5', 'bytes=0-', 'bytes=0-0'):
+            self.assertRaises(ValueError, _parse_range, value, 0)
+
+    def test_ignored(self):
+        # 无法解析或包含多个区间时按完整文件响应
+        for value in (None, '', 'items=0-1', 'bytes=0-1,3-4', 'bytes=-', 'bytes=5-3', 'bytes=a-b', 'bytes=--5'):
+            self.assertIsNone(_parse_range(value, 100))
+
+
+class EmptyFileRangeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        open(os.path.join(self.tmp, 'empty.txt'), 'wb').close()
+        self.app = WSGIApplication()
+        self.app.static.configure(directory=self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_suffix_range(self):
+        r = call(self.app, '/static/empty.txt', headers={'Range': 'bytes=-5'})
+        self.assertEqual(r.status_code, 416)
+        self.assertEqual(r.header('Content-Range'), 'bytes */0')
+
+    def test_full_file(self):
+        r = call(self.app, '/static/empty.txt')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.header('Content-Length'), '0')
+        self.assertEqual(r.body, b'')
+
+
+class CacheControlTest(unittest.TestCase):
+    def setUp(self):
+        self.app = WSGIApplication()
+        self.static = self.app.static
+        self.static.configure(max_age=3600)
+
+    def test_immutable_is_off_by_default(self):
+        self.assertEqual(self.static._cache_header('/static/app.3f2a9c1b5d7e9f01.js'), 'public, max-age=3600')
+
+    def test_fingerprint(self):
+        self.static.configure(immutable=True)
+        self.assertEqual(self.static._cache_header('/static/app.3f2a9c1b5d7e9f01.js'),
+                         'public, max-age=31536000, immutable')
+        # 日期、版本号及较短的十六进制串不是指纹
+        for name in ('report-20240101.css', 'app.20240101.js', 'style-3f2a9c1b5d7e9f01.css', 'app.3f2a9c1b.js'):
+            self.assertEqual(self.static._cache_header('/static/' + name), 'public, max-age=3600')
+
+    def test_custom_fingerprint(self):
+        self.static.configure(immutable=True, fingerprint=r'-[0-9a-f]{8}\.\w+$')
+        self.assertEqual(self.static._cache_header('/static/style-3f2a9c1b.css'),
+                         'public, max-age=31536000, immutable')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from mwebapp.template_engine import TemplateCache, CompiledTemplate, Template, precompile, load_artifact
+
+BASE = '<title>{% block title %}{% endblock %}</title>{% block body %}{% endblock %}'
+PAGE = '''{% extends 'base.html' %}
+{% block title %}{{ title }}{% endblock %}
+{% block body %}{% for item in items %}<p>{{ item }}</p>{% endfor %}{% include 'footer.html' %}{% endblock %}'''
+FOOTER = '<footer>{{ title.upper() }}</footer>'
+
+
+class TemplateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.template_dir = os.path.join(self.tmp, 'template')
+        os.makedirs(self.template_dir)
+        self.write('base.html', BASE)
+        self.write('page.html', PAGE)
+        self.write('footer.html', FOOTER)
+        self.page = os.path.join(self.template_dir, 'page.html')
+        self.context = {'title': 'hi', 'items': ['a', 'b']}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, text):
+        path = os.path.join(self.template_dir, name)
+        mtime = os.stat(path).st_mtime if os.path.exists(path) else None
+        with open(path, 'w') as f:
+            f.write(text)
+        if mtime is not None:
+            # 保证 mtime 变化
+            os.utime(path, (mtime + 10, mtime + 10))
+
+    def render(self, cache, stream=False):
+        text = cache.get_template(self.page, stream=stream).render(dict(self.context))
+        return ''.join(text) if stream else text
+
+
+class TemplateCacheTest(TemplateTestCase):
+    def test_render(self):
+        cache = TemplateCache(template_dir=self.template_dir)
+        self.assertEqual(self.render(cache), '<title>hi</title><p>a</p><p>b</p><footer>HI</footer>')
+
+    def test_hit_skips_realpath(self):
+        cache = TemplateCache(template_dir=self.template_dir, auto_reload=False)
+        template = cache.get_template(self.page)
+        with mock.patch('os.path.realpath') as realpath, mock.patch('os.stat') as stat:
+            self.assertIs(cache.get_template(self.page), template)
+        self.assertEqual(realpath.call_count, 0)
+        self.assertEqual(stat.call_count, 0)
+
+    def test_hit_checks_dependencies(self):
+        cache = TemplateCache(template_dir=self.template_dir)
+        template = cache.get_template(self.page)
+        with mock.patch('os.path.realpath') as realpath:
+            self.assertIs(cache.get_template(self.page), template)
+        self.assertEqual(realpath.call_count, 0)
+
+    def test_dependency_invalidation(self):
+        cache = TemplateCache(template_dir=self.template_dir)
+        self.render(cache)
+        self.write('base.html', '<h1>{% block title %}{% endblock %}</h1>{% block body %}{% endblock %}')
+        self.assertEqual(self.render(cache), '<h1>hi</h1><p>a</p><p>b</p><footer>HI</footer>')
+        self.write('footer.html', '<small>{{ title }}</small>')
+        self.assertEqual(self.render(cache), '<h1>hi</h1><p>a</p><p>b</p><small>hi</small>')
+
+    def test_no_auto_reload(self):
+        cache = TemplateCache(template_dir=self.template_dir, auto_reload=False)
+        text = self.render(cache)
+        self.write('footer.html', '<small>{{ title }}</small>')
+        self.assertEqual(self.render(cache), text)
+        cache.clear()
+        self.assertTrue(self.render(cache).endswith('<small>hi</small>'))
+
+    def test_same_template_by_different_paths(self):
+        cache = TemplateCache(template_dir=self.template_dir)
+        other = os.path.join(self.template_dir, '.', 'page.html')
+        self.assertIs(cache.get_template(other), cache.get_template(self.page))
+        self.assertEqual(len(cache), 1)
+
+    def test_maxsize(self):
+        cache = TemplateCache(template_dir=self.template_dir, maxsize=1)
+        cache.get_template(self.page)
+        cache.get_template(os.path.join(self.template_dir, 'footer.html'))
+        self.assertEqual(len(cache), 1)
+
+
+class ArtifactTest(TemplateTestCase):
+    def setUp(self):
+        super(ArtifactTest, self).setUp()
+        self.artifact_dir = os.path.join(self.tmp, 'template_cache')
+        self.written = precompile(self.template_dir, self.artifact_dir)
+
+    def cache(self):
+        return TemplateCache(template_dir=self.template_dir, artifact_dir=self.artifact_dir)
+
+    def test_precompile(self):
+        self.assertEqual(len(self.written), 3)
+        cache = self.cache()
+        self.assertIsInstance(cache.get_template(self.page), CompiledTemplate)
+        self.assertEqual(self.render(cache), '<title>hi</title><p>a</p><p>b</p><footer>HI</footer>')
+
+    def test_preload(self):
+        cache = self.cache()
+        self.assertEqual(cache.preload(), 3)
+        self.assertIsInstance(cache.get_template(self.page), CompiledTemplate)
+
+    def test_stale_artifact_falls_back(self):
+        # 依赖的模版在预编译后修改，预编译文件失效，改为实时编译
+        self.write('footer.html', '<small>{{ title }}</small>')
+        self.assertIsNone(load_artifact(self.page, self.template_dir, self.artifact_dir))
+        cache = self.cache()
+        self.assertIsInstance(cache.get_template(self.page), Template)
+        self.assertTrue(self.render(cache).endswith('<small>hi</small>'))
+
+    def test_corrupt_artifact_falls_back(self):
+        for path in self.written:
+            with open(path, 'wb') as f:
+                f.write(b'not marshal data')
+        cache = self.cache()
+        self.assertIsInstance(cache.get_template(self.page), Template)
+        self.assertEqual(self.render(cache), '<title>hi</title><p>a</p><p>b</p><footer>HI</footer>')
+
+    def test_missing_stream_artifact(self):
+        # 只生成了普通模式的预编译文件
+        self.assertIsNone(load_artifact(self.page, self.template_dir, self.artifact_dir, stream=True))
+
+
+class StreamTest(TemplateTestCase):
+    def test_stream_matches_render(self):
+        cache = TemplateCache(template_dir=self.template_dir)
+        self.context['items'] = ['item %d' % i for i in range(100)]
+        self.assertEqual(self.render(cache, stream=True), self.render(cache))
+
+    def test_flush_size(self):
+        cache = TemplateCache(template_dir=self.template_dir)
+        self.context['items'] = ['item %d' % i for i in range(100)]
+        text = self.render(cache)
+        chunks = list(cache.get_template(self.page, stream=True).render(dict(self.context), flush_size=64))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(''.join(chunks), text)
+        # 除最后一块外每块至少 flush_size 个字符
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), 64)
+
+    def test_stream_and_normal_are_cached_separately(self):
+        cache = TemplateCache(template_dir=self.template_dir)
+        self.assertIsNot(cache.get_template(self.page), cache.get_template(self.page, stream=True))
+        self.assertTrue(cache.get_template(self.page, stream=True).stream)
+
+    def test_stream_artifact(self):
+        artifact_dir = os.path.join(self.tmp, 'template_cache')
+        precompile(self.template_dir, artifact_dir, stream=True)
+        cache = TemplateCache(template_dir=self.template_dir, artifact_dir=artifact_dir)
+        template = cache.get_template(self.page, stream=True)
+        self.assertIsInstance(template, CompiledTemplate)
+        self.assertEqual(self.render(cache, stream=True), self.render(cache))
+
+
+if __name__ == '__main__':
+    unittest.main()
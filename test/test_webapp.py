@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# __author__ = 'MingLei Ji'
+import os
+import shutil
+import tempfile
+import unittest
+
+from mwebapp import db
+from mwebapp.webapp import WSGIApplication, ctx, render_html
+
+from client import call
+
+
+def _reset_engine():
+    if db.engine is not None:
+        db.engine.pool.close()
+    db.engine = None
+
+
+class StreamScopeTest(unittest.TestCase):
+    # stream 模式的模版在响应体输出时才执行，此时仍使用请求的数据库连接及 ctx
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        _reset_engine()
+        db.create_engine(database=os.path.join(self.tmp, 'test.db'), driver='sqlite3')
+        db.update('create table t (id integer primary key)')
+        db.update('insert into t values (1)')
+        self.template = os.path.join(self.tmp, 'stream.html')
+        with open(self.template, 'w') as f:
+            f.write('{{ request.path_info }} {{ count() }} {{ path() }}')
+        self.app = app = WSGIApplication()
+
+        @app.get('/stream/')
+        def stream():
+            return render_html(self.template, {
+                'count': lambda: db.select_int('select count(*) from t'),
+                'path': lambda: ctx.request.path_info,
+            }, stream=True)
+
+    def tearDown(self):
+        _reset_engine()
+        shutil.rmtree(self.tmp)
+
+    def test_wsgi(self):
+        checkouts = db.pool_stats()['checkouts']
+        r = call(self.app, '/stream/')
+        self.assertEqual(r.body, b'/stream/ 1 /stream/')
+        # 模版中的查询使用请求的连接，没有另外从连接池取出
+        self.assertEqual(db.pool_stats()['checkouts'], checkouts + 1)
+        self.assertEqual(db.pool_stats()['in_use'], 0)
+        self.assertFalse(db._db_ctx.is_init())
+        self.assertRaises(AttributeError, getattr, ctx, 'request')
+
+    def test_asgi(self):
+        import asyncio
+        self.app.server_options = {'threads': 4}
+        checkouts = db.pool_stats()['checkouts']
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/stream/', 'headers': []}
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.app.asgi(scope, receive, send))
+        finally:
+            loop.close()
+            self.app._asgi.executor.shutdown()
+        body = b''.join(message.get('body', b'') for message in messages)
+        self.assertEqual(body, b'/stream/ 1 /stream/')
+        self.assertEqual(db.pool_stats()['checkouts'], checkouts + 1)
+        self.assertEqual(db.pool_stats()['in_use'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()